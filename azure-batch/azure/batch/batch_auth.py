@@ -44,6 +44,7 @@ class SharedKeyAuth(AuthBase):
         self._header = header
         self._account_name = account_name
         self._key = key
+        self._hmac = None
 
     def __call__(self, request):
 
@@ -57,29 +58,24 @@ class SharedKeyAuth(AuthBase):
         uri_path = uri_path.replace('%5C', '/')
         uri_path = uri_path.replace('%2F', '/')
 
-        # method to sign
-        string_to_sign = request.method + '\n'
-
-        # get headers to sign
-        request_header_dict = {
-            key.lower(): val for key, val in request.headers.items() if val}
-
-        request_headers = [
-            str(request_header_dict.get(x, '')) for x in self.headers_to_sign]
-
-        string_to_sign += '\n'.join(request_headers) + '\n'
-
-        # get ocp- header to sign
+        # get headers and ocp- headers to sign in a single pass
+        request_header_dict = {}
         ocp_headers = []
         for name, value in request.headers.items():
-            if 'ocp-' in name and value:
-                ocp_headers.append((name.lower(), value))
+            if value:
+                lower_name = name.lower()
+                request_header_dict[lower_name] = value
+                if 'ocp-' in name:
+                    ocp_headers.append((lower_name, value))
+        ocp_headers.sort()
 
-        for name, value in sorted(ocp_headers):
-            string_to_sign += "{}:{}\n".format(name, value)
+        # method and headers to sign
+        parts = [request.method]
+        parts.extend(str(request_header_dict.get(x, '')) for x in self.headers_to_sign)
+        parts.extend("{}:{}".format(name, value) for name, value in ocp_headers)
 
         # get account_name and uri path to sign
-        string_to_sign += "/{}{}".format(self._account_name, uri_path)
+        parts.append("/{}{}".format(self._account_name, uri_path))
 
         # get query string to sign if it is not table service
         query_to_sign = parse_qs(url.query)
@@ -87,11 +83,11 @@ class SharedKeyAuth(AuthBase):
         for name in sorted(query_to_sign.keys()):
             value = query_to_sign[name][0]
             if value:
-                string_to_sign += "\n{}:{}".format(name, value)
+                parts.append("{}:{}".format(name, value))
 
         # sign the request
         auth_string = "SharedKey {}:{}".format(
-            self._account_name, self._sign_string(string_to_sign))
+            self._account_name, self._sign_string('\n'.join(parts)))
 
         request.headers[self._header] = auth_string
 
@@ -99,15 +95,17 @@ class SharedKeyAuth(AuthBase):
 
     def _sign_string(self, string_to_sign):
 
-        _key = self._key.encode('utf-8')
-        string_to_sign = string_to_sign.encode('utf-8')
-
-        try:
-            key = base64.b64decode(_key)
-        except TypeError:
-            raise ValueError("Invalid key value: {}".format(self._key))
-
-        signed_hmac_sha256 = hmac.HMAC(key, string_to_sign, hashlib.sha256)
+        # the key is decoded once, and each signature starts from a copy of the keyed HMAC
+        if self._hmac is None:
+            _key = self._key.encode('utf-8')
+            try:
+                key = base64.b64decode(_key)
+            except TypeError:
+                raise ValueError("Invalid key value: {}".format(self._key))
+            self._hmac = hmac.HMAC(key, digestmod=hashlib.sha256)
+
+        signed_hmac_sha256 = self._hmac.copy()
+        signed_hmac_sha256.update(string_to_sign.encode('utf-8'))
         digest = signed_hmac_sha256.digest()
 
         return base64.b64encode(digest).decode('utf-8')
@@ -0,0 +1,11 @@
+# coding=utf-8
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+#--------------------------------------------------------------------------
+
+from .batch_service_client import CustomBatchServiceClient
+from .task_watcher import TaskStateChange, TaskStateWatcher
+
+__all__ = ['CustomBatchServiceClient', 'TaskStateChange', 'TaskStateWatcher']
@@ -0,0 +1,32 @@
+# coding=utf-8
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+#--------------------------------------------------------------------------
+
+from ..batch_service_client import BatchServiceClient
+from .file_operations import CustomFileOperations
+from .task_operations import CustomTaskOperations
+
+
+class CustomBatchServiceClient(BatchServiceClient):
+
+    def __init__(self, credentials, base_url=None):
+        """A client for issuing REST requests to the Azure Batch service.
+
+        The task operations of this client add the bulk submission of tasks and the watching of their states to
+        the generated operations, and its file operations add the concurrent download and the following of
+        files.
+
+        :param credentials: Credentials needed for the client to connect to Azure.
+        :type credentials: :mod:`A msrestazure Credentials
+         object<msrestazure.azure_active_directory>`
+        :param str base_url: Service URL
+        """
+        super(CustomBatchServiceClient, self).__init__(credentials, base_url)
+
+        self.file = CustomFileOperations(
+            self._client, self.config, self._serialize, self._deserialize)
+        self.task = CustomTaskOperations(
+            self._client, self.config, self._serialize, self._deserialize)
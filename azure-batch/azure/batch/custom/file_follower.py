@@ -0,0 +1,161 @@
+# coding=utf-8
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+#--------------------------------------------------------------------------
+
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+from .. import models
+
+if sys.version_info < (3,):
+    from Queue import Queue, Full
+else:
+    from queue import Queue, Full
+
+_END = object()
+
+
+class _FollowedFile(object):
+    """The state of a file being followed: the offset of the next byte to fetch, the incomplete last line, and
+    the current poll interval."""
+
+    def __init__(self, key, get_properties, get_range, interval):
+        self.key = key
+        self.get_properties = get_properties
+        self.get_range = get_range
+        self.interval = interval
+        self.offset = 0
+        self.partial = b''
+        self.last_growth = time.time()
+
+    def poll(self, encoding):
+        """Fetches the bytes appended to the file since the previous poll.
+
+        :return: The complete lines appended to the file, or None if the file didn't grow.
+        """
+        try:
+            size = self.get_properties().headers['Content-Length']
+        except models.BatchErrorException as ex:
+            # the task or its file may not exist yet
+            if getattr(ex.response, 'status_code', None) == 404:
+                return None
+            raise
+        if size < self.offset:
+            # the file was replaced, e.g. by a retry of the task
+            self.offset = 0
+            self.partial = b''
+        if size == self.offset:
+            return None
+        data = b''.join(self.get_range('bytes={}-{}'.format(self.offset, size - 1)))
+        self.offset += len(data)
+        self.last_growth = time.time()
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        return [_decode(line, encoding) for line in lines]
+
+
+def _decode(line, encoding):
+    return line.rstrip(b'\r').decode(encoding, 'replace')
+
+
+def _follow(files, min_interval, max_interval, idle_timeout, max_workers, encoding):
+    """Follows the files with a pool of threads sharing a schedule of the next poll of each file.
+
+    A file is polled again min_interval seconds after it grew, and the interval is doubled up to max_interval
+    each time the file didn't grow. A file which didn't grow for idle_timeout seconds is no longer followed,
+    and its incomplete last line is yielded.
+
+    :param files: The (key, get_properties, get_range) tuples of the files.
+    :return: An iterator over the (key, line) tuples of the lines appended to the files. The threads stop when
+     the iterator is closed or garbage collected, or after all the files reached idle_timeout.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than 0')
+    if not 0 < min_interval <= max_interval:
+        raise ValueError('the intervals must satisfy 0 < min_interval <= max_interval')
+    sequence = itertools.count()
+    schedule = []
+    for key, get_properties, get_range in files:
+        heapq.heappush(schedule, (0, next(sequence), _FollowedFile(key, get_properties, get_range, min_interval)))
+    condition = threading.Condition()
+    lines = Queue(1000)
+    stopped = threading.Event()
+    following = [len(schedule)]
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                lines.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def next_due():
+        with condition:
+            while not stopped.is_set():
+                if not schedule:
+                    if not following[0]:
+                        return None
+                    condition.wait(0.1)
+                    continue
+                wait = schedule[0][0] - time.time()
+                if wait <= 0:
+                    return heapq.heappop(schedule)[2]
+                condition.wait(min(wait, 0.1))
+        return None
+
+    def work():
+        while True:
+            followed = next_due()
+            if followed is None:
+                return
+            try:
+                new_lines = followed.poll(encoding)
+            except Exception as ex:  # pylint: disable=broad-except
+                put((_END, ex))
+                stopped.set()
+                return
+            for line in new_lines or []:
+                put((followed.key, line))
+
+            now = time.time()
+            if idle_timeout is not None and now - followed.last_growth >= idle_timeout:
+                if followed.partial:
+                    put((followed.key, _decode(followed.partial, encoding)))
+                with condition:
+                    following[0] -= 1
+                    last = not following[0]
+                    condition.notify_all()
+                if last:
+                    put((_END, None))
+                continue
+            followed.interval = min_interval if new_lines is not None else min(followed.interval * 2, max_interval)
+            with condition:
+                heapq.heappush(schedule, (now + followed.interval, next(sequence), followed))
+                condition.notify()
+
+    def followed_lines():
+        if not following[0]:
+            return
+        for _ in range(min(max_workers, following[0])):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                key, line = lines.get()
+                if key is _END:
+                    if line is not None:
+                        raise line
+                    return
+                yield key, line
+        finally:
+            stopped.set()
+
+    return followed_lines()
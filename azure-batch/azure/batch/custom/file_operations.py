@@ -0,0 +1,334 @@
+# coding=utf-8
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+#--------------------------------------------------------------------------
+
+import json
+import os
+import sys
+import threading
+import time
+
+from ..operations.file_operations import FileOperations
+from .. import models
+from .file_follower import _follow
+
+if sys.version_info < (3,):
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_DOWNLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+
+DEFAULT_FOLLOW_WORKERS = 8
+DEFAULT_MIN_POLL_INTERVAL = 1.0
+DEFAULT_MAX_POLL_INTERVAL = 30.0
+
+# the journal of a download records the version of the file being downloaded, then the blocks written
+_JOURNAL_SUFFIX = '.download'
+
+
+class CustomFileOperations(FileOperations):
+
+    def download_from_task(self, job_id, task_id, file_path, local_path, max_workers=DEFAULT_DOWNLOAD_WORKERS,
+                           block_size=DEFAULT_DOWNLOAD_BLOCK_SIZE, **operation_config):
+        """Downloads the specified task file to a local file, fetching byte ranges of the file concurrently.
+
+        The local file is allocated to the size of the task file, and the ranges are written at their offset
+        as they are received. The ranges which were written are recorded in a journal next to the local file,
+        local_path + '.download', so that an interrupted download is resumed by downloading the file again,
+        unless the task file changed in the meantime. The ranges are requested with If-Unmodified-Since, so
+        that a task file changing during the download fails the download instead of mixing two versions.
+
+        :param job_id: The ID of the job that contains the task.
+        :type job_id: str
+        :param task_id: The ID of the task whose file you want to download.
+        :type task_id: str
+        :param file_path: The path to the task file that you want to download.
+        :type file_path: str
+        :param local_path: The path of the local file.
+        :type local_path: str
+        :param max_workers: The maximum number of concurrent range requests.
+        :type max_workers: int
+        :param block_size: The number of bytes of each range request.
+        :type block_size: int
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: A dict with the size of the file, the number of bytes downloaded and the number of bytes
+         resumed from a previous download, and the elapsed time in seconds.
+        :rtype: dict
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        def get_properties():
+            return self.get_properties_from_task(job_id, task_id, file_path, raw=True, **operation_config)
+
+        def get_range(ocp_range, if_unmodified_since):
+            options = models.FileGetFromTaskOptions(
+                ocp_range=ocp_range, if_unmodified_since=if_unmodified_since)
+            return self.get_from_task(job_id, task_id, file_path, options, **operation_config)
+
+        return self._download(get_properties, get_range, local_path, max_workers, block_size)
+
+    def download_from_compute_node(self, pool_id, node_id, file_path, local_path,
+                                   max_workers=DEFAULT_DOWNLOAD_WORKERS, block_size=DEFAULT_DOWNLOAD_BLOCK_SIZE,
+                                   **operation_config):
+        """Downloads the specified compute node file to a local file, fetching byte ranges of the file
+        concurrently.
+
+        See :meth:`download_from_task`.
+
+        :param pool_id: The ID of the pool that contains the compute node.
+        :type pool_id: str
+        :param node_id: The ID of the compute node that contains the file.
+        :type node_id: str
+        :param file_path: The path to the compute node file that you want to download.
+        :type file_path: str
+        :param local_path: The path of the local file.
+        :type local_path: str
+        :param max_workers: The maximum number of concurrent range requests.
+        :type max_workers: int
+        :param block_size: The number of bytes of each range request.
+        :type block_size: int
+        :return: A dict with the size of the file, the number of bytes downloaded and the number of bytes
+         resumed from a previous download, and the elapsed time in seconds.
+        :rtype: dict
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        def get_properties():
+            return self.get_properties_from_compute_node(pool_id, node_id, file_path, raw=True, **operation_config)
+
+        def get_range(ocp_range, if_unmodified_since):
+            options = models.FileGetFromComputeNodeOptions(
+                ocp_range=ocp_range, if_unmodified_since=if_unmodified_since)
+            return self.get_from_compute_node(pool_id, node_id, file_path, options, **operation_config)
+
+        return self._download(get_properties, get_range, local_path, max_workers, block_size)
+
+    def follow_from_task(self, job_id, task_id, file_path, **kwargs):
+        """Follows the specified task file, e.g. the stdout.txt of a running task, yielding its lines as they are
+        appended to the file.
+
+        See :meth:`follow_from_tasks`, which follows the files of many tasks with the same requests.
+
+        :param job_id: The ID of the job that contains the task.
+        :type job_id: str
+        :param task_id: The ID of the task whose file you want to follow.
+        :type task_id: str
+        :param file_path: The path to the task file that you want to follow.
+        :type file_path: str
+        :return: An iterator over the lines of the file, without their line terminator.
+        :rtype: iterator of str
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        for _, line in self.follow_from_tasks([(job_id, task_id, file_path)], **kwargs):
+            yield line
+
+    def follow_from_tasks(self, files, min_poll_interval=DEFAULT_MIN_POLL_INTERVAL,
+                          max_poll_interval=DEFAULT_MAX_POLL_INTERVAL, idle_timeout=None,
+                          max_workers=DEFAULT_FOLLOW_WORKERS, encoding='utf-8', **operation_config):
+        """Follows the specified task files, yielding their lines as they are appended to the files.
+
+        Each poll of a file gets its properties, and only when the file grew, the range of the bytes appended
+        since the previous poll. A file is polled min_poll_interval seconds after it grew, and the interval is
+        doubled up to max_poll_interval each time it didn't grow, so that idle files cost few requests. The
+        polls of all the files are scheduled on a shared pool of max_workers threads. A file which doesn't exist
+        yet is polled until it does, and a file which shrinks is followed again from its start.
+
+        The lines of a file are yielded in order, while the lines of different files are interleaved as they
+        are received. The iterator never ends unless idle_timeout is set; closing it stops the polls.
+
+        :param files: The (job_id, task_id, file_path) tuples of the task files to follow.
+        :type files: iterable of tuple
+        :param min_poll_interval: The number of seconds between the polls of a file which is growing.
+        :type min_poll_interval: float
+        :param max_poll_interval: The maximum number of seconds between the polls of a file.
+        :type max_poll_interval: float
+        :param idle_timeout: The number of seconds after which a file which didn't grow is no longer
+         followed, and its last line is yielded even if it is incomplete. The iterator ends when no file is
+         followed anymore.
+        :type idle_timeout: float
+        :param max_workers: The maximum number of concurrent polls.
+        :type max_workers: int
+        :param encoding: The encoding of the files.
+        :type encoding: str
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: An iterator over the ((job_id, task_id, file_path), line) tuples of the lines of the files,
+         without their line terminator.
+        :rtype: iterator of tuple
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        def follow(job_id, task_id, file_path):
+            def get_properties():
+                return self.get_properties_from_task(job_id, task_id, file_path, raw=True, **operation_config)
+
+            def get_range(ocp_range):
+                options = models.FileGetFromTaskOptions(ocp_range=ocp_range)
+                return self.get_from_task(job_id, task_id, file_path, options, **operation_config)
+
+            return (job_id, task_id, file_path), get_properties, get_range
+
+        return _follow([follow(*file) for file in files], min_poll_interval, max_poll_interval, idle_timeout,
+                       max_workers, encoding)
+
+    def follow_from_compute_node(self, pool_id, node_id, file_path, **kwargs):
+        """Follows the specified compute node file, yielding its lines as they are appended to the file.
+
+        See :meth:`follow_from_compute_nodes`.
+
+        :param pool_id: The ID of the pool that contains the compute node.
+        :type pool_id: str
+        :param node_id: The ID of the compute node that contains the file.
+        :type node_id: str
+        :param file_path: The path to the compute node file that you want to follow.
+        :type file_path: str
+        :return: An iterator over the lines of the file, without their line terminator.
+        :rtype: iterator of str
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        for _, line in self.follow_from_compute_nodes([(pool_id, node_id, file_path)], **kwargs):
+            yield line
+
+    def follow_from_compute_nodes(self, files, min_poll_interval=DEFAULT_MIN_POLL_INTERVAL,
+                                  max_poll_interval=DEFAULT_MAX_POLL_INTERVAL, idle_timeout=None,
+                                  max_workers=DEFAULT_FOLLOW_WORKERS, encoding='utf-8', **operation_config):
+        """Follows the specified compute node files, yielding their lines as they are appended to the files.
+
+        See :meth:`follow_from_tasks`.
+
+        :param files: The (pool_id, node_id, file_path) tuples of the compute node files to follow.
+        :type files: iterable of tuple
+        :param min_poll_interval: The number of seconds between the polls of a file which is growing.
+        :type min_poll_interval: float
+        :param max_poll_interval: The maximum number of seconds between the polls of a file.
+        :type max_poll_interval: float
+        :param idle_timeout: The number of seconds after which a file which didn't grow is no longer
+         followed. The iterator ends when no file is followed anymore.
+        :type idle_timeout: float
+        :param max_workers: The maximum number of concurrent polls.
+        :type max_workers: int
+        :param encoding: The encoding of the files.
+        :type encoding: str
+        :return: An iterator over the ((pool_id, node_id, file_path), line) tuples of the lines of the files,
+         without their line terminator.
+        :rtype: iterator of tuple
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        def follow(pool_id, node_id, file_path):
+            def get_properties():
+                return self.get_properties_from_compute_node(
+                    pool_id, node_id, file_path, raw=True, **operation_config)
+
+            def get_range(ocp_range):
+                options = models.FileGetFromComputeNodeOptions(ocp_range=ocp_range)
+                return self.get_from_compute_node(pool_id, node_id, file_path, options, **operation_config)
+
+            return (pool_id, node_id, file_path), get_properties, get_range
+
+        return _follow([follow(*file) for file in files], min_poll_interval, max_poll_interval, idle_timeout,
+                       max_workers, encoding)
+
+    def _download(self, get_properties, get_range, local_path, max_workers, block_size):
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than 0')
+        if block_size < 1:
+            raise ValueError('block_size must be greater than 0')
+        start = time.time()
+        headers = get_properties().headers
+        if headers.get('ocp-batch-file-isdirectory'):
+            raise ValueError('The file to download is a directory')
+        size = headers['Content-Length']
+        last_modified = headers.get('Last-Modified')
+        version = {'size': size, 'etag': headers.get('ETag'), 'block_size': block_size,
+                   'last_modified': last_modified.isoformat() if last_modified else None}
+
+        journal_path = local_path + _JOURNAL_SUFFIX
+        done = _read_journal(journal_path, version) if os.path.exists(local_path) else None
+        if done is None:
+            done = set()
+            with open(local_path, 'wb') as local_file:
+                local_file.truncate(size)
+            with open(journal_path, 'w') as journal:
+                journal.write(json.dumps(version, sort_keys=True) + '\n')
+
+        blocks = Queue()
+        for index in range((size + block_size - 1) // block_size):
+            if index not in done:
+                blocks.put(index)
+        summary = {'size': size, 'downloaded': 0, 'resumed': sum(
+            min(block_size, size - index * block_size) for index in done), 'elapsed': None}
+        lock = threading.Lock()
+        errors = []
+
+        def download_block(local_file, journal, index):
+            offset = index * block_size
+            length = min(block_size, size - offset)
+            local_file.seek(offset)
+            written = 0
+            for chunk in get_range('bytes={}-{}'.format(offset, offset + length - 1), last_modified):
+                if written + len(chunk) > length:
+                    raise ValueError('The range {} of the file is longer than requested'.format(index))
+                local_file.write(chunk)
+                written += len(chunk)
+            if written != length:
+                raise ValueError('The range {} of the file is shorter than requested: {} of {} bytes'.format(
+                    index, written, length))
+            local_file.flush()
+            with lock:
+                journal.write('{}\n'.format(index))
+                journal.flush()
+                summary['downloaded'] += length
+
+        def work(journal):
+            with open(local_path, 'r+b') as local_file:
+                while not errors:
+                    try:
+                        index = blocks.get_nowait()
+                    except Empty:
+                        return
+                    try:
+                        download_block(local_file, journal, index)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        errors.append(ex)
+
+        with open(journal_path, 'a') as journal:
+            threads = []
+            for _ in range(min(max_workers, blocks.qsize())):
+                thread = threading.Thread(target=work, args=(journal,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+        if os.path.getsize(local_path) != size:
+            raise ValueError('The size of the downloaded file {} is not the size of the file, {}'.format(
+                os.path.getsize(local_path), size))
+        os.remove(journal_path)
+        summary['elapsed'] = time.time() - start
+        return summary
+
+
+def _read_journal(journal_path, version):
+    """Returns the indexes of the blocks written by a previous download of the same version of the file, or None
+    if the local file must be downloaded from scratch."""
+    try:
+        with open(journal_path) as journal:
+            lines = journal.read().split('\n')
+        if json.loads(lines[0]) != version:
+            return None
+        # the last line is empty, or the incomplete line of an interrupted write
+        return set(int(line) for line in lines[1:-1])
+    except (IOError, OSError, ValueError):
+        return None
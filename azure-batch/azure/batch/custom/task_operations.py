@@ -0,0 +1,286 @@
+# coding=utf-8
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+#--------------------------------------------------------------------------
+
+import json
+import sys
+import threading
+import time
+import uuid
+
+from ..operations.job_operations import JobOperations
+from ..operations.task_operations import TaskOperations
+from .. import models
+from .task_watcher import TaskStateWatcher
+
+if sys.version_info < (3,):
+    from Queue import Queue, Empty, Full
+else:
+    from queue import Queue, Empty, Full
+
+# the limits of a single add_collection request
+MAX_TASKS_PER_REQUEST = 100
+MAX_REQUEST_BODY_SIZE = 4 * 1024 * 1024
+
+DEFAULT_SUBMIT_WORKERS = 8
+
+DEFAULT_WATCH_POLL_INTERVAL = 5.0
+DEFAULT_WATCH_MAX_LIST_INTERVAL = 60.0
+
+# seconds before the first retry of the tasks which failed with a server error, doubled for each retry
+_RETRY_DELAY = 1.0
+
+_BODY_PREFIX = '{"value": ['
+_BODY_SUFFIX = ']}'
+_BODY_SEPARATOR = ', '
+
+
+class CustomTaskOperations(TaskOperations):
+
+    def bulk_add(self, job_id, tasks, max_workers=DEFAULT_SUBMIT_WORKERS, max_retries=3,
+                 task_add_collection_options=None, **operation_config):
+        """Adds any number of tasks to the specified job.
+
+        The tasks are grouped in add_collection requests of at most 100 tasks and 4MB, which are sent
+        concurrently. A request rejected with RequestBodyTooLarge is split in two, and the tasks which failed
+        with a server error are retried up to max_retries times, while the tasks which were added are not
+        submitted again. The tasks are read from the iterable as the requests are sent, so that it can be a
+        generator of a large number of tasks.
+
+        Each task must have a unique ID. When a request fails for another reason than the size of its body,
+        e.g. because the job doesn't exist, no further request is sent and the error is raised once the requests
+        being sent complete; the tasks added until then are not removed.
+
+        Each task is serialized once, when it is read, and its JSON is sent as is in the requests. The retries
+        back off exponentially from one second, up to 30 seconds, in the worker which sent the failed request:
+        while it waits, the other max_workers - 1 workers keep sending the next requests.
+
+        :param job_id: The ID of the job to which the tasks are to be added.
+        :type job_id: str
+        :param tasks: The tasks to add.
+        :type tasks: iterable of :class:`TaskAddParameter
+         <azure.batch.models.TaskAddParameter>`
+        :param max_workers: The maximum number of concurrent requests.
+        :type max_workers: int
+        :param max_retries: The maximum number of times a task failing with a server error is retried.
+        :type max_retries: int
+        :param task_add_collection_options: Additional parameters for the add_collection requests.
+        :type task_add_collection_options: :class:`TaskAddCollectionOptions
+         <azure.batch.models.TaskAddCollectionOptions>`
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: A dict with the number of tasks added, the :class:`TaskAddResult
+         <azure.batch.models.TaskAddResult>` of the tasks which failed to be added, the number of requests
+         sent, the elapsed time in seconds and the number of tasks added per second.
+        :rtype: dict
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than 0')
+        summary = {'added': 0, 'failed': [], 'requests': 0}
+        lock = threading.Lock()
+        chunks = Queue(max_workers)
+        stopped = threading.Event()
+        errors = []
+
+        def submit(chunk, retries=0):
+            with lock:
+                summary['requests'] += 1
+            try:
+                result = self._add_serialized_collection(
+                    job_id, [task_json for _, task_json in chunk], task_add_collection_options, **operation_config)
+            except models.BatchErrorException as ex:
+                if ex.error is None or ex.error.code != 'RequestBodyTooLarge':
+                    raise
+                if len(chunk) == 1:
+                    with lock:
+                        summary['failed'].append(models.TaskAddResult(
+                            models.TaskAddStatus.client_error, chunk[0][0], error=ex.error))
+                    return
+                half = len(chunk) // 2
+                submit(chunk[:half], retries)
+                submit(chunk[half:], retries)
+                return
+
+            retry_ids = set()
+            failed = []
+            added = 0
+            for task_result in result.value or []:
+                if task_result.status == models.TaskAddStatus.success:
+                    added += 1
+                elif task_result.status == models.TaskAddStatus.server_error and retries < max_retries:
+                    retry_ids.add(task_result.task_id)
+                else:
+                    failed.append(task_result)
+            with lock:
+                summary['added'] += added
+                summary['failed'].extend(failed)
+            if retry_ids:
+                # blocks this worker only, see the docstring
+                time.sleep(min(_RETRY_DELAY * 2 ** retries, 30))
+                submit([task for task in chunk if task[0] in retry_ids], retries + 1)
+
+        def work():
+            while True:
+                try:
+                    chunk = chunks.get(timeout=0.1)
+                except Empty:
+                    if stopped.is_set():
+                        return
+                    continue
+                if chunk is None:
+                    return
+                if errors:
+                    continue
+                try:
+                    submit(chunk)
+                except Exception as ex:  # pylint: disable=broad-except
+                    errors.append(ex)
+                    stopped.set()
+
+        threads = []
+        for _ in range(max_workers):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        start = time.time()
+        try:
+            for chunk in self._chunk_tasks(tasks):
+                if not self._put_chunk(chunks, chunk, stopped):
+                    break
+        finally:
+            for _ in threads:
+                self._put_chunk(chunks, None, stopped)
+            stopped.set()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+
+        summary['elapsed'] = time.time() - start
+        summary['tasks_per_second'] = summary['added'] / summary['elapsed'] if summary['elapsed'] else None
+        return summary
+
+    def watch(self, job_id, poll_interval=DEFAULT_WATCH_POLL_INTERVAL,
+              max_list_interval=DEFAULT_WATCH_MAX_LIST_INTERVAL, overlap=5.0, until_complete=True,
+              **operation_config):
+        """Watches the states of the tasks of the specified job.
+
+        Iterating the returned watcher yields a :class:`TaskStateChange
+        <azure.batch.custom.task_watcher.TaskStateChange>` for each task added to the job, whose state changed,
+        or which was deleted, while its states attribute is an index of the state of each task. The task counts
+        of the job detect the changes, and the tasks are listed only when the counts changed, with a filter on
+        their state transition time and a selection of their ID, state and state transition time, rather than
+        downloading every task on each poll.
+
+        :param job_id: The ID of the job.
+        :type job_id: str
+        :param poll_interval: The number of seconds between the polls of the task counts of the job.
+        :type poll_interval: float
+        :param max_list_interval: The maximum number of seconds between two listings of the tasks, in case
+         changes of states are not visible in the task counts.
+        :type max_list_interval: float
+        :param overlap: The number of seconds before the latest state transition seen from which the tasks are
+         listed again, to see the transitions which became visible late.
+        :type overlap: float
+        :param until_complete: Whether the iteration ends once all the tasks of the job are completed.
+        :type until_complete: bool
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: The watcher, which is iterated to poll the job.
+        :rtype: :class:`TaskStateWatcher<azure.batch.custom.task_watcher.TaskStateWatcher>`
+        :raises:
+         :class:`BatchErrorException<azure.batch.models.BatchErrorException>`
+        """
+        job_operations = JobOperations(self._client, self.config, self._serialize, self._deserialize)
+        return TaskStateWatcher(self, job_operations, job_id, poll_interval, max_list_interval, overlap,
+                                until_complete, operation_config)
+
+    def _chunk_tasks(self, tasks):
+        """Serializes the tasks and groups them in lists of (task ID, JSON) which fit in an add_collection
+        request, by count and size of the body."""
+        chunk = []
+        size = len(_BODY_PREFIX) + len(_BODY_SUFFIX)
+        for task in tasks:
+            task_json = json.dumps(self._serialize.body(task, 'TaskAddParameter')).encode('utf-8')
+            if chunk and (len(chunk) == MAX_TASKS_PER_REQUEST or
+                          size + len(_BODY_SEPARATOR) + len(task_json) >= MAX_REQUEST_BODY_SIZE):
+                yield chunk
+                chunk = []
+                size = len(_BODY_PREFIX) + len(_BODY_SUFFIX)
+            if chunk:
+                size += len(_BODY_SEPARATOR)
+            chunk.append((task.id, task_json))
+            size += len(task_json)
+        if chunk:
+            yield chunk
+
+    def _add_serialized_collection(self, job_id, task_jsons, task_add_collection_options=None, **operation_config):
+        """Sends the add_collection request of tasks already serialized to JSON by _chunk_tasks.
+
+        See :meth:`add_collection<azure.batch.operations.TaskOperations.add_collection>`, which would
+        serialize the tasks again.
+        """
+        timeout = None
+        client_request_id = None
+        return_client_request_id = None
+        ocp_date = None
+        if task_add_collection_options is not None:
+            timeout = task_add_collection_options.timeout
+            client_request_id = task_add_collection_options.client_request_id
+            return_client_request_id = task_add_collection_options.return_client_request_id
+            ocp_date = task_add_collection_options.ocp_date
+
+        # Construct URL
+        url = '/jobs/{jobId}/addtaskcollection'
+        path_format_arguments = {
+            'jobId': self._serialize.url("job_id", job_id, 'str')
+        }
+        url = self._client.format_url(url, **path_format_arguments)
+
+        # Construct parameters
+        query_parameters = {}
+        query_parameters['api-version'] = self._serialize.query("self.api_version", self.api_version, 'str')
+        if timeout is not None:
+            query_parameters['timeout'] = self._serialize.query("timeout", timeout, 'int')
+
+        # Construct headers
+        header_parameters = {}
+        header_parameters['Content-Type'] = 'application/json; odata=minimalmetadata; charset=utf-8'
+        if self.config.generate_client_request_id:
+            header_parameters['client-request-id'] = str(uuid.uuid1())
+        if self.config.accept_language is not None:
+            header_parameters['accept-language'] = self._serialize.header("self.config.accept_language", self.config.accept_language, 'str')
+        if client_request_id is not None:
+            header_parameters['client-request-id'] = self._serialize.header("client_request_id", client_request_id, 'str')
+        if return_client_request_id is not None:
+            header_parameters['return-client-request-id'] = self._serialize.header("return_client_request_id", return_client_request_id, 'bool')
+        if ocp_date is not None:
+            header_parameters['ocp-date'] = self._serialize.header("ocp_date", ocp_date, 'rfc-1123')
+
+        # Construct the body from the serialized tasks, and send request
+        request = self._client.post(url, query_parameters)
+        request.data = (_BODY_PREFIX.encode('utf-8') + _BODY_SEPARATOR.encode('utf-8').join(task_jsons) +
+                        _BODY_SUFFIX.encode('utf-8'))
+        response = self._client.send(request, header_parameters, None, **operation_config)
+
+        if response.status_code not in [200]:
+            raise models.BatchErrorException(self._deserialize, response)
+
+        return self._deserialize('TaskAddCollectionResult', response)
+
+    @staticmethod
+    def _put_chunk(chunks, chunk, stopped):
+        while not stopped.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
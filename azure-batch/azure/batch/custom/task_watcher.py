@@ -0,0 +1,140 @@
+# coding=utf-8
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for
+# license information.
+#--------------------------------------------------------------------------
+
+import collections
+import datetime
+import time
+
+from msrest import Serializer
+
+from .. import models
+
+# the properties of the tasks which are listed
+_TASK_SELECT = 'id,state,stateTransitionTime'
+
+TaskStateChange = collections.namedtuple(
+    'TaskStateChange', ['task_id', 'previous_state', 'state', 'state_transition_time'])
+TaskStateChange.__doc__ = """A change of the state of a task.
+
+previous_state is None for a task seen for the first time, and state is None for a task which was deleted.
+"""
+
+
+class TaskStateWatcher(object):
+    """Watches the states of the tasks of a job, yielding a :class:`TaskStateChange` for each task whose state
+    changed. Created by :meth:`task.watch
+    <azure.batch.custom.task_operations.CustomTaskOperations.watch>`.
+
+    The task counts of the job are polled every poll_interval seconds, and the tasks are listed only when the
+    counts changed or max_list_interval seconds passed since they were last listed. The first listing gets all the
+    tasks of the job; the next ones only get the tasks whose state changed since the latest state transition
+    seen, minus overlap seconds to allow for transitions which became visible late. All listings select only
+    the ID, state and state transition time of the tasks, and the watcher only keeps the state of each task,
+    so that its memory is proportional to the number of tasks rather than to their size. When the counts show
+    fewer tasks than the watcher knows of, all the tasks are listed again to find the deleted ones.
+
+    A task changing state several times between two listings yields a single change, from the state
+    previously seen to the current one.
+
+    :ivar states: The state of each task of the job, by task ID.
+    :vartype states: dict
+    :ivar counts: The latest task counts of the job.
+    :vartype counts: :class:`TaskCounts<azure.batch.models.TaskCounts>`
+    :ivar stats: The numbers of task counts requests, of task listings, and of tasks listed.
+    :vartype stats: dict
+    """
+
+    def __init__(self, task_operations, job_operations, job_id, poll_interval, max_list_interval, overlap,
+                 until_complete, operation_config):
+        self._task_operations = task_operations
+        self._job_operations = job_operations
+        self._job_id = job_id
+        self._poll_interval = poll_interval
+        self._max_list_interval = max_list_interval
+        self._overlap = datetime.timedelta(seconds=overlap)
+        self._until_complete = until_complete
+        self._operation_config = operation_config
+        self._watermark = None
+        self._last_list = None
+        self._pending = 0
+        self.states = {}
+        self.counts = None
+        self.stats = {'counts_requests': 0, 'listings': 0, 'tasks_listed': 0}
+
+    @property
+    def complete(self):
+        """Whether the job has tasks, and they are all completed."""
+        return (bool(self.states) and not self._pending and self.counts is not None and
+                not self.counts.active and not self.counts.running)
+
+    def __iter__(self):
+        while True:
+            start = time.time()
+            previous_counts = self.counts
+            self.counts = self._job_operations.get_task_counts(self._job_id, **self._operation_config)
+            self.stats['counts_requests'] += 1
+            total = self.counts.active + self.counts.running + self.counts.completed
+            if self._last_list is None or total < len(self.states):
+                for change in self._list(full=True):
+                    yield change
+            elif (_counts_key(self.counts) != _counts_key(previous_counts) or
+                  start - self._last_list >= self._max_list_interval or
+                  (self.counts.completed == total and self._pending)):
+                for change in self._list(full=False):
+                    yield change
+            if self._until_complete and self.complete:
+                return
+            time.sleep(max(0, self._poll_interval - (time.time() - start)))
+
+    def _list(self, full):
+        self._last_list = time.time()
+        self.stats['listings'] += 1
+        if full or self._watermark is None:
+            task_filter = None
+        else:
+            task_filter = "stateTransitionTime ge datetime'{}'".format(
+                Serializer.serialize_iso(self._watermark - self._overlap))
+        options = models.TaskListOptions(filter=task_filter, select=_TASK_SELECT)
+        previous_watermark = self._watermark
+        seen = set() if full else None
+        for task in self._task_operations.list(self._job_id, options, **self._operation_config):
+            self.stats['tasks_listed'] += 1
+            if seen is not None:
+                seen.add(task.id)
+            transition_time = task.state_transition_time
+            if transition_time is not None and (self._watermark is None or transition_time > self._watermark):
+                self._watermark = transition_time
+            previous_state = self.states.get(task.id)
+            # a task listed again in the overlap keeps its state, unless it transitioned since the last listing
+            if previous_state == task.state and (
+                    transition_time is None or previous_watermark is None or transition_time <= previous_watermark):
+                continue
+            self._set_state(task.id, task.state)
+            yield TaskStateChange(task.id, previous_state, task.state, transition_time)
+
+        if seen is not None:
+            for task_id in [task_id for task_id in self.states if task_id not in seen]:
+                previous_state = self.states[task_id]
+                self._set_state(task_id, None)
+                yield TaskStateChange(task_id, previous_state, None, None)
+
+    def _set_state(self, task_id, state):
+        previous_state = self.states.get(task_id)
+        if task_id in self.states and previous_state != models.TaskState.completed:
+            self._pending -= 1
+        if state is None:
+            del self.states[task_id]
+            return
+        self.states[task_id] = state
+        if state != models.TaskState.completed:
+            self._pending += 1
+
+
+def _counts_key(counts):
+    if counts is None:
+        return None
+    return counts.active, counts.running, counts.completed, counts.succeeded, counts.failed
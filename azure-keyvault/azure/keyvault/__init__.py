@@ -12,6 +12,8 @@
 from .custom import http_bearer_challenge_cache as HttpBearerChallengeCache
 from .custom.http_bearer_challenge import HttpBearerChallenge
 from .custom.key_vault_client import CustomKeyVaultClient as KeyVaultClient
+from .custom.key_vault_cache import KeyVaultCache
+from .custom.key_vault_concurrency import AdaptiveConcurrencyLimiter
 from .custom.key_vault_id import (KeyVaultId,
                                   KeyId,
                                   SecretId,
@@ -24,6 +26,8 @@ from .custom.key_vault_authentication import KeyVaultAuthentication, KeyVaultAut
 from .version import VERSION
 
 __all__ = ['KeyVaultClient',
+           'KeyVaultCache',
+           'AdaptiveConcurrencyLimiter',
            'KeyVaultId',
            'KeyId',
            'SecretId',
@@ -52,6 +52,11 @@ class HttpBearerChallenge(object):
     def get_value(self, key):
         return self._parameters.get(key)
 
+    def get_parameters(self):
+        """ Returns a copy of the name=value pairs of the challenge.
+        rtype: dict """
+        return dict(self._parameters)
+
     def get_authorization_server(self):
         """ Returns the URI for the authorization server if present, otherwise empty string. """
         value = ''
@@ -3,6 +3,10 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 #---------------------------------------------------------------------------------------------
 
+import json
+import logging
+import os
+from collections import OrderedDict
 from threading import Lock
 
 try:
@@ -10,8 +14,22 @@ try:
 except ImportError:
     import urlparse as parse # pylint: disable=import-error
 
-_cache = {}
+from ..http_bearer_challenge import HttpBearerChallenge
+
+_LOGGER = logging.getLogger(__name__)
+
+# the cache is copy-on-write: readers use the current dict without locking, writers replace it under _lock
+_cache = OrderedDict()
 _lock = Lock()
+_max_size = 1024
+_persistence_path = None
+# the file is written outside of _lock, under _save_lock, and only with a newer version of the cache than saved
+_save_lock = Lock()
+_version = 0
+_saved_version = 0
+# counters are updated without locking on the read path, and may undercount under contention
+_counters = {'hits': 0, 'misses': 0, 'updates': 0, 'challenges': 0, 'evictions': 0}
+
 
 def get_challenge_for_url(url):
     """ Gets the challenge for the cached URL.
@@ -20,34 +38,31 @@ def get_challenge_for_url(url):
     if not url:
         raise ValueError('URL cannot be None')
 
-    url = parse.urlparse(url)
+    val = _cache.get(parse.urlsplit(url).netloc)
 
-    _lock.acquire()
-
-    val = _cache.get(url.netloc)
-
-    _lock.release()
+    _counters['hits' if val is not None else 'misses'] += 1
 
     return val
 
 
 def remove_challenge_for_url(url):
-    """ Removes the cached challenge for the specified URL.
+    """ Removes the cached challenge for the specified URL, if any.
     :param url: the URL for which to remove the cached challenge """
     if not url:
         raise ValueError('URL cannot be empty')
 
-    url = parse.urlparse(url)
-
-    _lock.acquire()
+    netloc = parse.urlsplit(url).netloc
 
-    del _cache[url.netloc]
-
-    _lock.release()
+    snapshot = None
+    with _lock:
+        if netloc in _cache:
+            snapshot = _replace(OrderedDict((key, value) for key, value in _cache.items() if key != netloc))
+    _persist(snapshot)
 
 
 def set_challenge_for_url(url, challenge):
-    """ Caches the challenge for the specified URL.
+    """ Caches the challenge for the specified URL. The challenges cached first are evicted
+    once the cache holds more than its maximum size.
     :param url: the URL for which to cache the challenge
     :param challenge: the challenge to cache """
     if not url:
@@ -56,22 +71,127 @@ def set_challenge_for_url(url, challenge):
     if not challenge:
         raise ValueError('Challenge cannot be empty')
 
-    src_url = parse.urlparse(url)
+    src_url = parse.urlsplit(url)
     if src_url.netloc != challenge.source_authority:
         raise ValueError('Source URL and Challenge URL do not match')
 
-    _lock.acquire()
-
-    _cache[src_url.netloc] = challenge
-
-    _lock.release()
+    with _lock:
+        _counters['updates'] += 1
+        cache = OrderedDict(_cache)
+        cache.pop(src_url.netloc, None)
+        cache[src_url.netloc] = challenge
+        while len(cache) > _max_size:
+            cache.popitem(last=False)
+            _counters['evictions'] += 1
+        snapshot = _replace(cache)
+    _persist(snapshot)
 
 
 def clear():
     """ Clears the cache. """
-
-    _lock.acquire()
-
-    _cache.clear() # pylint: disable=redefined-outer-name,unused-variable
-
-    _lock.release()
+    with _lock:
+        snapshot = _replace(OrderedDict())
+    _persist(snapshot)
+
+
+def set_max_size(max_size):
+    """ Sets the maximum number of cached challenges.
+    :param max_size: the maximum number of cached challenges """
+    global _max_size  # pylint: disable=global-statement
+    if max_size < 1:
+        raise ValueError('max_size must be greater than 0')
+
+    snapshot = None
+    with _lock:
+        _max_size = max_size
+        if len(_cache) > max_size:
+            items = list(_cache.items())
+            _counters['evictions'] += len(items) - max_size
+            snapshot = _replace(OrderedDict(items[-max_size:]))
+    _persist(snapshot)
+
+
+def enable_persistence(path):
+    """ Loads the challenges saved in the specified file, and saves the cache to the file whenever
+    it changes, so that new processes don't need a 401 challenge round trip for known vaults.
+    :param path: the path of the file, or None to disable persistence """
+    global _persistence_path  # pylint: disable=global-statement
+
+    with _lock:
+        _persistence_path = path
+        if not path or not os.path.exists(path):
+            return
+        cache = OrderedDict(_cache)
+        for challenge in _load(path):
+            cache.pop(challenge.source_authority, None)
+            cache[challenge.source_authority] = challenge
+        while len(cache) > _max_size:
+            cache.popitem(last=False)
+        snapshot = _replace(cache)
+    _persist(snapshot)
+
+
+def get_metrics():
+    """ Returns the counters of the cache: hits and misses of get_challenge_for_url, updates by
+    set_challenge_for_url, challenges answered by retrying a request after its 401 response,
+    evictions, and the number of cached challenges.
+    :rtype: dict """
+    metrics = dict(_counters)
+    metrics['size'] = len(_cache)
+    return metrics
+
+
+def _count_challenge():
+    # called by KeyVaultAuthBase.handle_401 for each 401 round trip
+    with _lock:
+        _counters['challenges'] += 1
+
+
+def _replace(cache):
+    # must be called with _lock held, returns the snapshot to pass to _persist once _lock is released
+    global _cache, _version  # pylint: disable=global-statement
+    _cache = cache
+    _version += 1
+    return (_persistence_path, _version, cache) if _persistence_path else None
+
+
+def _persist(snapshot):
+    global _saved_version  # pylint: disable=global-statement
+    if snapshot is None:
+        return
+    path, version, cache = snapshot
+    with _save_lock:
+        # a newer version may have been saved while this one waited
+        if version > _saved_version:
+            _save(path, cache)
+            _saved_version = version
+
+
+def _load(path):
+    try:
+        with open(path) as challenge_file:
+            entries = json.load(challenge_file)
+        return [HttpBearerChallenge(entry['source_uri'], entry['challenge']) for entry in entries]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        _LOGGER.warning('Ignoring invalid challenge cache file %s', path, exc_info=True)
+        return []
+
+
+def _save(path, cache):
+    entries = [{
+        'source_uri': challenge.source_uri,
+        'challenge': 'Bearer ' + ', '.join('{}="{}"'.format(key, value)
+                                           for key, value in sorted(challenge.get_parameters().items()))
+    } for challenge in cache.values()]
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as challenge_file:
+            json.dump(entries, challenge_file)
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, path)
+        else:
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+    except (IOError, OSError):
+        _LOGGER.warning('Failed to save the challenge cache to %s', path, exc_info=True)
@@ -3,13 +3,147 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 #---------------------------------------------------------------------------------------------
 
+import base64
+import json
+import logging
 import threading
+import time
 import requests
+
+try:
+    import urllib.parse as parse
+except ImportError:
+    import urlparse as parse # pylint: disable=import-error
+
 from requests.auth import AuthBase
 from requests.cookies import extract_cookies_to_jar
 from azure.keyvault import HttpBearerChallenge
 from azure.keyvault import HttpBearerChallengeCache as ChallengeCache
 from msrest.authentication import OAuthTokenAuthentication
+from msrest.exceptions import ClientRequestError
+
+_LOGGER = logging.getLogger(__name__)
+
+# tokens are refreshed in the background once they expire within this many seconds
+DEFAULT_TOKEN_REFRESH_MARGIN = 300
+# and are not used anymore once they expire within this many seconds
+_TOKEN_EXPIRY_SKEW = 30
+# the resource of the key vault data plane in the public cloud
+DEFAULT_KEY_VAULT_RESOURCE = 'https://vault.azure.net'
+# requests with larger or streamed bodies get the challenge with a request without body first
+_PROBE_BODY_SIZE = 16 * 1024
+_PROBE_TIMEOUT = 30
+
+
+def _get_token_expiry(access_token):
+    """Returns the expiry time of a JWT access token, or None if it can't be read from the token."""
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _get_access_token(request):
+    """Returns the access token the request was authorized with, or None."""
+    authorization = request.headers.get('Authorization')
+    return authorization.split(' ', 1)[-1] if authorization else None
+
+
+class _AccessTokenCache(object):
+    """
+    Caches the tokens returned by an authorization callback per (authority, resource, scope) until they expire.
+    A token close to expiry is still returned while a new one is acquired in a background thread, and
+    concurrent acquisitions of the same token are collapsed into a single call to the callback. Tokens
+    whose expiry can't be read are not cached.
+    """
+
+    def __init__(self, callback, refresh_margin=DEFAULT_TOKEN_REFRESH_MARGIN):
+        self._callback = callback
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.acquisitions = 0
+        self.background_refreshes = 0
+        self._tokens = {}
+        self._locks = {}
+        self._refreshing = set()
+        self._rejected = {}
+        self._lock = threading.Lock()
+
+    def get(self, authority, resource, scope):
+        """
+        Gets the (token type, access token) tuple for the specified challenge parameters.
+        """
+        key = (authority, resource, scope)
+        now = time.time()
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and now < cached[1] - _TOKEN_EXPIRY_SKEW:
+                self.hits += 1
+                if now >= cached[1] - self.refresh_margin and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    thread = threading.Thread(target=self._refresh, args=(key,))
+                    thread.daemon = True
+                    thread.start()
+                return cached[0]
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            # another thread may have acquired the token while this one was waiting
+            with self._lock:
+                cached = self._tokens.get(key)
+                if cached is not None and time.time() < cached[1] - _TOKEN_EXPIRY_SKEW:
+                    return cached[0]
+            return self._acquire(key)
+
+    def invalidate(self, authority, resource, scope, access_token):
+        """
+        Drops the token for the specified challenge parameters if it is access_token, which was rejected by the
+        vault, e.g. because it was revoked, so that the next get acquires a new token.
+        """
+        key = (authority, resource, scope)
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and cached[0][1] == access_token:
+                del self._tokens[key]
+            self._rejected[key] = access_token
+
+    def is_rejected(self, authority, resource, scope, access_token):
+        """
+        Whether access_token is the latest token rejected for the specified challenge parameters.
+        """
+        with self._lock:
+            return self._rejected.get((authority, resource, scope)) == access_token
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+            self._rejected.clear()
+
+    def _acquire(self, key):
+        token = self._callback(*key)
+        expiry = _get_token_expiry(token[1])
+        with self._lock:
+            self.acquisitions += 1
+            if expiry is not None:
+                self._tokens[key] = (token, expiry)
+            else:
+                self._tokens.pop(key, None)
+        return token
+
+    def _refresh(self, key):
+        try:
+            with self._locks[key]:
+                self._acquire(key)
+            with self._lock:
+                self.background_refreshes += 1
+        except Exception:
+            # the current token is used until it expires, then acquired synchronously
+            _LOGGER.warning('Failed to refresh the access token for %s', key, exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
 
 
 class KeyVaultAuthBase(AuthBase):
@@ -17,7 +151,8 @@ class KeyVaultAuthBase(AuthBase):
     Used for handling authentication challenges, by hooking into the request AuthBase extension model.
     """
 
-    def __init__(self, authorization_callback):
+    def __init__(self, authorization_callback, refresh_margin=DEFAULT_TOKEN_REFRESH_MARGIN, authority=None,
+                 resource=DEFAULT_KEY_VAULT_RESOURCE, scope=None):
         """
         Creates a new KeyVaultAuthBase instance used for handling authentication challenges, by hooking into the request AuthBase
         extension model.
@@ -25,8 +160,27 @@ class KeyVaultAuthBase(AuthBase):
         This callback should take three str arguments: authorization uri, resource, and scope, and return 
         a tuple of (token type, access token).
                     return token['token_type'], token['access_token']
+        The returned JWT access tokens are cached per authorization uri, resource and scope until they expire or
+        are rejected by a vault.
+        :param refresh_margin: The number of seconds before the expiry of a cached token at which a new token is
+        acquired in the background.
+        :param authority: Optional. The authorization server of the vaults, e.g.
+        https://login.windows.net/<tenant id>. When specified, the first request to a vault is authenticated with
+        a challenge built from authority, resource and scope instead of waiting for the 401 challenge of the vault.
+        A vault responding with a different challenge replaces it.
+        :param resource: The resource of the pre-seeded challenge.
+        :param scope: Optional. The scope of the pre-seeded challenge.
         """
         self._callback = authorization_callback
+        self._tokens = _AccessTokenCache(authorization_callback, refresh_margin) if authorization_callback else None
+        self._seed_challenge = None
+        if authority:
+            self._seed_challenge = 'Bearer authorization="{}", resource="{}"'.format(authority, resource)
+            if scope:
+                self._seed_challenge += ', scope="{}"'.format(scope)
+        # set by KeyVaultClient to send the challenge probes through its pipeline, with its configuration
+        self._send_probe = None
+        self._probe_session = None
         self._token = None
         self._thread_local = threading.local()
         self._thread_local.pos = None
@@ -39,26 +193,77 @@ class KeyVaultAuthBase(AuthBase):
         :return: returns the original request, registering hooks on the response if it is the first time this url has been called and an 
         auth challenge might be returned  
         """
-        # attempt to pre-fetch challenge if cached
-        if self._callback:
-            challenge = ChallengeCache.get_challenge_for_url(request.url)
+        # attempt to pre-fetch challenge if cached, the challenge probes are sent without authentication
+        if self._callback and not getattr(self._thread_local, 'probing', False):
+            challenge = ChallengeCache.get_challenge_for_url(request.url) or self._get_initial_challenge(request)
             if challenge:
                 # if challenge cached, use the authorization_callback to retrieve token and update the request
                 self.set_authorization_header(request, challenge)
-            else:
-                # if the challenge is not cached we will let the request proceed without the auth header so we
-                # get back the proper challenge in response. We register a callback to handle the response 401 response.
-                try:
-                    self._thread_local.pos = request.body.tell()
-                except AttributeError:
-                    self._thread_local.pos = None
 
-                self._thread_local.auth_attempted = False
-                request.register_hook('response', self.handle_401)
-                request.register_hook('response', self.handle_redirect)
+            # if the challenge is not cached we will let the request proceed without the auth header so we
+            # get back the proper challenge in response. We register a callback to handle the response 401 response,
+            # which also replaces a cached challenge which is not valid anymore, e.g. loaded from a persisted cache.
+            try:
+                self._thread_local.pos = request.body.tell()
+            except AttributeError:
+                self._thread_local.pos = None
+
+            self._thread_local.auth_attempted = False
+            request.register_hook('response', self.handle_401)
+            request.register_hook('response', self.handle_redirect)
 
         return request
 
+    def discover_challenge(self, url):
+        """
+        Gets the challenge of the vault of the specified url with an unauthenticated request without body, and caches it.
+        The request is sent through the pipeline of the KeyVaultClient using these credentials, so that it has the
+        proxies, certificate verification and user agent of the client.
+        :param url: A url of the vault.
+        :return: The challenge of the vault, or None if the vault didn't respond with a bearer challenge.
+        :rtype: HttpBearerChallenge
+        """
+        url = parse.urlsplit(url)
+        probe_url = parse.urlunsplit((url.scheme, url.netloc, '/keys', url.query, ''))
+        self._thread_local.probing = True
+        try:
+            if self._send_probe is not None:
+                response = self._send_probe(probe_url)
+            else:
+                # not used by a client
+                if self._probe_session is None:
+                    self._probe_session = requests.Session()
+                response = self._probe_session.get(probe_url, timeout=_PROBE_TIMEOUT, allow_redirects=False)
+        finally:
+            self._thread_local.probing = False
+        response.close()
+
+        auth_header = response.headers.get('www-authenticate', '')
+        if response.status_code != 401 or not HttpBearerChallenge.is_bearer_challenge(auth_header):
+            return None
+        challenge = HttpBearerChallenge(probe_url, auth_header)
+        ChallengeCache.set_challenge_for_url(probe_url, challenge)
+        return challenge
+
+    def _get_initial_challenge(self, request):
+        """
+        Gets the challenge of the first request to a vault: the pre-seeded challenge if there is one, otherwise the
+        challenge discovered without sending a large or streamed body, which would be sent twice, or None to get the
+        challenge from the 401 response of the request itself.
+        """
+        if self._seed_challenge:
+            challenge = HttpBearerChallenge(request.url, self._seed_challenge)
+            ChallengeCache.set_challenge_for_url(request.url, challenge)
+            return challenge
+
+        body = request.body
+        if body is not None and (not hasattr(body, '__len__') or len(body) > _PROBE_BODY_SIZE):
+            try:
+                return self.discover_challenge(request.url)
+            except (requests.RequestException, ClientRequestError):
+                _LOGGER.warning('Failed to discover the challenge of %s', request.url, exc_info=True)
+        return None
+
     def handle_redirect(self, r, **kwargs):
         """Reset auth_attempted on redirects."""
         if r.is_redirect:
@@ -98,13 +303,23 @@ class KeyVaultAuthBase(AuthBase):
         # add the challenge to the cache
         challenge = HttpBearerChallenge(response.request.url, auth_header)
         ChallengeCache.set_challenge_for_url(response.request.url, challenge)
+        ChallengeCache._count_challenge()  # pylint: disable=protected-access
+
+        # a token rejected by the vault is not reused for the retry
+        rejected_token = _get_access_token(response.request)
+        if rejected_token:
+            self._tokens.invalidate(
+                challenge.get_authorization_server(),
+                challenge.get_resource(),
+                challenge.get_scope(),
+                rejected_token)
 
         # Consume content and release the original connection
         # to allow our new request to reuse the same one.
         response.content
         response.close()
 
-        # copy the request to resend
+        # copy the request to resend, the copy shares the already serialized body
         prep = response.request.copy()
         extract_cookies_to_jar(prep._cookies, response.request, response.raw)
         prep.prepare_cookies(prep._cookies)
@@ -119,7 +334,7 @@ class KeyVaultAuthBase(AuthBase):
         return _response
 
     def set_authorization_header(self, request, challenge):
-        auth = self._callback(
+        auth = self._tokens.get(
             challenge.get_authorization_server(),
             challenge.get_resource(),
             challenge.get_scope())
@@ -145,7 +360,8 @@ class KeyVaultAuthentication(OAuthTokenAuthentication):
             self.keyvault_data_client = KeyVaultClient(KeyVaultAuthentication(auth_callack))
     """
 
-    def __init__(self, authorization_callback=None, credentials=None):
+    def __init__(self, authorization_callback=None, credentials=None, refresh_margin=DEFAULT_TOKEN_REFRESH_MARGIN,
+                 authority=None, resource=DEFAULT_KEY_VAULT_RESOURCE, scope=None):
         """
         Creates a new KeyVaultAuthentication instance used for authentication in the KeyVaultClient
         :param authorization_callback: A callback used to provide authentication credentials to the key vault data service.  
@@ -154,6 +370,12 @@ class KeyVaultAuthentication(OAuthTokenAuthentication):
         :param credentials:: Credentials needed for the client to connect to Azure.
         :type credentials: :mod:`A msrestazure Credentials
          object<msrestazure.azure_active_directory>`
+        :param refresh_margin: The number of seconds before the expiry of a cached token at which a new token is
+        acquired in the background.
+        :param authority: Optional. The authorization server of the vaults, used to authenticate the first request
+        to a vault without a 401 challenge round trip. See :class:`KeyVaultAuthBase`.
+        :param resource: The resource of the pre-seeded challenge.
+        :param scope: Optional. The scope of the pre-seeded challenge.
         """
         if not authorization_callback and not credentials:
             raise ValueError("Either parameter 'authorization_callback' or parameter 'credentials' must be specified.")
@@ -163,29 +385,48 @@ class KeyVaultAuthentication(OAuthTokenAuthentication):
         self._credentials = credentials
 
         if not authorization_callback:
+            credentials_lock = threading.Lock()
+
             def auth_callback(server, resource, scope):
-                if self._credentials.resource != resource:
-                    self._credentials.resource = resource
-                    self._credentials.set_token()
-                token = self._credentials.token
+                # the credentials hold a single token, switch their resource under a lock. The returned tokens are
+                # cached per resource so the token is only set again when switching resources, close to expiry, or
+                # when the vault rejected it.
+                with credentials_lock:
+                    access_token = (self._credentials.token or {}).get('access_token')
+                    expiry = _get_token_expiry(access_token)
+                    if self._credentials.resource != resource or \
+                            (expiry is not None and expiry - refresh_margin <= time.time()) or \
+                            self.auth._tokens.is_rejected(server, resource, scope, access_token):
+                        self._credentials.resource = resource
+                        self._credentials.set_token()
+                    token = self._credentials.token
                 return token['token_type'], token['access_token']
 
             authorization_callback = auth_callback
 
-        self.auth = KeyVaultAuthBase(authorization_callback)
+        self.auth = KeyVaultAuthBase(authorization_callback, refresh_margin, authority, resource, scope)
         self._callback = authorization_callback
         
-    def signed_session(self):
-        session = requests.Session()
+    def signed_session(self, session=None):
+        """Create requests session with the key vault authentication, or add it to
+        the specified session so that its connections are reused.
+
+        :param session: The session to configure for authentication
+        :type session: requests.Session
+        :rtype: requests.Session
+        """
+        session = session or requests.Session()
         session.auth = self.auth
         return session
 
-    def refresh_session(self):
+    def refresh_session(self, session=None):
         """Return updated session if token has expired, attempts to
         refresh using refresh token.
 
+        :param session: The session to configure for authentication
+        :type session: requests.Session
         :rtype: requests.Session.
         """
         if self._credentials:
             self._credentials.refresh_session()
-        return self.signed_session()
+        return self.signed_session(session)
@@ -0,0 +1,104 @@
+#---------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+#---------------------------------------------------------------------------------------------
+
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# The archive written by KeyVaultClient.backup_vault starts with _ARCHIVE_MAGIC, followed by one record per backed
+# up object: a json header line, e.g. {"collection": "keys", "name": "mykey", "size": 2048}, followed by the size bytes
+# of the zlib compressed backup blob returned by the service. Records are appended as the backups complete, so the
+# complete records of an interrupted backup are valid, and the index of the archive is read from the record headers.
+_ARCHIVE_MAGIC = b'AZURE-KEYVAULT-BACKUP 1\n'
+
+
+class _RateLimiter(object):
+    """Spaces out the requests made by concurrent threads to at most rate requests per second."""
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0')
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _open_archive(path):
+    """Opens the archive for appending records, creating it if it doesn't exist. The records following the
+    last complete record of an interrupted backup are truncated.
+
+    :return: The archive file, positioned at its end, and the index of its records.
+    """
+    if not os.path.exists(path):
+        archive = open(path, 'w+b')
+        archive.write(_ARCHIVE_MAGIC)
+        archive.flush()
+        return archive, OrderedDict()
+
+    archive = open(path, 'r+b')
+    try:
+        index, end = _read_index(archive)
+        archive.seek(end)
+        archive.truncate()
+    except Exception:
+        archive.close()
+        raise
+    return archive, index
+
+
+def _read_index(archive):
+    """Reads the record headers of the archive.
+
+    :return: An OrderedDict mapping the (collection, name) of the records to the (offset, size) of their
+     compressed blob, and the offset following the last complete record.
+    """
+    archive.seek(0)
+    if archive.read(len(_ARCHIVE_MAGIC)) != _ARCHIVE_MAGIC:
+        raise ValueError('{} is not a key vault backup archive'.format(getattr(archive, 'name', archive)))
+    archive_size = os.fstat(archive.fileno()).st_size
+    index = OrderedDict()
+    end = archive.tell()
+    while True:
+        line = archive.readline()
+        if not line.endswith(b'\n'):
+            break
+        try:
+            header = json.loads(line.decode('utf-8'))
+            key = (header['collection'], header['name'])
+            size = int(header['size'])
+        except (ValueError, KeyError, TypeError):
+            # the header of a record which was being written when the backup was interrupted
+            break
+        offset = archive.tell()
+        if offset + size > archive_size:
+            break
+        index[key] = (offset, size)
+        end = offset + size
+        archive.seek(end)
+    return index, end
+
+
+def _write_record(archive, collection, name, blob):
+    data = zlib.compress(blob)
+    header = json.dumps({'collection': collection, 'name': name, 'size': len(data)}, sort_keys=True)
+    archive.write(header.encode('utf-8') + b'\n')
+    archive.write(data)
+    archive.flush()
+
+
+def _read_record(archive, offset, size):
+    archive.seek(offset)
+    return zlib.decompress(archive.read(size))
@@ -0,0 +1,261 @@
+#---------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+#---------------------------------------------------------------------------------------------
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from ..models import KeyVaultErrorException
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _is_not_found(error):
+    return getattr(error.response, 'status_code', None) == 404
+
+
+def _cache_key(collection, vault_base_url, name, version):
+    # vault urls, object names and versions are case insensitive
+    return (collection, vault_base_url.rstrip('/').lower(), name.lower(), (version or '').lower())
+
+
+class _CacheEntry(object):
+
+    def __init__(self, value, error, expires):
+        self.value = value
+        self.error = error
+        self.expires = expires
+        self.refreshing = False
+
+    def result(self):
+        if self.error is not None:
+            raise _copy_error(self.error)
+        return self.value
+
+
+def _copy_error(error):
+    """Returns a copy of a cached error, so that each caller raises its own exception and traceback."""
+    copy = error.__class__.__new__(error.__class__)
+    copy.__dict__.update(error.__dict__)
+    copy.args = error.args
+    return copy
+
+
+class _FetchLock(object):
+    """The lock of the fetches of a key, with the number of threads holding or waiting for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = 0
+
+
+class KeyVaultCache(object):
+    """Thread safe client side cache of the secrets, keys and certificates read by a KeyVaultClient.
+
+    Entries are keyed by (collection, vault, name, version) and expire after ttl seconds. Once expired,
+    an entry is still served for up to stale_ttl seconds while it is refreshed in a background thread,
+    so that a hot secret never blocks on the service. Objects which were not found are cached for
+    negative_ttl seconds. The least recently used entries are evicted beyond max_size entries.
+
+    Concurrent reads of the same missing entry are collapsed into a single request to the service.
+
+    :param ttl: Number of seconds an entry is served without being refreshed.
+    :type ttl: float
+    :param max_size: Maximum number of cached entries.
+    :type max_size: int
+    :param negative_ttl: Number of seconds a not found error is cached, 0 to disable negative caching.
+    :type negative_ttl: float
+    :param stale_ttl: Number of seconds an expired entry is served while it is refreshed in the
+     background, 0 to always refresh synchronously.
+    :type stale_ttl: float
+    """
+
+    def __init__(self, ttl=300, max_size=1024, negative_ttl=30, stale_ttl=60):
+        if max_size < 1:
+            raise ValueError('max_size must be greater than 0')
+        self.ttl = ttl
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.evictions = 0
+        self._total_refresh_latency = 0.0
+        self._max_refresh_latency = 0.0
+
+        self._entries = OrderedDict()
+        self._fetch_locks = {}
+        # incremented by invalidate and clear, so that the fetches started before are not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def metrics(self):
+        """A snapshot of the cache counters: hits (fresh, stale and negative), misses, hit rate, number
+        of entries, evictions, and the count, failures, mean and max latency in seconds of the requests
+        made to the service to fill or refresh entries.
+
+        :rtype: dict
+        """
+        with self._lock:
+            hits = self.hits + self.stale_hits + self.negative_hits
+            lookups = hits + self.misses
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_rate': float(hits) / lookups if lookups else None,
+                'size': len(self._entries),
+                'evictions': self.evictions,
+                'refreshes': self.refreshes,
+                'refresh_failures': self.refresh_failures,
+                'mean_refresh_latency':
+                    self._total_refresh_latency / self.refreshes if self.refreshes else None,
+                'max_refresh_latency': self._max_refresh_latency,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, fetch):
+        """Gets the cached value of key, calling fetch() to get it from the service when it is missing
+        or expired.
+
+        :param key: The cache key, a (collection, vault, name, version) tuple.
+        :type key: tuple
+        :param fetch: Callable returning the value from the service.
+        :return: The cached or fetched value.
+        :raises: :class:`KeyVaultErrorException<azure.keyvault.models.KeyVaultErrorException>`
+         raised by fetch, or cached when the object was not found.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now < entry.expires:
+                    self._entries[key] = self._entries.pop(key)
+                    if entry.error is not None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return entry.result()
+                if entry.error is None and now < entry.expires + self.stale_ttl:
+                    self.stale_hits += 1
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        self._start_refresh(key, fetch)
+                    return entry.value
+            self.misses += 1
+            fetch_lock = self._fetch_locks.get(key)
+            if fetch_lock is None:
+                fetch_lock = self._fetch_locks[key] = _FetchLock()
+            fetch_lock.waiters += 1
+
+        try:
+            with fetch_lock.lock:
+                # another thread may have filled the entry while this one was waiting
+                with self._lock:
+                    entry = self._entries.get(key)
+                    if entry is not None and time.time() < entry.expires:
+                        return entry.result()
+                return self._load(key, fetch).result()
+        finally:
+            with self._lock:
+                fetch_lock.waiters -= 1
+                if not fetch_lock.waiters:
+                    del self._fetch_locks[key]
+
+    def invalidate(self, collection=None, vault=None, name=None):
+        """Removes the matching entries, all the versions of an object at once. Arguments which are
+        not specified match any entry.
+
+        :param collection: The collection of the object: 'secrets', 'keys' or 'certificates'.
+        :type collection: str
+        :param vault: The normalized vault base url.
+        :type vault: str
+        :param name: The normalized name of the object.
+        :type name: str
+        """
+        with self._lock:
+            self._generation += 1
+            for key in list(self._entries):
+                if (collection is None or key[0] == collection) and \
+                        (vault is None or key[1] == vault) and \
+                        (name is None or key[2] == name):
+                    del self._entries[key]
+
+    def clear(self):
+        """Removes all the entries."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _load(self, key, fetch):
+        with self._lock:
+            generation = self._generation
+        start = time.time()
+        try:
+            value = fetch()
+        except KeyVaultErrorException as ex:
+            not_found = _is_not_found(ex)
+            self._record_refresh(start, failed=not not_found)
+            if not_found and self.negative_ttl:
+                return self._store(key, _CacheEntry(None, ex, time.time() + self.negative_ttl), generation)
+            raise
+        except Exception:
+            self._record_refresh(start, failed=True)
+            raise
+        self._record_refresh(start)
+        return self._store(key, _CacheEntry(value, None, time.time() + self.ttl), generation)
+
+    def _store(self, key, entry, generation):
+        """Stores the entry fetched at generation, unless entries were invalidated since, in which case the
+        fetched value may be stale and is only returned to the caller."""
+        with self._lock:
+            if generation != self._generation:
+                return entry
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def _record_refresh(self, start, failed=False):
+        latency = time.time() - start
+        with self._lock:
+            self.refreshes += 1
+            if failed:
+                self.refresh_failures += 1
+            self._total_refresh_latency += latency
+            self._max_refresh_latency = max(self._max_refresh_latency, latency)
+
+    def _start_refresh(self, key, fetch):
+        thread = threading.Thread(target=self._refresh, args=(key, fetch))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, key, fetch):
+        try:
+            self._load(key, fetch)
+        except Exception:
+            # the stale value is served until it expires, then fetched synchronously
+            _LOGGER.warning('Failed to refresh cached key vault object %s', key, exc_info=True)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
@@ -3,18 +3,77 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 #---------------------------------------------------------------------------------------------
 
+import functools
+import os
+import sys
+import threading
 import uuid
 from msrest.pipeline import ClientRawResponse
 
 from .key_vault_authentication import KeyVaultAuthBase, KeyVaultAuthentication
+from .key_vault_backup import _RateLimiter, _open_archive, _read_index, _read_record, _write_record
+from .key_vault_cache import KeyVaultCache, _cache_key
+from .key_vault_concurrency import _limit_concurrency
+from .key_vault_crypto import _LOCAL_CRYPTO_AVAILABLE, _RsaPublicKey
+from .key_vault_id import KeyVaultId, KeyId, SecretId, CertificateId
+from .key_vault_paging import _prefetch_pages, _fan_out
 from ..key_vault_client import KeyVaultClient as KeyVaultClientBase
-from ..models import KeyVaultErrorException
+from ..models import KeyVaultErrorException, KeyItem, KeyOperationResult, KeyVerifyResult
 from msrestazure.azure_active_directory import AADMixin
 
+if sys.version_info < (3,):
+    from Queue import Queue
+else:
+    from queue import Queue
+
+DEFAULT_BULK_WORKERS = 8
+
+
+def _send_probe(client, send, url):
+    """Sends a challenge probe of KeyVaultAuthBase with the configuration of the client."""
+    return send(client.get(url), stream=False, allow_redirects=False)
+
+
+def _invalidates(collections, name_parameter, method):
+    """Wraps a client method which changes an object so that it drops the cached versions of the object, in
+    each of the collections it appears in."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            vault_base_url = args[0] if args else kwargs['vault_base_url']
+            name = args[1] if len(args) > 1 else kwargs[name_parameter]
+            for collection in collections:
+                self._invalidate_cached(collection, vault_base_url, name)
+    return wrapper
+
+
+def _invalidates_restored(collection, id_type, method):
+    """Wraps a client method which restores an object from a backup blob so that it drops the cached versions of
+    the object, named by the id of the returned bundle."""
+    @functools.wraps(method)
+    def wrapper(self, vault_base_url, *args, **kwargs):
+        result = method(self, vault_base_url, *args, **kwargs)
+        bundle = result.output if isinstance(result, ClientRawResponse) else result
+        uri = bundle.key.kid if collection == 'keys' else bundle.id
+        self._invalidate_cached(collection, vault_base_url, id_type(uri=uri).name)
+        return result
+    return wrapper
+
+
+# a certificate is backed by a secret and a key with the same name
+_CERTIFICATE_COLLECTIONS = ('certificates', 'secrets', 'keys')
+
+
+def _item_name(id_type, item):
+    # key items are identified by their kid, the other items by their id
+    return id_type(uri=item.kid if isinstance(item, KeyItem) else item.id).name
+
 
 class CustomKeyVaultClient(KeyVaultClientBase):
 
-    def __init__(self, credentials):
+    def __init__(self, credentials, cache=None, local_crypto=False, concurrency_limiter=None):
         """The key vault client performs cryptographic key operations and vault operations against the Key Vault service.
 
         :ivar config: Configuration for client.
@@ -24,6 +83,18 @@ class CustomKeyVaultClient(KeyVaultClientBase):
         :type credentials: :mod:`A msrestazure Credentials
          object<msrestazure.azure_active_directory>` or :mod:`A KeyVaultAuthentication
          object<key_vault_authentication>` 
+        :param cache: Optional cache of the secrets, keys and certificates read with get_secret, get_key
+         and get_certificate. Objects changed or deleted through this client are removed from the cache.
+        :type cache: :class:`KeyVaultCache<azure.keyvault.KeyVaultCache>`
+        :param local_crypto: Whether encrypt, wrap_key and verify are performed locally with the cached public
+         part of RSA keys, which requires the cryptography package (azure-keyvault[local_crypto]). Only the
+         operations on a specific key version are local. Operations which need the private key, other key types,
+         keys which can't be read with get_key, and all operations when cryptography isn't installed are handled
+         by the service.
+        :type local_crypto: bool
+        :param concurrency_limiter: Optional limiter of the number of concurrent requests of the client, which
+         adapts to the throttling of the vault and retries throttled requests.
+        :type concurrency_limiter: :class:`AdaptiveConcurrencyLimiter<azure.keyvault.AdaptiveConcurrencyLimiter>`
         """
 
         # if the supplied credentials instance is not derived from KeyVaultAuthBase but is an AAD credential type
@@ -34,6 +105,396 @@ class CustomKeyVaultClient(KeyVaultClientBase):
 
         super(CustomKeyVaultClient, self).__init__(credentials)
 
+        self.cache = cache
+        self._public_keys = KeyVaultCache() if local_crypto and _LOCAL_CRYPTO_AVAILABLE else None
+        # the probes bypass the concurrency limiter, they are sent while the request needing them holds its slot
+        auth = getattr(credentials, 'auth', None)
+        if isinstance(auth, KeyVaultAuthBase):
+            auth._send_probe = functools.partial(_send_probe, self._client, self._client.send)  # pylint: disable=protected-access
+
+        self.concurrency_limiter = concurrency_limiter
+        if concurrency_limiter is not None:
+            self._client.send = _limit_concurrency(concurrency_limiter, self._client.send)
+
+    def get_secret(self, vault_base_url, secret_name, secret_version, custom_headers=None, raw=False, **operation_config):
+        """Get a specified secret from a given key vault, from the cache of the client if it has one.
+
+        See :meth:`KeyVaultClient.get_secret<azure.keyvault.key_vault_client.KeyVaultClient.get_secret>`.
+        Requests with custom_headers or raw are not cached.
+        """
+        get = super(CustomKeyVaultClient, self).get_secret
+        if self.cache is None or custom_headers or raw:
+            return get(vault_base_url, secret_name, secret_version, custom_headers, raw, **operation_config)
+        return self.cache.get(_cache_key('secrets', vault_base_url, secret_name, secret_version),
+                              lambda: get(vault_base_url, secret_name, secret_version, **operation_config))
+
+    def get_key(self, vault_base_url, key_name, key_version, custom_headers=None, raw=False, **operation_config):
+        """Gets the public part of a stored key, from the cache of the client if it has one.
+
+        See :meth:`KeyVaultClient.get_key<azure.keyvault.key_vault_client.KeyVaultClient.get_key>`.
+        Requests with custom_headers or raw are not cached.
+        """
+        get = super(CustomKeyVaultClient, self).get_key
+        if self.cache is None or custom_headers or raw:
+            return get(vault_base_url, key_name, key_version, custom_headers, raw, **operation_config)
+        return self.cache.get(_cache_key('keys', vault_base_url, key_name, key_version),
+                              lambda: get(vault_base_url, key_name, key_version, **operation_config))
+
+    def get_certificate(self, vault_base_url, certificate_name, certificate_version, custom_headers=None, raw=False, **operation_config):
+        """Gets information about a specified certificate, from the cache of the client if it has one.
+
+        See :meth:`KeyVaultClient.get_certificate<azure.keyvault.key_vault_client.KeyVaultClient.get_certificate>`.
+        Requests with custom_headers or raw are not cached.
+        """
+        get = super(CustomKeyVaultClient, self).get_certificate
+        if self.cache is None or custom_headers or raw:
+            return get(vault_base_url, certificate_name, certificate_version, custom_headers, raw, **operation_config)
+        return self.cache.get(_cache_key('certificates', vault_base_url, certificate_name, certificate_version),
+                              lambda: get(vault_base_url, certificate_name, certificate_version, **operation_config))
+
+    def encrypt(self, vault_base_url, key_name, key_version, algorithm, value, custom_headers=None, raw=False, **operation_config):
+        """Encrypts an arbitrary sequence of bytes using an encryption key, locally if the client has local_crypto.
+
+        See :meth:`KeyVaultClient.encrypt<azure.keyvault.key_vault_client.KeyVaultClient.encrypt>`.
+        The ciphertext should be decrypted with the key identified by the kid of the result.
+        """
+        if not custom_headers and not raw:
+            key = self._get_public_key(vault_base_url, key_name, key_version, 'encrypt', algorithm, operation_config)
+            result = key.encrypt(algorithm, value) if key is not None else None
+            if result is not None:
+                return self._key_operation_result(key, result)
+        return super(CustomKeyVaultClient, self).encrypt(
+            vault_base_url, key_name, key_version, algorithm, value, custom_headers, raw, **operation_config)
+
+    def wrap_key(self, vault_base_url, key_name, key_version, algorithm, value, custom_headers=None, raw=False, **operation_config):
+        """Wraps a symmetric key using a specified key, locally if the client has local_crypto.
+
+        See :meth:`KeyVaultClient.wrap_key<azure.keyvault.key_vault_client.KeyVaultClient.wrap_key>`.
+        The wrapped key should be unwrapped with the key identified by the kid of the result.
+        """
+        if not custom_headers and not raw:
+            key = self._get_public_key(vault_base_url, key_name, key_version, 'wrapKey', algorithm, operation_config)
+            result = key.encrypt(algorithm, value) if key is not None else None
+            if result is not None:
+                return self._key_operation_result(key, result)
+        return super(CustomKeyVaultClient, self).wrap_key(
+            vault_base_url, key_name, key_version, algorithm, value, custom_headers, raw, **operation_config)
+
+    def verify(self, vault_base_url, key_name, key_version, algorithm, digest, signature, custom_headers=None, raw=False, **operation_config):
+        """Verifies a signature using a specified key, locally if the client has local_crypto.
+
+        See :meth:`KeyVaultClient.verify<azure.keyvault.key_vault_client.KeyVaultClient.verify>`.
+        """
+        if not custom_headers and not raw:
+            key = self._get_public_key(vault_base_url, key_name, key_version, 'verify', algorithm, operation_config)
+            if key is not None:
+                result = KeyVerifyResult()
+                result.value = key.verify(algorithm, digest, signature)
+                return result
+        return super(CustomKeyVaultClient, self).verify(
+            vault_base_url, key_name, key_version, algorithm, digest, signature, custom_headers, raw, **operation_config)
+
+    def _get_public_key(self, vault_base_url, key_name, key_version, operation, algorithm, operation_config):
+        """Gets the cached public key to perform operation locally, or None if the service must perform it.
+
+        The public keys are cached by key version, the latest version of a key is resolved by the service so
+        that a rotated key is used as soon as it is created.
+        """
+        if self._public_keys is None or not key_version:
+            return None
+
+        def fetch():
+            try:
+                bundle = self.get_key(vault_base_url, key_name, key_version, **operation_config)
+            except KeyVaultErrorException:
+                # e.g. the key can be used but not read, leave the operations to the service
+                return None
+            return _RsaPublicKey.from_key_bundle(bundle)
+
+        key = self._public_keys.get(_cache_key('keys', vault_base_url, key_name, key_version), fetch)
+        return key if key is not None and key.allows(operation, algorithm) else None
+
+    @staticmethod
+    def _key_operation_result(key, value):
+        result = KeyOperationResult()
+        result.kid = key.kid
+        result.result = value
+        return result
+
+    def bulk_get_secrets(self, secret_ids, max_workers=DEFAULT_BULK_WORKERS, **operation_config):
+        """Gets many secrets concurrently, e.g. to load the secrets of a service at startup.
+
+        The first secret is fetched alone so that the bearer challenge and the access token are acquired once,
+        then the others are fetched by a pool of threads sharing the credentials of the client. Connections are
+        reused between requests when the client keeps them alive (client.config.keep_alive).
+
+        :param secret_ids: The secret identifiers, as uris or :class:`SecretId<azure.keyvault.SecretId>`
+         instances. A version-less identifier gets the current version of the secret.
+        :type secret_ids: list
+        :param max_workers: The maximum number of concurrent requests.
+        :type max_workers: int
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: A list of (secret bundle, error) tuples in the order of secret_ids, where exactly one of the
+         items is None.
+        :rtype: list
+        """
+        return self._get_many(self.get_secret, SecretId, secret_ids, max_workers, operation_config)
+
+    def bulk_get_keys(self, key_ids, max_workers=DEFAULT_BULK_WORKERS, **operation_config):
+        """Gets the public part of many keys concurrently.
+
+        See :meth:`bulk_get_secrets`.
+
+        :param key_ids: The key identifiers, as uris or :class:`KeyId<azure.keyvault.KeyId>` instances.
+        :type key_ids: list
+        :param max_workers: The maximum number of concurrent requests.
+        :type max_workers: int
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: A list of (key bundle, error) tuples in the order of key_ids, where exactly one of the items
+         is None.
+        :rtype: list
+        """
+        return self._get_many(self.get_key, KeyId, key_ids, max_workers, operation_config)
+
+    def _get_many(self, get, id_type, ids, max_workers, operation_config):
+        if max_workers < 1:
+            raise ValueError('max_workers must be greater than 0')
+        ids = list(ids)
+        results = [None] * len(ids)
+        pending = Queue()
+
+        def fetch(index):
+            try:
+                object_id = ids[index]
+                if not isinstance(object_id, KeyVaultId):
+                    object_id = id_type(uri=object_id)
+                results[index] = (get(object_id.vault, object_id.name, object_id.version, **operation_config), None)
+            except Exception as ex:
+                results[index] = (None, ex)
+
+        def work():
+            while True:
+                index = pending.get()
+                if index is None:
+                    return
+                fetch(index)
+
+        if not ids:
+            return results
+        fetch(0)
+
+        for index in range(1, len(ids)):
+            pending.put(index)
+        threads = []
+        for _ in range(min(max_workers, len(ids) - 1)):
+            pending.put(None)
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    @staticmethod
+    def iter_prefetched(paged, prefetch_pages=1):
+        """Iterates over the items of a list operation while the next pages are fetched in a background thread.
+
+        :param paged: The result of a list operation, e.g. get_secrets or get_deleted_keys.
+        :type paged: :class:`Paged<msrest.paging.Paged>`
+        :param prefetch_pages: The number of pages fetched ahead of the page being iterated.
+        :type prefetch_pages: int
+        :return: An iterator over the items of all the pages. The background thread stops when the iterator is
+         closed or garbage collected.
+        """
+        return _prefetch_pages(paged, prefetch_pages)
+
+    def bulk_get_secret_versions(self, vault_base_url, secret_names=None, max_workers=DEFAULT_BULK_WORKERS,
+                                 maxresults=None, **operation_config):
+        """Lists the versions of many secrets concurrently.
+
+        :param vault_base_url: The vault name, e.g. https://myvault.vault.azure.net
+        :type vault_base_url: str
+        :param secret_names: The names of the secrets, all the secrets of the vault if not specified.
+        :type secret_names: list
+        :param max_workers: The maximum number of secrets listed concurrently.
+        :type max_workers: int
+        :param maxresults: Maximum number of results to return in a page.
+        :type maxresults: int
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: An iterator over (secret name, list of SecretItem, error) tuples in completion order, where one
+         of the list and the error is None.
+        """
+        return self._get_many_versions(self.get_secrets, self.get_secret_versions, SecretId, vault_base_url,
+                                       secret_names, max_workers, maxresults, operation_config)
+
+    def bulk_get_key_versions(self, vault_base_url, key_names=None, max_workers=DEFAULT_BULK_WORKERS,
+                              maxresults=None, **operation_config):
+        """Lists the versions of many keys concurrently.
+
+        See :meth:`bulk_get_secret_versions`.
+
+        :return: An iterator over (key name, list of KeyItem, error) tuples in completion order.
+        """
+        return self._get_many_versions(self.get_keys, self.get_key_versions, KeyId, vault_base_url,
+                                       key_names, max_workers, maxresults, operation_config)
+
+    def bulk_get_certificate_versions(self, vault_base_url, certificate_names=None, max_workers=DEFAULT_BULK_WORKERS,
+                                      maxresults=None, **operation_config):
+        """Lists the versions of many certificates concurrently.
+
+        See :meth:`bulk_get_secret_versions`.
+
+        :return: An iterator over (certificate name, list of CertificateItem, error) tuples in completion order.
+        """
+        return self._get_many_versions(self.get_certificates, self.get_certificate_versions, CertificateId,
+                                       vault_base_url, certificate_names, max_workers, maxresults, operation_config)
+
+    def _get_many_versions(self, list_objects, list_versions, id_type, vault_base_url, names, max_workers,
+                           maxresults, operation_config):
+        if names is None:
+            names = (_item_name(id_type, item) for item in
+                     _prefetch_pages(list_objects(vault_base_url, maxresults, **operation_config), 1))
+
+        def get_versions(name):
+            return list(list_versions(vault_base_url, name, maxresults, **operation_config))
+
+        return _fan_out(get_versions, names, max_workers)
+
+    def backup_vault(self, vault_base_url, path, max_workers=DEFAULT_BULK_WORKERS, max_requests_per_second=None,
+                     **operation_config):
+        """Backs up all the keys and secrets of a vault to an archive file.
+
+        The keys and secrets are listed and backed up concurrently, and the backup blobs are compressed and
+        appended to the archive as they are received, so that the memory used doesn't depend on the size of the
+        vault. The archive is indexed by the collection and the name of the objects. When the archive already
+        exists, e.g. after an interrupted backup or a backup with failures, the objects it contains are skipped
+        and the others are added to it. Certificates are not backed up, as this API version can't back them up,
+        and neither are the keys and secrets managed by certificates: they are listed as not_backed_up in the
+        returned summary.
+
+        :param vault_base_url: The vault name, e.g. https://myvault.vault.azure.net
+        :type vault_base_url: str
+        :param path: The path of the archive file.
+        :type path: str
+        :param max_workers: The maximum number of concurrent backup requests.
+        :type max_workers: int
+        :param max_requests_per_second: The maximum rate of the backup requests, not limited if not specified.
+        :type max_requests_per_second: float
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: A dict with the number of objects backed_up and already in the archive (resumed), the
+         (collection, name) tuples of the keys and secrets managed by certificates, which are not_backed_up, and
+         the (collection, name, error) tuples of the objects which failed to be backed up.
+        :rtype: dict
+        :raises: the error raised while listing the objects of the vault, after the completed backups were
+         added to the archive.
+        """
+        limiter = _RateLimiter(max_requests_per_second) if max_requests_per_second else None
+        summary = {'backed_up': 0, 'resumed': 0, 'not_backed_up': [], 'failed': []}
+        archive, index = _open_archive(path)
+
+        def objects():
+            for collection, list_objects, id_type in (('keys', self.get_keys, KeyId),
+                                                      ('secrets', self.get_secrets, SecretId)):
+                for item in _prefetch_pages(list_objects(vault_base_url, **operation_config), 1):
+                    name = _item_name(id_type, item)
+                    if item.managed:
+                        summary['not_backed_up'].append((collection, name))
+                    elif (collection, name) in index:
+                        summary['resumed'] += 1
+                    else:
+                        yield collection, name
+
+        def backup(collection_name):
+            collection, name = collection_name
+            if limiter is not None:
+                limiter.acquire()
+            backup_object = self.backup_key if collection == 'keys' else self.backup_secret
+            return backup_object(vault_base_url, name, **operation_config).value
+
+        with archive:
+            for (collection, name), blob, error in _fan_out(backup, objects(), max_workers):
+                if error is not None:
+                    summary['failed'].append((collection, name, error))
+                else:
+                    _write_record(archive, collection, name, blob)
+                    summary['backed_up'] += 1
+            os.fsync(archive.fileno())
+        return summary
+
+    def restore_vault(self, vault_base_url, path, max_workers=DEFAULT_BULK_WORKERS, max_requests_per_second=None,
+                      **operation_config):
+        """Restores the keys and secrets of an archive written by :meth:`backup_vault` to a vault.
+
+        The objects are read from the archive and restored concurrently. Objects which already exist in the vault
+        are skipped, so that an interrupted restore is resumed by restoring the archive again.
+
+        :param vault_base_url: The vault name, e.g. https://myvault.vault.azure.net
+        :type vault_base_url: str
+        :param path: The path of the archive file.
+        :type path: str
+        :param max_workers: The maximum number of concurrent restore requests.
+        :type max_workers: int
+        :param max_requests_per_second: The maximum rate of the restore requests, not limited if not specified.
+        :type max_requests_per_second: float
+        :param operation_config: :ref:`Operation configuration
+         overrides<msrest:optionsforoperations>`.
+        :return: A dict with the number of objects restored and already existing in the vault, and the
+         (collection, name, error) tuples of the objects which failed to be restored.
+        :rtype: dict
+        """
+        limiter = _RateLimiter(max_requests_per_second) if max_requests_per_second else None
+        summary = {'restored': 0, 'existing': 0, 'failed': []}
+        read_lock = threading.Lock()
+
+        def restore(record):
+            (collection, _), (offset, size) = record
+            with read_lock:
+                blob = _read_record(archive, offset, size)
+            if limiter is not None:
+                limiter.acquire()
+            restore_object = self.restore_key if collection == 'keys' else self.restore_secret
+            return restore_object(vault_base_url, blob, **operation_config)
+
+        with open(path, 'rb') as archive:
+            index, _ = _read_index(archive)
+            for ((collection, name), _), _, error in _fan_out(restore, index.items(), max_workers):
+                if error is None:
+                    summary['restored'] += 1
+                elif isinstance(error, KeyVaultErrorException) and \
+                        getattr(error.response, 'status_code', None) == 409:
+                    summary['existing'] += 1
+                else:
+                    summary['failed'].append((collection, name, error))
+        return summary
+
+    def _invalidate_cached(self, collection, vault_base_url, name):
+        for cache in (self.cache, self._public_keys):
+            if cache is not None:
+                cache.invalidate(*_cache_key(collection, vault_base_url, name, None)[:3])
+
+    set_secret = _invalidates(('secrets',), 'secret_name', KeyVaultClientBase.set_secret)
+    update_secret = _invalidates(('secrets',), 'secret_name', KeyVaultClientBase.update_secret)
+    delete_secret = _invalidates(('secrets',), 'secret_name', KeyVaultClientBase.delete_secret)
+    recover_deleted_secret = _invalidates(('secrets',), 'secret_name', KeyVaultClientBase.recover_deleted_secret)
+    restore_secret = _invalidates_restored('secrets', SecretId, KeyVaultClientBase.restore_secret)
+    create_key = _invalidates(('keys',), 'key_name', KeyVaultClientBase.create_key)
+    import_key = _invalidates(('keys',), 'key_name', KeyVaultClientBase.import_key)
+    update_key = _invalidates(('keys',), 'key_name', KeyVaultClientBase.update_key)
+    delete_key = _invalidates(('keys',), 'key_name', KeyVaultClientBase.delete_key)
+    recover_deleted_key = _invalidates(('keys',), 'key_name', KeyVaultClientBase.recover_deleted_key)
+    restore_key = _invalidates_restored('keys', KeyId, KeyVaultClientBase.restore_key)
+    create_certificate = _invalidates(_CERTIFICATE_COLLECTIONS, 'certificate_name', KeyVaultClientBase.create_certificate)
+    import_certificate = _invalidates(_CERTIFICATE_COLLECTIONS, 'certificate_name', KeyVaultClientBase.import_certificate)
+    update_certificate = _invalidates(_CERTIFICATE_COLLECTIONS, 'certificate_name', KeyVaultClientBase.update_certificate)
+    merge_certificate = _invalidates(_CERTIFICATE_COLLECTIONS, 'certificate_name', KeyVaultClientBase.merge_certificate)
+    delete_certificate = _invalidates(_CERTIFICATE_COLLECTIONS, 'certificate_name', KeyVaultClientBase.delete_certificate)
+    recover_deleted_certificate = _invalidates(_CERTIFICATE_COLLECTIONS, 'certificate_name', KeyVaultClientBase.recover_deleted_certificate)
+
     def get_pending_certificate_signing_request(self, vault_base_url, certificate_name, custom_headers=None, raw=False, **operation_config):
         """Gets the Base64 pending certificate signing request (PKCS-10).
 
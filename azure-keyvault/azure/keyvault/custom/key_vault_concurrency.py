@@ -0,0 +1,196 @@
+#---------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+#---------------------------------------------------------------------------------------------
+
+import email.utils
+import functools
+import logging
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+_TOO_MANY_REQUESTS = 429
+
+
+def _retry_after(response, default):
+    """Returns the number of seconds of the Retry-After header of the response, given either as a number of
+    seconds or as an http date."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return default
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """Limits the number of concurrent requests of a KeyVaultClient to the rate sustained by the vault.
+
+    The limit is adjusted with additive increase, multiplicative decrease (AIMD): it grows by one after each
+    limit successful responses, and it is multiplied by backoff_factor when the vault throttles a request with
+    429 Too Many Requests. Only the first throttled response of the requests started at the current limit
+    decreases it, so that a burst of 429s decreases the limit once. The requests are paused for the duration of the
+    Retry-After header of the throttled responses, and throttled requests are retried up to max_retries times
+    before the 429 response is returned to the caller.
+
+    A limiter can be shared by several clients which send their requests to the same vault.
+
+    :param initial_limit: The number of concurrent requests allowed at first.
+    :type initial_limit: int
+    :param min_limit: The minimum number of concurrent requests.
+    :type min_limit: int
+    :param max_limit: The maximum number of concurrent requests.
+    :type max_limit: int
+    :param backoff_factor: The factor applied to the limit when a request is throttled.
+    :type backoff_factor: float
+    :param max_retries: The maximum number of times a throttled request is retried.
+    :type max_retries: int
+    :param default_retry_after: The number of seconds requests are paused after a throttled response without
+     Retry-After header.
+    :type default_retry_after: float
+    :param max_retry_after: The maximum number of seconds requests are paused after a throttled response.
+    :type max_retry_after: float
+    """
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64, backoff_factor=0.5, max_retries=3,
+                 default_retry_after=1, max_retry_after=60):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError('the limits must satisfy 1 <= min_limit <= initial_limit <= max_limit')
+        if not 0 < backoff_factor < 1:
+            raise ValueError('backoff_factor must be between 0 and 1')
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.max_retries = max_retries
+        self.default_retry_after = default_retry_after
+        self.max_retry_after = max_retry_after
+
+        self.successes = 0
+        self.throttled = 0
+        self.retries = 0
+        self.decreases = 0
+
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiting = 0
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The number of concurrent requests currently allowed.
+
+        :rtype: int
+        """
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """The number of requests being sent.
+
+        :rtype: int
+        """
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        """The number of requests waiting to be sent.
+
+        :rtype: int
+        """
+        return self._waiting
+
+    @property
+    def metrics(self):
+        """A snapshot of the limiter: current limit, requests in flight and waiting, successful and throttled
+        responses, retries, limit decreases, and the number of seconds requests are still paused for.
+
+        :rtype: dict
+        """
+        with self._condition:
+            return {
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'queue_depth': self._waiting,
+                'successes': self.successes,
+                'throttled': self.throttled,
+                'retries': self.retries,
+                'decreases': self.decreases,
+                'paused_for': max(0.0, self._paused_until - time.time()),
+            }
+
+    def acquire(self, retry=False):
+        """Waits until a request can be sent.
+
+        :param retry: Whether the request is the retry of a throttled request.
+        :type retry: bool
+        :return: The permit of the request, to be passed to :meth:`release`.
+        """
+        with self._condition:
+            if retry:
+                self.retries += 1
+            self._waiting += 1
+            try:
+                while True:
+                    pause = self._paused_until - time.time()
+                    if pause > 0:
+                        self._condition.wait(pause)
+                    elif self._in_flight < int(self._limit):
+                        break
+                    else:
+                        self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            return self.decreases
+
+    def release(self, permit, response=None):
+        """Records the response of a request and adjusts the limit.
+
+        :param permit: The permit returned by :meth:`acquire` for the request.
+        :param response: The response of the request, None if the request failed without response, which
+         doesn't change the limit.
+        :type response: :class:`requests.Response`
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if response is not None and response.status_code == _TOO_MANY_REQUESTS:
+                self.throttled += 1
+                if permit == self.decreases:
+                    self._limit = max(float(self.min_limit), int(self._limit) * self.backoff_factor)
+                    self.decreases += 1
+                    _LOGGER.info('Key vault throttled a request, the concurrency limit is now %d', int(self._limit))
+                pause = min(_retry_after(response, self.default_retry_after), self.max_retry_after)
+                self._paused_until = max(self._paused_until, time.time() + pause)
+            elif response is not None:
+                self.successes += 1
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / int(self._limit))
+            self._condition.notify_all()
+
+
+def _limit_concurrency(limiter, send):
+    """Wraps the send method of a ServiceClient so that its requests are limited by the limiter, and retried
+    when they are throttled."""
+    @functools.wraps(send)
+    def limited_send(request, *args, **kwargs):
+        retries = 0
+        while True:
+            permit = limiter.acquire(retry=retries > 0)
+            response = None
+            try:
+                response = send(request, *args, **kwargs)
+            finally:
+                limiter.release(permit, response)
+            if response.status_code != _TOO_MANY_REQUESTS or retries >= limiter.max_retries:
+                return response
+            # the responses are streamed, release the connection of the throttled response to the pool
+            response.close()
+            retries += 1
+    return limited_send
@@ -0,0 +1,151 @@
+#---------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+#---------------------------------------------------------------------------------------------
+
+import binascii
+import calendar
+import time
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa, utils
+except ImportError:
+    # the local operations need the optional cryptography package, azure-keyvault[local_crypto]
+    rsa = None
+
+# whether the public keys can be used locally, otherwise the operations are left to the service
+_LOCAL_CRYPTO_AVAILABLE = rsa is not None
+
+# the hash of each encryption algorithm, None for PKCS #1 v1.5
+_ENCRYPTION_HASHES = {
+    'RSA-OAEP': 'SHA1',
+    'RSA-OAEP-256': 'SHA256',
+    'RSA1_5': None,
+}
+
+_SIGNATURE_HASHES = {
+    'RS256': 'SHA256',
+    'RS384': 'SHA384',
+    'RS512': 'SHA512',
+    'PS256': 'SHA256',
+    'PS384': 'SHA384',
+    'PS512': 'SHA512',
+}
+
+_RSA_KEY_TYPES = ('RSA', 'RSA-HSM')
+
+
+def _bytes_to_int(value):
+    return int(binascii.hexlify(value), 16) if value else 0
+
+
+def _algorithm_name(algorithm):
+    # algorithms are given either as strings or as the members of the generated enums
+    return getattr(algorithm, 'value', algorithm)
+
+
+def _to_timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+
+def _pss_salt_length(hash_algorithm):
+    # cryptography>=37 recovers the salt length from the signature. The older versions verify a fixed length,
+    # the length of the hash, which JWA requires for PS256, PS384 and PS512.
+    return getattr(padding.PSS, 'AUTO', hash_algorithm.digest_size)
+
+
+class _RsaPublicKey(object):
+    """The public part of a key vault RSA key, used to encrypt, wrap and verify locally with the cryptography
+    package."""
+
+    def __init__(self, kid, n, e, key_ops=None, not_before=None, expires=None):
+        self.kid = kid
+        self.key_ops = key_ops
+        self.not_before = not_before
+        self.expires = expires
+        self._key = rsa.RSAPublicNumbers(_bytes_to_int(e), _bytes_to_int(n)).public_key(default_backend())
+
+    @staticmethod
+    def from_key_bundle(bundle):
+        """Returns the public key of the specified KeyBundle, or None if it can't be used locally.
+
+        :param bundle: The key bundle returned by get_key.
+        :type bundle: :class:`KeyBundle<azure.keyvault.models.KeyBundle>`
+        :rtype: _RsaPublicKey
+        """
+        key = bundle.key
+        if not _LOCAL_CRYPTO_AVAILABLE or key is None or key.kty not in _RSA_KEY_TYPES or not key.n or not key.e:
+            return None
+        attributes = bundle.attributes
+        if attributes is not None and attributes.enabled is False:
+            return None
+        return _RsaPublicKey(
+            key.kid, key.n, key.e, key.key_ops,
+            _to_timestamp(attributes.not_before) if attributes is not None and attributes.not_before else None,
+            _to_timestamp(attributes.expires) if attributes is not None and attributes.expires else None)
+
+    def allows(self, operation, algorithm):
+        """Whether the operation can be performed locally with the key and the algorithm right now.
+
+        :param operation: The operation, e.g. 'encrypt', 'wrapKey' or 'verify'.
+        :type operation: str
+        :param algorithm: The algorithm of the operation.
+        :type algorithm: str
+        :rtype: bool
+        """
+        algorithms = _SIGNATURE_HASHES if operation == 'verify' else _ENCRYPTION_HASHES
+        if _algorithm_name(algorithm) not in algorithms:
+            return False
+        if self.key_ops is not None and operation not in self.key_ops:
+            return False
+        now = time.time()
+        return (self.not_before is None or self.not_before <= now) and (self.expires is None or now < self.expires)
+
+    def encrypt(self, algorithm, plaintext):
+        """Encrypts plaintext with RSAES-PKCS1-v1_5 (RSA1_5) or RSAES-OAEP (RSA-OAEP, RSA-OAEP-256).
+
+        :param algorithm: The encryption algorithm.
+        :type algorithm: str
+        :param plaintext: The data to encrypt.
+        :type plaintext: bytes
+        :return: The ciphertext, or None if plaintext is too long for the key.
+        :rtype: bytes
+        """
+        hash_name = _ENCRYPTION_HASHES[_algorithm_name(algorithm)]
+        if hash_name is None:
+            encryption_padding = padding.PKCS1v15()
+        else:
+            hash_algorithm = getattr(hashes, hash_name)()
+            encryption_padding = padding.OAEP(padding.MGF1(hash_algorithm), hash_algorithm, None)
+        try:
+            return self._key.encrypt(plaintext, encryption_padding)
+        except ValueError:
+            return None
+
+    def verify(self, algorithm, digest, signature):
+        """Verifies an RSASSA-PKCS1-v1_5 (RS256, RS384, RS512) or RSASSA-PSS (PS256, PS384, PS512) signature of a
+        digest.
+
+        :param algorithm: The signature algorithm.
+        :type algorithm: str
+        :param digest: The digest which was signed.
+        :type digest: bytes
+        :param signature: The signature to verify.
+        :type signature: bytes
+        :rtype: bool
+        """
+        algorithm = _algorithm_name(algorithm)
+        hash_algorithm = getattr(hashes, _SIGNATURE_HASHES[algorithm])()
+        if algorithm.startswith('PS'):
+            signature_padding = padding.PSS(padding.MGF1(hash_algorithm), _pss_salt_length(hash_algorithm))
+        else:
+            signature_padding = padding.PKCS1v15()
+        try:
+            self._key.verify(signature, digest, signature_padding, utils.Prehashed(hash_algorithm))
+        except (InvalidSignature, ValueError):
+            # ValueError for a digest whose length doesn't match the hash
+            return False
+        return True
@@ -3,13 +3,29 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # ---------------------------------------------------------------------------------------------
 
+import re
+import threading
+from collections import OrderedDict
+
 try:
     import urllib.parse as parse
 except ImportError:
     import urlparse as parse # pylint: disable=import-error
 
+try:
+    from sys import intern
+except ImportError:
+    pass # intern is a builtin in python 2
+
 from enum import Enum
 
+# identifiers are parsed for every item of a listing, and the same identifiers are parsed repeatedly,
+# so the segments parsed from the most recently used uris are memoized
+_PARSE_CACHE_SIZE = 4096
+_parsed_segments = OrderedDict()
+_parsed_segments_lock = threading.Lock()
+_compiled_formats = {}
+
 
 class KeyVaultCollectionType(Enum):
     keys = 'keys'
@@ -209,7 +225,7 @@ class KeyVaultIdentifier(KeyVaultId):
 
         # add all the keyword arguments as attributes
         for key, value in kwargs.items():
-            self.__dict__[key] = _validate_string_argument(value, key, True)
+            self.__dict__[key] = _validate_string_argument(value, key, True) if value is not None else None
 
         self.version = self.version or KeyVaultIdentifier.version_none
 
@@ -275,46 +291,15 @@ class KeyVaultIdentifier(KeyVaultId):
         :param validation_args: format arguments to be validated
         :return: None
         """
-        def format_error():
-            return ValueError('invalid id: The specified uri "{}", does to match the specified format "{}"'.format(uri, self._id_format))
-
         uri = _validate_string_argument(uri, 'uri')
-        parsed_uri = _parse_uri_argument(uri)
-
-        # split all the id segments from the uri path using and insert the host as the first segment
-        id_segs = list(filter(None, parsed_uri.path.split('/')))
-        id_segs.insert(0, '{}://{}'.format(parsed_uri.scheme, parsed_uri.hostname))
-
-        # split the format segments from the classes format string
-        fmt_segs = list(filter(None, self._id_format.split('/')))
-
-        for ix in range(len(fmt_segs)):
-            # get the format segment and the id segment
-            fmt_seg = fmt_segs[ix]
-            id_seg = id_segs.pop(0) if len(id_segs) > 0 else ''
-
-            # if the segment is a substitution element
-            if fmt_seg.startswith('{') and fmt_seg.endswith('}'):
-                prop = fmt_seg[1:-1]
-                prop_strip = prop.rstrip('?')
-                # if the segment is not present in the specified uri and is not optional raise an error
-                if not id_seg and not prop.endswith('?'):
-                    raise format_error()
-                # if the segment is in the segments to validate and doesn't match the expected vault raise an error
-                if prop_strip in validation_args and validation_args[prop_strip] and validation_args[prop_strip] != id_seg:
-                    if id_seg and not prop.endswith('?'):
-                        raise ValueError('invalid id: The {} "{}" does not match the expected "{}"'.format(prop, id_seg, validation_args[prop_strip]))
-                # set the attribute to the value parsed from the uri
-                self.__dict__[prop_strip] = id_seg
-            # otherwise the segment is a literal element
-            else:
-                # if the value parsed from the uri doesn't match the literal value from the format string raise an error
-                if not fmt_seg == id_seg:
-                    raise format_error()
 
-        # if there are still segments left in the uri which were not accounted for in the format string raise an error
-        if len(id_segs) > 0:
-            raise format_error()
+        for prop, id_seg, optional in _parse_segments(self._id_format, uri):
+            # if the segment is in the segments to validate and doesn't match the expected vault raise an error
+            expected = validation_args.get(prop)
+            if expected and expected != id_seg and id_seg and not optional:
+                raise ValueError('invalid id: The {} "{}" does not match the expected "{}"'.format(prop, id_seg, expected))
+            # set the attribute to the value parsed from the uri
+            self.__dict__[prop] = id_seg
 
 
 class KeyId(KeyVaultIdentifier):
@@ -440,3 +425,103 @@ def _parse_uri_argument(uri):
         raise ValueError("'{}' is not not a valid URI".format(uri))
     return parsed_uri
 
+
+def _compile_format(fmt):
+    """
+    Compiles the id format string into a regular expression matching the canonical uris of the format: lowercase
+    scheme and host without port or credentials, no empty path segments, no parameters, query or fragment.  These
+    are the uris returned by the service, and the ones for which the match is the result of the general parsing.
+    :param fmt: The id format string, e.g. '{vault}/{collection}/{name}/{version?}'
+    :return: The compiled regular expression, and the (prop, optional) tuples of its groups
+    """
+    pattern = ['^([a-z][a-z0-9+.-]*://[a-z0-9._-]+)']
+    props = []
+    for fmt_seg in list(filter(None, fmt.split('/'))):
+        if fmt_seg.startswith('{') and fmt_seg.endswith('}'):
+            optional = fmt_seg.endswith('?}')
+            props.append((fmt_seg[1:-1].rstrip('?'), optional))
+            if len(props) == 1:
+                # the first segment is the vault, matched by the scheme and host group
+                continue
+            pattern.append('(?:/([^/?#;\\s]+))?' if optional else '/([^/?#;\\s]+)')
+        else:
+            pattern.append('/' + re.escape(fmt_seg))
+    pattern.append('/?$')
+    return re.compile(''.join(pattern)), tuple(props)
+
+
+def _parse_segments(fmt, uri):
+    """
+    Parses the specified uri using the id format string.
+    :param fmt: The id format string
+    :param uri: The stripped key vault identifier uri
+    :return: (prop, value, optional) tuples of the substitution segments of the format, in order
+    """
+    key = (fmt, uri)
+    with _parsed_segments_lock:
+        segments = _parsed_segments.pop(key, None)
+        if segments is not None:
+            _parsed_segments[key] = segments
+            return segments
+
+    compiled = _compiled_formats.get(fmt)
+    if compiled is None:
+        compiled = _compiled_formats[fmt] = _compile_format(fmt)
+    regex, props = compiled
+
+    match = regex.match(uri)
+    if match:
+        segments = tuple([(prop, _intern_segment(prop, value or ''), optional)
+                          for (prop, optional), value in zip(props, match.groups())])
+    else:
+        segments = _parse_segments_slow(fmt, uri)
+
+    with _parsed_segments_lock:
+        _parsed_segments[key] = segments
+        while len(_parsed_segments) > _PARSE_CACHE_SIZE:
+            _parsed_segments.popitem(last=False)
+    return segments
+
+
+def _parse_segments_slow(fmt, uri):
+    def format_error():
+        return ValueError('invalid id: The specified uri "{}", does to match the specified format "{}"'.format(uri, fmt))
+
+    parsed_uri = _parse_uri_argument(uri)
+
+    # split all the id segments from the uri path using and insert the host as the first segment
+    id_segs = list(filter(None, parsed_uri.path.split('/')))
+    id_segs.insert(0, '{}://{}'.format(parsed_uri.scheme, parsed_uri.hostname))
+
+    segments = []
+    for fmt_seg in list(filter(None, fmt.split('/'))):
+        id_seg = id_segs.pop(0) if len(id_segs) > 0 else ''
+
+        # if the segment is a substitution element
+        if fmt_seg.startswith('{') and fmt_seg.endswith('}'):
+            prop = fmt_seg[1:-1]
+            optional = prop.endswith('?')
+            prop = prop.rstrip('?')
+            # if the segment is not present in the specified uri and is not optional raise an error
+            if not id_seg and not optional:
+                raise format_error()
+            segments.append((prop, _intern_segment(prop, id_seg), optional))
+        # otherwise the segment is a literal element, which must match the value parsed from the uri
+        elif not fmt_seg == id_seg:
+            raise format_error()
+
+    # if there are still segments left in the uri which were not accounted for in the format string raise an error
+    if len(id_segs) > 0:
+        raise format_error()
+
+    return tuple(segments)
+
+
+def _intern_segment(prop, value):
+    # the vault and the collection are shared by most of the parsed ids
+    if prop == 'vault' or prop == 'collection':
+        try:
+            return intern(value)
+        except TypeError:
+            pass # unicode strings can't be interned in python 2
+    return value
@@ -0,0 +1,135 @@
+#---------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+#---------------------------------------------------------------------------------------------
+
+import sys
+import threading
+
+if sys.version_info < (3,):
+    from Queue import Queue, Empty, Full
+else:
+    from queue import Queue, Empty, Full
+
+_END = object()
+
+
+def _run_in_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _put(items, item, stopped):
+    """Puts item in the bounded queue items unless the consumer stopped. Returns whether the item was put."""
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get(items, stopped):
+    """Gets an item from the queue items, or _END once the consumer stopped."""
+    while not stopped.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except Empty:
+            pass
+    return _END
+
+
+def _prefetch_pages(paged, prefetch_pages):
+    """Iterates over the items of a msrest Paged object while a background thread fetches up to prefetch_pages
+    pages ahead. The thread stops after its current page once the caller stops iterating, and an exception
+    raised while fetching a page is raised to the caller after the items of the previous pages."""
+    if prefetch_pages < 1:
+        raise ValueError('prefetch_pages must be greater than 0')
+    pages = Queue(prefetch_pages)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            while True:
+                page = list(paged.advance_page())
+                if not _put(pages, (page, None), stopped):
+                    return
+        except StopIteration:
+            _put(pages, (_END, None), stopped)
+        except Exception as ex:  # pylint: disable=broad-except
+            _put(pages, (_END, ex), stopped)
+
+    def items():
+        _run_in_thread(produce)
+        try:
+            while True:
+                page, error = pages.get()
+                if page is _END:
+                    if error is not None:
+                        raise error
+                    return
+                for item in page:
+                    yield item
+        finally:
+            stopped.set()
+
+    return items()
+
+
+def _fan_out(function, arguments, max_workers):
+    """Calls function with each item of the arguments iterable from up to max_workers threads, and yields
+    (argument, result, error) tuples as the calls complete. The arguments are consumed lazily by a background
+    thread; an exception raised by the arguments iterable is raised to the caller once the started calls
+    completed."""
+    if max_workers < 1:
+        raise ValueError('max_workers must be greater than 0')
+    pending = Queue(max_workers)
+    results = Queue(max_workers)
+    stopped = threading.Event()
+    feed_error = []
+
+    def feed():
+        try:
+            for argument in arguments:
+                if not _put(pending, argument, stopped):
+                    return
+        except Exception as ex:  # pylint: disable=broad-except
+            feed_error.append(ex)
+        for _ in range(max_workers):
+            if not _put(pending, _END, stopped):
+                return
+
+    def work():
+        while True:
+            argument = _get(pending, stopped)
+            if argument is _END:
+                _put(results, _END, stopped)
+                return
+            try:
+                result = (argument, function(argument), None)
+            except Exception as ex:  # pylint: disable=broad-except
+                result = (argument, None, ex)
+            if not _put(results, result, stopped):
+                return
+
+    def completed():
+        _run_in_thread(feed)
+        for _ in range(max_workers):
+            _run_in_thread(work)
+        try:
+            running = max_workers
+            while running:
+                result = results.get()
+                if result is _END:
+                    running -= 1
+                else:
+                    yield result
+            if feed_error:
+                raise feed_error[0]
+        finally:
+            stopped.set()
+
+    return completed()
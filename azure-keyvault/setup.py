@@ -81,5 +81,10 @@ setup(
         'msrestazure~=0.4.7',
         'azure-common~=1.1.5',
     ],
+    extras_require={
+        'local_crypto': [
+            'cryptography>=2.1',
+        ]
+    },
     cmdclass=cmdclass
 )
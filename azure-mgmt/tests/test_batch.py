@@ -5,16 +5,26 @@
 # Licensed under the MIT License. See License.txt in the project root for
 # license information.
 #--------------------------------------------------------------------------
+import base64
 import datetime
 import io
 import json
 import logging
 import os
 import sys
+import threading
 import time
 import unittest
 
 import requests
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
 
 from testutils.common_recordingtestcase import (
     RecordingTestCase,
@@ -29,6 +39,7 @@ import azure.mgmt.storage
 import azure.mgmt.batch
 import azure.mgmt.keyvault
 import azure.batch as batch
+from azure.batch.custom import CustomBatchServiceClient
 from azure.batch.batch_auth import SharedKeyCredentials
 from msrestazure.azure_active_directory import AADTokenCredentials
 from azure.common.credentials import ServicePrincipalCredentials
@@ -1434,6 +1445,399 @@ class BatchMgmtTestCase(RecordingTestCase):
         self.assertSuccess(_e)
 
 
+class BatchCustomLayerTest(unittest.TestCase):
+
+    url = 'https://account.region.batch.azure.com'
+
+    @staticmethod
+    def _response(status_code, body):
+        response = requests.models.Response()
+        response.status_code = status_code
+        response.headers['content-type'] = 'application/json; odata=minimalmetadata'
+        response._content = json.dumps(body).encode('utf-8')
+        return response
+
+    def _client(self, send):
+        client = CustomBatchServiceClient(MagicMock(), base_url=self.url)
+        client._client.send = send
+        return client
+
+    @patch('azure.batch.custom.task_operations._RETRY_DELAY', 0.01)
+    def test_bulk_add_tasks(self):
+        requests_sent = []
+        server_errors = {'task-7': 1, 'task-250': 5}
+        lock = threading.Lock()
+
+        def send(request, headers=None, content=None, **kwargs):
+            self.assertIn('/jobs/job/addtaskcollection', request.url)
+            tasks = json.loads(request.data.decode('utf-8'))['value']
+            with lock:
+                requests_sent.append(len(tasks))
+            if len(request.data) >= 4 * 1024 * 1024:
+                return self._response(413, {'code': 'RequestBodyTooLarge',
+                                            'message': {'lang': 'en-US', 'value': 'too large'}})
+            results = []
+            for task in tasks:
+                status = 'success'
+                with lock:
+                    if server_errors.get(task['id']):
+                        server_errors[task['id']] -= 1
+                        status = 'serverError'
+                if task['id'] == 'task-3':
+                    status = 'clientError'
+                results.append({'status': status, 'taskId': task['id']})
+            return self._response(200, {'value': results})
+
+        client = self._client(send)
+        tasks = (batch.models.TaskAddParameter('task-{}'.format(i), 'cmd /c echo {}'.format(i)) for i in range(1050))
+
+        summary = client.task.bulk_add('job', tasks, max_workers=4)
+
+        self.assertEqual(summary['added'], 1048)
+        self.assertEqual(sorted(r.task_id for r in summary['failed']), ['task-250', 'task-3'])
+        # 11 chunks of at most 100 tasks, task-7 retried once, task-250 retried 3 times
+        self.assertEqual(max(requests_sent[:11]), 100)
+        self.assertEqual(summary['requests'], 15)
+        self.assertGreater(summary['tasks_per_second'], 0)
+
+    def test_bulk_add_splits_large_requests(self):
+        sizes = []
+        lock = threading.Lock()
+
+        def send(request, headers=None, content=None, **kwargs):
+            size = len(request.data)
+            content = json.loads(request.data.decode('utf-8'))
+            with lock:
+                sizes.append(size)
+            # the service limit is lower than the one of the client for some tasks
+            if len(content['value']) > 10:
+                return self._response(413, {'code': 'RequestBodyTooLarge',
+                                            'message': {'lang': 'en-US', 'value': 'too large'}})
+            return self._response(200, {'value': [{'status': 'success', 'taskId': task['id']}
+                                                  for task in content['value']]})
+
+        client = self._client(send)
+        # 100KB tasks, about 40 tasks fit in 4MB
+        tasks = [batch.models.TaskAddParameter('task-{}'.format(i), 'cmd /c echo ' + 'x' * 100 * 1024)
+                 for i in range(100)]
+
+        summary = client.task.bulk_add('job', tasks)
+
+        self.assertEqual((summary['added'], summary['failed']), (100, []))
+        self.assertLess(max(sizes), 4 * 1024 * 1024)
+
+    def test_bulk_add_serializes_each_task_once(self):
+        bodies = []
+
+        def send(request, headers=None, content=None, **kwargs):
+            self.assertIsNone(content)
+            self.assertIn('timeout=60', request.url)
+            bodies.append(json.loads(request.data.decode('utf-8')))
+            return self._response(200, {'value': [{'status': 'success', 'taskId': task['id']}
+                                                  for task in bodies[-1]['value']]})
+
+        client = self._client(send)
+        serialize = client.task._serialize.body
+        tasks = [batch.models.TaskAddParameter('task-{}'.format(i), 'cmd /c echo {}'.format(i)) for i in range(150)]
+
+        with patch.object(client.task._serialize, 'body', side_effect=serialize) as body:
+            summary = client.task.bulk_add('job', tasks, task_add_collection_options=batch.models.TaskAddCollectionOptions(timeout=60))
+
+        self.assertEqual(summary['added'], 150)
+        self.assertEqual(body.call_count, 150)
+        self.assertEqual(bodies[0]['value'][0], {'id': 'task-0', 'commandLine': 'cmd /c echo 0'})
+        self.assertEqual(sorted(task['id'] for body in bodies for task in body['value']),
+                         sorted(task.id for task in tasks))
+
+    def test_watch_task_states(self):
+        start = datetime.datetime(2017, 10, 2, 10, 0, 0)
+        tasks = {'task-{}'.format(i): ('active', start) for i in range(5)}
+        listings = []
+        polls = []
+
+        def advance(poll):
+            def set_state(task_id, state, seconds):
+                tasks[task_id] = (state, start + datetime.timedelta(seconds=seconds))
+            if poll == 1:
+                set_state('task-0', 'running', 10)
+                set_state('task-1', 'running', 10)
+            elif poll == 3:
+                # task-0 ran and completed between two polls
+                for task_id in ('task-0', 'task-1', 'task-2', 'task-3'):
+                    set_state(task_id, 'completed', 20)
+                del tasks['task-4']
+
+        def send(request, headers=None, content=None, **kwargs):
+            url = urlparse(request.url)
+            query = parse_qs(url.query)
+            if url.path.endswith('/taskcounts'):
+                advance(len(polls))
+                polls.append(url.path)
+                states = [state for state, _ in tasks.values()]
+                return self._response(200, {
+                    'active': states.count('active'), 'running': states.count('running'),
+                    'completed': states.count('completed'), 'succeeded': states.count('completed'), 'failed': 0,
+                    'validationStatus': 'validated'})
+            self.assertEqual(query['$select'], ['id,state,stateTransitionTime'])
+            task_filter = query.get('$filter', [None])[0]
+            listings.append(task_filter)
+            since = None
+            if task_filter:
+                since = datetime.datetime.strptime(task_filter.split("'")[1], '%Y-%m-%dT%H:%M:%S.%fZ')
+            return self._response(200, {'value': [
+                {'id': task_id, 'state': state, 'stateTransitionTime': time.isoformat() + 'Z'}
+                for task_id, (state, time) in sorted(tasks.items()) if since is None or time >= since]})
+
+        watcher = self._client(send).task.watch('job', poll_interval=0, overlap=1)
+        changes = [(change.task_id, change.previous_state, change.state) for change in watcher]
+
+        active, running, completed = (batch.models.TaskState.active, batch.models.TaskState.running,
+                                      batch.models.TaskState.completed)
+        self.assertEqual(changes, [('task-{}'.format(i), None, active) for i in range(5)] + [
+            ('task-0', active, running), ('task-1', active, running),
+            ('task-0', running, completed), ('task-1', running, completed), ('task-2', active, completed),
+            ('task-3', active, completed), ('task-4', active, None)])
+        # all the tasks are listed, then the tasks which changed since 09:59:59 when the counts change, but not
+        # when they don't, then all the tasks again to find the deleted task
+        self.assertEqual(listings, [None, "stateTransitionTime ge datetime'2017-10-02T09:59:59.000Z'", None])
+        self.assertEqual(watcher.states, {'task-{}'.format(i): completed for i in range(4)})
+        self.assertEqual(watcher.stats, {'counts_requests': 4, 'listings': 3, 'tasks_listed': 14})
+
+    def test_bulk_add_stops_on_request_errors(self):
+        def send(request, headers=None, content=None, **kwargs):
+            return self._response(404, {'code': 'JobNotFound', 'message': {'lang': 'en-US', 'value': 'no job'}})
+
+        client = self._client(send)
+        tasks = (batch.models.TaskAddParameter('task-{}'.format(i), 'cmd') for i in range(100000))
+
+        with self.assertRaises(batch.models.BatchErrorException) as context:
+            client.task.bulk_add('job', tasks)
+        self.assertEqual(context.exception.error.code, 'JobNotFound')
+
+
+class BatchSharedKeyAuthTest(unittest.TestCase):
+
+    def test_shared_key_signature(self):
+        from azure.batch.batch_auth import SharedKeyAuth
+        auth = SharedKeyAuth('Authorization', 'account', base64.b64encode(b'k' * 64).decode('utf-8'))
+        request = requests.Request(
+            'POST',
+            'https://account.region.batch.azure.com/jobs/job-0/addtaskcollection'
+            '?api-version=2017-09-01.6.0&timeout=30&$filter=state%20eq%20%27active%27',
+            headers={'Content-Type': 'application/json; odata=minimalmetadata; charset=utf-8',
+                     'ocp-date': 'Mon, 02 Oct 2017 10:00:00 GMT', 'client-request-id': 'abc',
+                     'Content-Length': '1234', 'ocp-range': 'bytes=0-9', 'If-Match': '',
+                     'User-Agent': 'x'}).prepare()
+        self.assertEqual(auth(request).headers['Authorization'],
+                         'SharedKey account:9B+7CMBXpzB/BWjYno97lXOWPWfFtLOJTXph/oRhArQ=')
+
+        # the signer is reused for the next requests
+        request = requests.Request(
+            'GET', 'https://account.region.batch.azure.com/pools/a%2Fb%5Cc',
+            headers={'ocp-date': 'Mon, 02 Oct 2017 10:00:00 GMT'}).prepare()
+        self.assertEqual(auth(request).headers['Authorization'],
+                         'SharedKey account:y78t0Le6sSuWThWql81UOn6/9aNK9tuqs3N994VomhA=')
+
+
+class BatchFileDownloadTest(unittest.TestCase):
+
+    url = 'https://account.region.batch.azure.com'
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'stdout.txt')
+        self.data = os.urandom(1024 * 1024 + 123)
+        self.etag = '0x8D4F'
+        self.ranges = []
+        self.fail_range = None
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _send(self, request, headers=None, content=None, **kwargs):
+        response = requests.models.Response()
+        response.headers['ETag'] = self.etag
+        response.headers['Last-Modified'] = 'Mon, 02 Oct 2017 10:00:00 GMT'
+        response._content_consumed = True
+        if request.method == 'HEAD':
+            response.status_code = 200
+            response.headers['Content-Length'] = str(len(self.data))
+            response.headers['ocp-batch-file-isdirectory'] = 'False'
+            response._content = b''
+            return response
+        self.assertEqual(headers['If-Unmodified-Since'], 'Mon, 02 Oct 2017 10:00:00 GMT')
+        ocp_range = headers['ocp-range']
+        self.ranges.append(ocp_range)
+        if ocp_range == self.fail_range:
+            response.status_code = 500
+            response.headers['content-type'] = 'application/json'
+            response._content = b'{"code": "InternalError", "message": {"lang": "en-US", "value": "failed"}}'
+            return response
+        first, last = [int(i) for i in ocp_range.split('=')[1].split('-')]
+        response.status_code = 200
+        response._content = self.data[first:last + 1]
+        return response
+
+    def _client(self):
+        client = CustomBatchServiceClient(MagicMock(), base_url=self.url)
+        client._client.send = self._send
+        return client
+
+    def test_download_from_task(self):
+        summary = self._client().file.download_from_task(
+            'job', 'task', 'stdout.txt', self.path, max_workers=4, block_size=64 * 1024)
+
+        with open(self.path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), self.data)
+        self.assertEqual((summary['size'], summary['downloaded'], summary['resumed']),
+                         (len(self.data), len(self.data), 0))
+        self.assertEqual(len(self.ranges), 17)
+        self.assertIn('bytes=1048576-1048698', self.ranges)
+        self.assertFalse(os.path.exists(self.path + '.download'))
+
+    def test_download_is_resumed(self):
+        client = self._client()
+        self.fail_range = 'bytes=327680-393215'
+        with self.assertRaises(batch.models.BatchErrorException):
+            client.file.download_from_compute_node('pool', 'node', 'startup/stdout.txt', self.path,
+                                                   max_workers=1, block_size=64 * 1024)
+        self.assertTrue(os.path.exists(self.path + '.download'))
+
+        self.fail_range = None
+        self.ranges = []
+        summary = client.file.download_from_compute_node('pool', 'node', 'startup/stdout.txt', self.path,
+                                                         max_workers=4, block_size=64 * 1024)
+
+        with open(self.path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), self.data)
+        self.assertEqual(summary['resumed'], 5 * 64 * 1024)
+        self.assertEqual(summary['downloaded'], len(self.data) - 5 * 64 * 1024)
+        self.assertEqual(len(self.ranges), 12)
+
+    def test_changed_file_is_downloaded_again(self):
+        client = self._client()
+        self.fail_range = 'bytes=327680-393215'
+        with self.assertRaises(batch.models.BatchErrorException):
+            client.file.download_from_task('job', 'task', 'stdout.txt', self.path, max_workers=1,
+                                           block_size=64 * 1024)
+
+        self.fail_range = None
+        self.etag = '0x8D50'
+        self.data = os.urandom(1000)
+        summary = client.file.download_from_task('job', 'task', 'stdout.txt', self.path, block_size=64 * 1024)
+
+        with open(self.path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), self.data)
+        self.assertEqual((summary['downloaded'], summary['resumed']), (1000, 0))
+
+
+class BatchFileFollowTest(unittest.TestCase):
+
+    url = 'https://account.region.batch.azure.com'
+
+    def setUp(self):
+        self.files = {}
+        self.polls = {}
+        self.fetched = {}
+        self.lock = threading.Lock()
+
+    def _send(self, request, headers=None, content=None, **kwargs):
+        task_id = request.url.split('/tasks/')[1].split('/')[0]
+        response = requests.models.Response()
+        response._content_consumed = True
+        with self.lock:
+            data = self.files.get(task_id)
+            if data is None:
+                response.status_code = 404
+                response.headers['content-type'] = 'application/json'
+                response._content = b'{"code": "TaskNotFound", "message": {"lang": "en-US", "value": "no task"}}'
+                return response
+            data = bytes(data)
+            response.status_code = 200
+            if request.method == 'HEAD':
+                self.polls[task_id] = self.polls.get(task_id, 0) + 1
+                response.headers['Content-Length'] = str(len(data))
+                response._content = b''
+                return response
+            first, last = [int(i) for i in headers['ocp-range'].split('=')[1].split('-')]
+            self.fetched[task_id] = self.fetched.get(task_id, 0) + last + 1 - first
+            response._content = data[first:last + 1]
+            return response
+
+    def _append(self, task_id, data):
+        with self.lock:
+            self.files.setdefault(task_id, bytearray()).extend(data)
+
+    def _client(self):
+        client = CustomBatchServiceClient(MagicMock(), base_url=self.url)
+        client._client.send = self._send
+        return client
+
+    def test_follow_from_tasks(self):
+        def write():
+            for i in range(20):
+                for task_id in ('task-1', 'task-2'):
+                    self._append(task_id, 'line {}\r\n{} é'.format(i, task_id).encode('utf-8'))
+                    self._append(task_id, b'\n')
+                time.sleep(0.01)
+            self._append('task-1', b'no newline')
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        lines = {}
+        for (job_id, task_id, file_path), line in self._client().file.follow_from_tasks(
+                [('job', 'task-1', 'stdout.txt'), ('job', 'task-2', 'stdout.txt'), ('job', 'task-3', 'stdout.txt')],
+                min_poll_interval=0.005, max_poll_interval=0.05, idle_timeout=0.3):
+            self.assertEqual((job_id, file_path), ('job', 'stdout.txt'))
+            lines.setdefault(task_id, []).append(line)
+        writer.join()
+
+        for task_id in ('task-1', 'task-2'):
+            expected = []
+            for i in range(20):
+                expected.extend(['line {}'.format(i), u'{} é'.format(task_id)])
+            if task_id == 'task-1':
+                expected.append('no newline')
+            self.assertEqual(lines[task_id], expected)
+            # the bytes of the files are fetched once
+            self.assertEqual(self.fetched[task_id], len(self.files[task_id]))
+        self.assertNotIn('task-3', lines)
+
+    def test_idle_files_are_polled_less_often(self):
+        self._append('task', b'started\n')
+        lines = list(self._client().file.follow_from_task(
+            'job', 'task', 'stdout.txt', min_poll_interval=0.01, max_poll_interval=0.16, idle_timeout=0.5))
+
+        self.assertEqual(lines, ['started'])
+        # polled after 0, 0.01, 0.03, 0.07, 0.15, 0.31 and 0.47 seconds rather than every 0.01 seconds
+        self.assertLessEqual(self.polls['task'], 9)
+
+    def test_follow_stops_when_closed(self):
+        self._append('task', b'first\nsecond\n')
+        lines = self._client().file.follow_from_task('job', 'task', 'stdout.txt', min_poll_interval=0.01)
+        self.assertEqual(next(lines), 'first')
+        lines.close()
+        polls = self.polls['task']
+        time.sleep(0.1)
+        self.assertLessEqual(self.polls['task'], polls + 1)
+
+    def test_follow_raises_errors(self):
+        def send(request, headers=None, content=None, **kwargs):
+            response = requests.models.Response()
+            response.status_code = 403
+            response.headers['content-type'] = 'application/json'
+            response._content = b'{"code": "AuthenticationFailed", "message": {"lang": "en-US", "value": "denied"}}'
+            return response
+
+        client = self._client()
+        client._client.send = send
+        with self.assertRaises(batch.models.BatchErrorException) as context:
+            list(client.file.follow_from_compute_node('pool', 'node', 'startup/stdout.txt'))
+        self.assertEqual(context.exception.error.code, 'AuthenticationFailed')
+
+
 class BatchPool(object):
 
     def __init__(self, live, client, id, **kwargs):
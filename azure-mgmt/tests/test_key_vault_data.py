@@ -5,6 +5,7 @@
 # Licensed under the MIT License. See License.txt in the project root for
 # license information.
 #--------------------------------------------------------------------------
+import base64
 import binascii
 import codecs
 import copy
@@ -12,18 +13,23 @@ import string
 
 from dateutil import parser as date_parse
 import hashlib
+import json
 import os
+import threading
 import time
 import unittest
 import random
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import MagicMock, patch
 except ImportError:
-    from mock import MagicMock
+    from mock import MagicMock, patch
 
 from azure.keyvault import KeyVaultId
+from azure.keyvault import KeyVaultCache, KeyVaultClient, AdaptiveConcurrencyLimiter
 from azure.keyvault import HttpBearerChallenge
 from azure.keyvault import HttpBearerChallengeCache
+from azure.keyvault import KeyVaultAuthBase, KeyVaultAuthentication
+from azure.keyvault.models import KeyVaultErrorException, KeyBundle, KeyAttributes
 from azure.keyvault.generated.models import \
     (CertificatePolicy, KeyProperties, SecretProperties, IssuerParameters,
      X509CertificateProperties, IssuerBundle, IssuerCredentials, OrganizationDetails,
@@ -156,6 +162,48 @@ class KeyVaultCustomLayerTest(unittest.TestCase):
         res = KeyVaultId.parse_certificate_issuer_id('https://myvault.vault.azure.net/certificates/issuers/myissuer')
         self.assertEqual(res.__dict__, expected)
 
+    def test_parse_fast_path_matches_general_parsing(self):
+        from azure.keyvault.custom import key_vault_id
+        formats = ['{vault}/{collection}/{name}/{version?}', '{vault}/{collection}/issuers/{name}',
+                   '{vault}/{collection}/{account_name}/sas/{sas_definition}']
+        uris = ['https://myvault.vault.azure.net/keys/mykey/abc123',
+                'https://myvault.vault.azure.net/keys/mykey/',
+                'https://MyVault.vault.azure.net/keys/mykey',
+                'HTTPS://myvault.vault.azure.net/keys/mykey',
+                'https://myvault.vault.azure.net:443/keys/mykey/abc123',
+                'https://user@myvault.vault.azure.net/keys/mykey',
+                'https://myvault.vault.azure.net//keys/mykey',
+                'https://myvault.vault.azure.net/keys/mykey/abc123?api-version=7.0',
+                'https://myvault.vault.azure.net/keys/mykey;abc123',
+                'https://myvault.vault.azure.net/certificates/issuers/myissuer',
+                'https://myvault.vault.azure.net/storage/myaccount/sas/mysas',
+                'https://myvault.vault.azure.net/keys/mykey/abc123/extra',
+                'https://myvault.vault.azure.net/keys']
+
+        def parse(parse_segments, fmt, uri):
+            try:
+                return parse_segments(fmt, uri)
+            except ValueError:
+                return ValueError
+
+        for fmt in formats:
+            for uri in uris:
+                self.assertEqual(parse(key_vault_id._parse_segments, fmt, uri),
+                                 parse(key_vault_id._parse_segments_slow, fmt, uri), (fmt, uri))
+                # the second parse is memoized
+                self.assertEqual(parse(key_vault_id._parse_segments, fmt, uri),
+                                 parse(key_vault_id._parse_segments_slow, fmt, uri), (fmt, uri))
+
+    def test_parsed_vault_is_shared(self):
+        vault = 'https://myvault.vault.azure.net'
+        first = KeyVaultId.parse_secret_id(vault + '/secrets/first/abc123')
+        second = KeyVaultId.parse_key_id(vault + '/keys/second')
+        self.assertIs(first.vault, second.vault)
+
+        # the parsed segments are still validated against the specified arguments
+        with self.assertRaises(ValueError):
+            KeyVaultId.parse_object_id('keys', vault + '/secrets/first/abc123')
+
     def test_bearer_challenge_cache(self):
         test_challenges = []
         HttpBearerChallengeCache.clear()
@@ -186,6 +234,75 @@ class KeyVaultCustomLayerTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             HttpBearerChallengeCache.set_challenge_for_url('https://diffurl.com', test_challenges[0]['challenge'])
 
+    def test_bearer_challenge_cache_eviction_and_metrics(self):
+        HttpBearerChallengeCache.clear()
+        HttpBearerChallengeCache.set_max_size(2)
+        try:
+            metrics = HttpBearerChallengeCache.get_metrics()
+            for x in range(3):
+                url = 'https://mytest{}.url.com'.format(x)
+                challenge = MagicMock(source_authority='mytest{}.url.com'.format(x))
+                HttpBearerChallengeCache.set_challenge_for_url(url, challenge)
+
+            self.assertIsNone(HttpBearerChallengeCache.get_challenge_for_url('https://mytest0.url.com'))
+            self.assertIsNotNone(HttpBearerChallengeCache.get_challenge_for_url('https://mytest2.url.com/keys/k'))
+            # removing a missing challenge is not an error
+            HttpBearerChallengeCache.remove_challenge_for_url('https://mytest0.url.com')
+
+            new_metrics = HttpBearerChallengeCache.get_metrics()
+            self.assertEqual(new_metrics['size'], 2)
+            self.assertEqual(new_metrics['updates'] - metrics['updates'], 3)
+            self.assertEqual(new_metrics['challenges'] - metrics['challenges'], 0)
+            self.assertEqual(new_metrics['evictions'] - metrics['evictions'], 1)
+            self.assertEqual(new_metrics['hits'] - metrics['hits'], 1)
+            self.assertEqual(new_metrics['misses'] - metrics['misses'], 1)
+        finally:
+            HttpBearerChallengeCache.set_max_size(1024)
+            HttpBearerChallengeCache.clear()
+
+    def test_bearer_challenge_cache_persistence(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'challenges.json')
+        url = 'https://myvault.vault.azure.net/secrets/mysecret'
+        challenge = HttpBearerChallenge(
+            url, 'Bearer authorization="https://login.windows.net/mock-id", resource="https://vault.azure.net"')
+        try:
+            HttpBearerChallengeCache.clear()
+            HttpBearerChallengeCache.enable_persistence(path)
+            HttpBearerChallengeCache.set_challenge_for_url(url, challenge)
+
+            # a new process loads the saved challenges
+            HttpBearerChallengeCache.enable_persistence(None)
+            HttpBearerChallengeCache.clear()
+            HttpBearerChallengeCache.enable_persistence(path)
+
+            loaded = HttpBearerChallengeCache.get_challenge_for_url('https://myvault.vault.azure.net/keys/k')
+            self.assertEqual(loaded.get_authorization_server(), 'https://login.windows.net/mock-id')
+            self.assertEqual(loaded.get_resource(), 'https://vault.azure.net')
+
+            HttpBearerChallengeCache.remove_challenge_for_url(url)
+            HttpBearerChallengeCache.enable_persistence(None)
+            HttpBearerChallengeCache.enable_persistence(path)
+            self.assertIsNone(HttpBearerChallengeCache.get_challenge_for_url(url))
+
+            # the file is written without holding the lock of the cache
+            save = HttpBearerChallengeCache._save
+            locked = []
+
+            def checked_save(save_path, cache):
+                locked.append(HttpBearerChallengeCache._lock.locked())
+                save(save_path, cache)
+
+            with patch.object(HttpBearerChallengeCache, '_save', checked_save):
+                HttpBearerChallengeCache.set_challenge_for_url(url, challenge)
+            self.assertEqual(locked, [False])
+        finally:
+            HttpBearerChallengeCache.enable_persistence(None)
+            HttpBearerChallengeCache.clear()
+            shutil.rmtree(directory)
+
     def test_bearer_challenge(self):
         mock_bearer_challenge = '  Bearer authorization="https://login.windows.net/mock-id", resource="https://vault.azure.net"'
 
@@ -208,6 +325,959 @@ class KeyVaultCustomLayerTest(unittest.TestCase):
         challenge = HttpBearerChallenge('https://test.uri.com', mock_bearer_challenge)
         self.assertEqual(challenge.get_authorization_server(), 'https://login.windows.net/mock-id')
 
+class KeyVaultCacheTest(unittest.TestCase):
+
+    def _client(self, cache, status_code=200):
+        client = KeyVaultClient(MagicMock(), cache=cache)
+        client._client.send = MagicMock(return_value=MagicMock(status_code=status_code))
+        client._deserialize = MagicMock(side_effect=lambda model, response: MagicMock())
+        return client
+
+    def _not_found(self):
+        return KeyVaultErrorException(MagicMock(), MagicMock(status_code=404))
+
+    def test_get_is_cached(self):
+        cache = KeyVaultCache()
+        client = self._client(cache)
+
+        first = client.get_secret('https://myvault.vault.azure.net/', 'MySecret', '')
+        second = client.get_secret('https://MYVAULT.vault.azure.net', 'mysecret', None)
+        other = client.get_secret('https://myvault.vault.azure.net', 'mysecret', 'abc')
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(client._client.send.call_count, 2)
+        metrics = cache.metrics
+        self.assertEqual((metrics['hits'], metrics['misses'], metrics['size']), (1, 2, 2))
+        self.assertEqual(metrics['hit_rate'], 1 / 3.0)
+        self.assertEqual(metrics['refreshes'], 2)
+        self.assertGreaterEqual(metrics['max_refresh_latency'], metrics['mean_refresh_latency'])
+
+    def test_raw_requests_are_not_cached(self):
+        client = self._client(KeyVaultCache())
+
+        client.get_key('https://myvault.vault.azure.net', 'mykey', '', raw=True)
+        client.get_key('https://myvault.vault.azure.net', 'mykey', '', raw=True)
+
+        self.assertEqual(client._client.send.call_count, 2)
+        self.assertEqual(len(client.cache), 0)
+
+    def test_client_changes_invalidate_all_versions(self):
+        client = self._client(KeyVaultCache())
+        vault = 'https://myvault.vault.azure.net'
+        client.get_secret(vault, 'mysecret', '')
+        client.get_secret(vault, 'mysecret', 'abc')
+        client.get_secret(vault, 'other', '')
+        client.get_certificate(vault, 'mysecret', '')
+
+        client.set_secret(vault_base_url=vault + '/', secret_name='MySecret', value='value')
+
+        self.assertNotIn(('secrets', vault, 'mysecret', ''), client.cache)
+        self.assertNotIn(('secrets', vault, 'mysecret', 'abc'), client.cache)
+        self.assertIn(('secrets', vault, 'other', ''), client.cache)
+        self.assertIn(('certificates', vault, 'mysecret', ''), client.cache)
+
+        client.update_secret(vault, 'other', '', content_type='text/plain')
+        self.assertNotIn(('secrets', vault, 'other', ''), client.cache)
+
+    def test_recover_and_restore_invalidate_not_found(self):
+        client = self._client(KeyVaultCache(negative_ttl=30))
+        vault = 'https://myvault.vault.azure.net'
+        statuses = iter([200, 404, 200, 200, 200, 404, 200, 200])
+        client._client.send = MagicMock(side_effect=lambda *args, **kwargs: MagicMock(status_code=next(statuses)))
+        client._deserialize = MagicMock(side_effect=lambda model, response: MagicMock(
+            id=vault + '/secrets/mysecret/abc', key=MagicMock(kid=vault + '/keys/mykey/abc')))
+
+        client.delete_secret(vault, 'mysecret')
+        with self.assertRaises(KeyVaultErrorException):
+            client.get_secret(vault, 'mysecret', '')
+        client.recover_deleted_secret(vault, 'mysecret')
+        client.get_secret(vault, 'mysecret', '')
+
+        client.delete_key(vault, 'mykey')
+        with self.assertRaises(KeyVaultErrorException):
+            client.get_key(vault, 'mykey', '')
+        client.restore_key(vault, b'blob')
+        client.get_key(vault, 'mykey', '')
+
+        self.assertEqual(client._client.send.call_count, 8)
+
+    def test_certificate_changes_invalidate_its_secret_and_key(self):
+        client = self._client(KeyVaultCache())
+        vault = 'https://myvault.vault.azure.net'
+        client.get_certificate(vault, 'mycert', '')
+        client.get_secret(vault, 'mycert', '')
+        client.get_key(vault, 'mycert', '')
+        client.get_key(vault, 'other', '')
+
+        client.import_certificate(vault, 'mycert', 'base64')
+
+        self.assertEqual(list(client.cache._entries), [('keys', vault, 'other', '')])
+
+    def test_not_found_is_cached(self):
+        cache = KeyVaultCache(negative_ttl=30)
+        fetch = MagicMock(side_effect=self._not_found())
+
+        for _ in range(3):
+            with self.assertRaises(KeyVaultErrorException):
+                cache.get(('secrets', 'vault', 'missing', ''), fetch)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(cache.metrics['negative_hits'], 2)
+
+    def test_not_found_is_raised_as_a_new_exception(self):
+        cache = KeyVaultCache(negative_ttl=30)
+        error = self._not_found()
+        errors = []
+
+        for _ in range(2):
+            try:
+                cache.get(('secrets', 'vault', 'missing', ''), MagicMock(side_effect=error))
+            except KeyVaultErrorException as ex:
+                errors.append(ex)
+
+        self.assertIsNot(errors[0], errors[1])
+        self.assertIs(errors[1].response, error.response)
+        self.assertEqual(errors[1].args, error.args)
+        self.assertEqual(cache.metrics['refresh_failures'], 0)
+
+    def test_other_errors_are_not_cached(self):
+        cache = KeyVaultCache()
+        fetch = MagicMock(side_effect=[KeyVaultErrorException(MagicMock(), MagicMock(status_code=403)), 'value'])
+
+        with self.assertRaises(KeyVaultErrorException):
+            cache.get(('secrets', 'vault', 'name', ''), fetch)
+
+        self.assertEqual(cache.get(('secrets', 'vault', 'name', ''), fetch), 'value')
+        self.assertEqual(cache.metrics['refresh_failures'], 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = KeyVaultCache(max_size=2)
+
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 1)
+        cache.get('c', lambda: 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.metrics['evictions'], 1)
+
+    def test_expired_entry_is_served_while_refreshed(self):
+        cache = KeyVaultCache(ttl=0.1, stale_ttl=60)
+        values = iter(['first', 'second'])
+        refreshed = threading.Event()
+
+        def fetch():
+            value = next(values)
+            if value == 'second':
+                refreshed.set()
+            return value
+
+        self.assertEqual(cache.get('key', fetch), 'first')
+        time.sleep(0.2)
+        self.assertEqual(cache.get('key', fetch), 'first')
+        self.assertTrue(refreshed.wait(5))
+        deadline = time.time() + 5
+        while cache.metrics['refreshes'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get('key', fetch), 'second')
+        self.assertEqual(cache.metrics['stale_hits'], 1)
+
+    def test_concurrent_misses_fetch_once(self):
+        cache = KeyVaultCache()
+        fetch = MagicMock(side_effect=lambda: time.sleep(0.2) or 'value')
+        values = []
+
+        threads = [threading.Thread(target=lambda: values.append(cache.get('key', fetch)))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(values, ['value'] * 10)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(cache._fetch_locks, {})
+
+    def test_late_miss_waits_for_the_running_fetch(self):
+        cache = KeyVaultCache(ttl=0)
+        started = threading.Event()
+        release = threading.Event()
+        fetch = MagicMock(side_effect=lambda: started.set() or release.wait() and 'value')
+        first = threading.Thread(target=cache.get, args=('key', fetch))
+        first.start()
+        self.assertTrue(started.wait(5))
+
+        # the second miss holds the fetch lock of the first, which is only dropped by the last of them
+        second = threading.Thread(target=cache.get, args=('key', fetch))
+        second.start()
+        time.sleep(0.1)
+        self.assertEqual(cache._fetch_locks['key'].waiters, 2)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(cache._fetch_locks, {})
+
+    def test_fetch_started_before_invalidate_is_not_stored(self):
+        cache = KeyVaultCache()
+        key = ('secrets', 'vault', 'name', '')
+
+        def fetch():
+            cache.invalidate('secrets', 'vault', 'name')
+            return 'old'
+
+        self.assertEqual(cache.get(key, fetch), 'old')
+        self.assertNotIn(key, cache)
+        self.assertEqual(cache.get(key, lambda: 'new'), 'new')
+        self.assertIn(key, cache)
+
+    def test_get_secrets_concurrently(self):
+        client = self._client(None)
+        lock = threading.Lock()
+        active = [0]
+        concurrency = []
+
+        def send(request, *args, **kwargs):
+            with lock:
+                active[0] += 1
+                concurrency.append(active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return MagicMock(status_code=200, url=request.url)
+
+        client._client.send = MagicMock(side_effect=send)
+        client._deserialize = MagicMock(side_effect=lambda model, response: response.url)
+        ids = ['https://myvault.vault.azure.net/secrets/s{}'.format(i) for i in range(20)]
+
+        results = client.bulk_get_secrets(ids + ['https://myvault.vault.azure.net/keys/k1'], max_workers=4)
+
+        self.assertEqual(len(results), 21)
+        for i, (secret, error) in enumerate(results[:20]):
+            self.assertIsNone(error)
+            self.assertIn('/secrets/s{}/'.format(i), secret)
+        self.assertIsNone(results[20][0])
+        self.assertIsInstance(results[20][1], ValueError)
+        # the first secret acquires the challenge alone, the others are fetched concurrently
+        self.assertEqual(concurrency[0], 1)
+        self.assertGreater(max(concurrency), 1)
+        self.assertLessEqual(max(concurrency), 4)
+
+    def test_get_keys_reports_errors(self):
+        client = self._client(None)
+        client._client.send = MagicMock(side_effect=[
+            MagicMock(status_code=200), MagicMock(status_code=404), MagicMock(status_code=200)])
+        key_ids = [KeyVaultId.create_key_id('https://myvault.vault.azure.net', 'key{}'.format(i)) for i in range(3)]
+
+        results = client.bulk_get_keys(key_ids, max_workers=1)
+
+        self.assertEqual([error is None for _, error in results], [True, False, True])
+        self.assertIsInstance(results[1][1], KeyVaultErrorException)
+        self.assertEqual(client.bulk_get_keys([]), [])
+
+
+class KeyVaultPagingTest(unittest.TestCase):
+
+    vault = 'https://myvault.vault.azure.net'
+
+    def _client(self, secrets, versions=2, page_size=3, delay=0, fail=(), collection='secrets'):
+        import requests
+        client = KeyVaultClient(MagicMock())
+        self.requests = []
+        id_property = 'kid' if collection == 'keys' else 'id'
+
+        def send(request, *args, **kwargs):
+            time.sleep(delay)
+            self.requests.append(request.url)
+            if '/versions' in request.url:
+                name = request.url.split('/{}/'.format(collection))[1].split('/')[0]
+                if name in fail:
+                    response = requests.models.Response()
+                    response.status_code = 404
+                    response._content = b'{"error": {"code": "SecretNotFound", "message": "not found"}}'
+                    return response
+                ids = ['{}/{}/{}/v{}'.format(self.vault, collection, name, i) for i in range(versions)]
+                next_link = None
+            else:
+                start = int(request.url.split('skip=')[1]) if 'skip=' in request.url else 0
+                ids = ['{}/{}/s{}'.format(self.vault, collection, i)
+                       for i in range(start, min(start + page_size, secrets))]
+                next_link = '{}/{}?skip={}'.format(self.vault, collection, start + page_size) \
+                    if start + page_size < secrets else None
+            response = requests.models.Response()
+            response.status_code = 200
+            response.headers['content-type'] = 'application/json'
+            response._content = json.dumps({'value': [{id_property: i} for i in ids],
+                                            'nextLink': next_link}).encode('utf-8')
+            return response
+
+        client._client.send = send
+        return client
+
+    def test_iter_prefetched(self):
+        client = self._client(secrets=10)
+
+        ids = [item.id for item in client.iter_prefetched(client.get_secrets(self.vault), prefetch_pages=2)]
+
+        self.assertEqual(ids, ['{}/secrets/s{}'.format(self.vault, i) for i in range(10)])
+        self.assertEqual(len(self.requests), 4)
+
+    def test_iter_prefetched_fetches_ahead(self):
+        client = self._client(secrets=9, delay=0.1)
+        items = client.iter_prefetched(client.get_secrets(self.vault), prefetch_pages=1)
+
+        next(items)
+        time.sleep(0.5)
+
+        # the second page was fetched while the first one was consumed, the third one waits for room
+        self.assertEqual(len(self.requests), 3)
+        items.close()
+
+    def test_bulk_get_secret_versions(self):
+        client = self._client(secrets=7, versions=3, fail=('s4',))
+
+        results = dict((name, (versions, error)) for name, versions, error in
+                       client.bulk_get_secret_versions(self.vault, max_workers=3))
+
+        self.assertEqual(sorted(results), ['s{}'.format(i) for i in range(7)])
+        self.assertIsInstance(results['s4'][1], KeyVaultErrorException)
+        self.assertEqual([item.id for item in results['s1'][0]],
+                         ['{}/secrets/s1/v{}'.format(self.vault, i) for i in range(3)])
+
+    def test_bulk_get_secret_versions_is_concurrent(self):
+        client = self._client(secrets=0, delay=0.1)
+
+        start = time.time()
+        results = list(client.bulk_get_secret_versions(self.vault, ['s{}'.format(i) for i in range(8)], max_workers=8))
+
+        self.assertEqual(len(results), 8)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_bulk_get_key_versions(self):
+        client = self._client(secrets=4, versions=2, collection='keys')
+
+        results = dict((name, [item.kid for item in versions]) for name, versions, _ in
+                       client.bulk_get_key_versions(self.vault, max_workers=2))
+
+        self.assertEqual(sorted(results), ['s{}'.format(i) for i in range(4)])
+        self.assertEqual(results['s1'], ['{}/keys/s1/v0'.format(self.vault), '{}/keys/s1/v1'.format(self.vault)])
+
+
+class KeyVaultConcurrencyLimiterTest(unittest.TestCase):
+
+    vault = 'https://myvault.vault.azure.net'
+
+    @staticmethod
+    def _response(status_code, retry_after=None):
+        import requests
+        response = requests.models.Response()
+        response.status_code = status_code
+        response.headers['content-type'] = 'application/json'
+        if retry_after is not None:
+            response.headers['Retry-After'] = retry_after
+        if status_code == 200:
+            response._content = b'{"value": "secret", "id": "https://myvault.vault.azure.net/secrets/s/1"}'
+        else:
+            response._content = b'{"error": {"code": "Throttled", "message": "too many requests"}}'
+        response._content_consumed = True
+        return response
+
+    def test_throttled_responses_are_closed(self):
+        from azure.keyvault.custom.key_vault_concurrency import _limit_concurrency
+        throttled = MagicMock(status_code=429, headers={'Retry-After': '0'})
+        success = MagicMock(status_code=200, headers={})
+        send = _limit_concurrency(AdaptiveConcurrencyLimiter(), MagicMock(side_effect=[throttled, success]))
+
+        self.assertIs(send(MagicMock()), success)
+        throttled.close.assert_called_once_with()
+        success.close.assert_not_called()
+
+    def test_limit_is_adjusted(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=4)
+
+        for _ in range(4):
+            limiter.release(limiter.acquire(), self._response(200))
+        self.assertEqual(limiter.limit, 5)
+
+        first, second = limiter.acquire(), limiter.acquire()
+        limiter.release(first, self._response(429, '0'))
+        self.assertEqual(limiter.limit, 2)
+        # the other requests started before the decrease don't decrease the limit again
+        limiter.release(second, self._response(429, '0'))
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual((limiter.metrics['throttled'], limiter.metrics['decreases']), (2, 1))
+
+        # a failed request doesn't change the limit
+        limiter.release(limiter.acquire())
+        self.assertEqual((limiter.limit, limiter.in_flight), (2, 0))
+
+    def test_retry_after_pauses_requests(self):
+        limiter = AdaptiveConcurrencyLimiter()
+        limiter.release(limiter.acquire(), self._response(429, '0.3'))
+
+        start = time.time()
+        limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+        from email.utils import formatdate
+        limiter.release(limiter.acquire(), self._response(429, formatdate(time.time() + 30, usegmt=True)))
+        self.assertGreater(limiter.metrics['paused_for'], 20)
+
+    def test_requests_wait_for_the_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+        permit = limiter.acquire()
+        acquired = threading.Event()
+
+        thread = threading.Thread(target=lambda: acquired.set() if limiter.acquire() is not None else None)
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual((limiter.in_flight, limiter.queue_depth), (1, 1))
+        self.assertFalse(acquired.is_set())
+
+        limiter.release(permit, self._response(200))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
+    def test_client_adapts_to_throttling(self):
+        # a vault which throttles the requests beyond 4 concurrent requests
+        capacity = 4
+        state = {'in_flight': 0, 'max_in_flight': 0}
+        lock = threading.Lock()
+
+        def request(method, url, **kwargs):
+            with lock:
+                state['in_flight'] += 1
+                throttled = state['in_flight'] > capacity
+                state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+            try:
+                time.sleep(0.01)
+                return self._response(429, '0.02') if throttled else self._response(200)
+            finally:
+                with lock:
+                    state['in_flight'] -= 1
+
+        credentials = MagicMock()
+        credentials.signed_session.return_value.request.side_effect = request
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=16, max_retries=20)
+        client = KeyVaultClient(credentials, concurrency_limiter=limiter)
+        errors = []
+
+        def get_secrets():
+            for _ in range(10):
+                try:
+                    client.get_secret(self.vault, 's', '')
+                except Exception as ex:  # pylint: disable=broad-except
+                    errors.append(ex)
+
+        threads = [threading.Thread(target=get_secrets) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(limiter.metrics['successes'], 160)
+        self.assertGreater(limiter.metrics['throttled'], 0)
+        self.assertLessEqual(limiter.limit, 2 * capacity)
+        self.assertEqual((limiter.in_flight, limiter.queue_depth), (0, 0))
+
+
+class KeyVaultBackupTest(unittest.TestCase):
+
+    vault = 'https://myvault.vault.azure.net'
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'vault.backup')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def _client(self, objects, fail=(), managed=()):
+        """A client of a fake vault holding the backup blobs of the objects, keyed by (collection, name)."""
+        import requests
+        client = KeyVaultClient(MagicMock())
+        self.requests = []
+
+        def encode(blob):
+            return base64.urlsafe_b64encode(blob).decode('ascii').rstrip('=')
+
+        def respond(status_code, body):
+            response = requests.models.Response()
+            response.status_code = status_code
+            response.headers['content-type'] = 'application/json'
+            response._content = json.dumps(body).encode('utf-8')
+            return response
+
+        def send(request, headers=None, content=None, **kwargs):
+            path = request.url.split(self.vault)[1].split('?')[0].strip('/').split('/')
+            self.requests.append((request.method, '/'.join(path)))
+            collection = path[0]
+            if request.method == 'GET':
+                id_property = 'kid' if collection == 'keys' else 'id'
+                return respond(200, {'value': [
+                    {id_property: '{}/{}/{}'.format(self.vault, c, n), 'managed': True if n in managed else None}
+                    for c, n in sorted(objects) if c == collection]})
+            if path[-1] == 'backup':
+                if path[1] in fail:
+                    return respond(500, {'error': {'code': 'InternalError', 'message': 'failed'}})
+                return respond(200, {'value': encode(objects[(collection, path[1])])})
+            # restore
+            blob = base64.urlsafe_b64decode(content['value'] + '=' * (-len(content['value']) % 4))
+            name = blob.decode('utf-8').split(':')[0]
+            if (collection, name) in objects:
+                return respond(409, {'error': {'code': 'Conflict', 'message': 'exists'}})
+            objects[(collection, name)] = blob
+            if collection == 'keys':
+                return respond(200, {'key': {'kid': '{}/keys/{}/1'.format(self.vault, name)}})
+            return respond(200, {'id': '{}/secrets/{}/1'.format(self.vault, name)})
+
+        client._client.send = send
+        return client
+
+    @staticmethod
+    def _objects(count):
+        objects = {}
+        for i in range(count):
+            objects[('keys', 'k{}'.format(i))] = 'k{}:{}'.format(i, 'key material ' * 50).encode('utf-8')
+            objects[('secrets', 's{}'.format(i))] = 's{}:{}'.format(i, 'secret value ' * 50).encode('utf-8')
+        return objects
+
+    def test_backup_and_restore(self):
+        objects = self._objects(5)
+        client = self._client(dict(objects), managed=('s4',))
+
+        summary = client.backup_vault(self.vault, self.path, max_workers=3)
+
+        self.assertEqual((summary['backed_up'], summary['resumed'], summary['not_backed_up'], summary['failed']),
+                         (9, 0, [('secrets', 's4')], []))
+        # the archive is compressed
+        self.assertLess(os.path.getsize(self.path), sum(len(blob) for blob in objects.values()) / 2)
+
+        restored = {}
+        client = self._client(restored)
+        summary = client.restore_vault(self.vault, self.path, max_workers=3)
+
+        self.assertEqual((summary['restored'], summary['existing'], summary['failed']), (9, 0, []))
+        del objects[('secrets', 's4')]
+        self.assertEqual(restored, objects)
+
+        # restoring again skips the existing objects
+        summary = client.restore_vault(self.vault, self.path, max_workers=3)
+        self.assertEqual((summary['restored'], summary['existing'], summary['failed']), (0, 9, []))
+
+    def test_backup_is_resumed(self):
+        objects = self._objects(4)
+        client = self._client(objects, fail=('k1', 's2'))
+
+        summary = client.backup_vault(self.vault, self.path)
+        self.assertEqual(summary['backed_up'], 6)
+        self.assertEqual(sorted((c, n) for c, n, _ in summary['failed']), [('keys', 'k1'), ('secrets', 's2')])
+
+        # interrupt the backup while the last record was written
+        with open(self.path, 'r+b') as archive:
+            archive.truncate(os.path.getsize(self.path) - 10)
+
+        client = self._client(objects)
+        summary = client.backup_vault(self.vault, self.path)
+
+        self.assertEqual((summary['backed_up'], summary['resumed'], summary['failed']), (3, 5, []))
+        self.assertEqual(len([r for r in self.requests if r[1].endswith('/backup')]), 3)
+
+        restored = {}
+        summary = self._client(restored).restore_vault(self.vault, self.path)
+        self.assertEqual(summary['restored'], 8)
+        self.assertEqual(restored, objects)
+
+    def test_backup_rate_limit(self):
+        client = self._client(self._objects(3))
+
+        start = time.time()
+        client.backup_vault(self.vault, self.path, max_workers=6, max_requests_per_second=20)
+
+        # 6 backups spaced by 50ms
+        self.assertGreaterEqual(time.time() - start, 0.25)
+
+    def test_invalid_archive(self):
+        with open(self.path, 'wb') as archive:
+            archive.write(b'not a backup')
+
+        with self.assertRaises(ValueError):
+            self._client({}).backup_vault(self.vault, self.path)
+        with self.assertRaises(ValueError):
+            self._client({}).restore_vault(self.vault, self.path)
+
+
+class KeyVaultLocalCryptoTest(unittest.TestCase):
+
+    def setUp(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        self.private_key = rsa.generate_private_key(65537, 2048, default_backend())
+        numbers = self.private_key.public_key().public_numbers()
+        self.kid = 'https://myvault.vault.azure.net/keys/mykey/abc'
+        self.bundle = KeyBundle(
+            key=JsonWebKey(kid=self.kid, kty='RSA', key_ops=['encrypt', 'wrapKey', 'verify'],
+                           n=codecs.decode('{:0512x}'.format(numbers.n), 'hex'),
+                           e=codecs.decode('010001', 'hex')),
+            attributes=KeyAttributes(enabled=True))
+        self.client = KeyVaultClient(MagicMock(), local_crypto=True)
+        self.client.get_key = MagicMock(return_value=self.bundle)
+        self.client._client.send = MagicMock(return_value=MagicMock(status_code=200))
+        self.client._deserialize = MagicMock(side_effect=lambda model, response: MagicMock())
+
+    def _padding(self, algorithm):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        if algorithm == 'RSA1_5':
+            return padding.PKCS1v15()
+        hash_algorithm = hashes.SHA1() if algorithm == 'RSA-OAEP' else hashes.SHA256()
+        return padding.OAEP(padding.MGF1(hash_algorithm), hash_algorithm, None)
+
+    def test_encrypt_and_wrap_locally(self):
+        vault = 'https://myvault.vault.azure.net'
+        for algorithm in ['RSA-OAEP', 'RSA-OAEP-256', 'RSA1_5']:
+            result = self.client.encrypt(vault, 'mykey', 'abc', algorithm, b'plaintext')
+            self.assertEqual(result.kid, self.kid)
+            self.assertEqual(self.private_key.decrypt(result.result, self._padding(algorithm)), b'plaintext')
+
+            result = self.client.wrap_key(vault, 'mykey', 'abc', algorithm, b'k' * 32)
+            self.assertEqual(self.private_key.decrypt(result.result, self._padding(algorithm)), b'k' * 32)
+
+        self.assertEqual(self.client.get_key.call_count, 1)
+        self.client._client.send.assert_not_called()
+
+    def test_verify_locally(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        vault = 'https://myvault.vault.azure.net'
+        digest = hashlib.sha256(b'message').digest()
+        signatures = {
+            'RS256': self.private_key.sign(b'message', padding.PKCS1v15(), hashes.SHA256()),
+            'PS256': self.private_key.sign(
+                b'message', padding.PSS(padding.MGF1(hashes.SHA256()), 32), hashes.SHA256()),
+        }
+
+        for algorithm, signature in signatures.items():
+            self.assertTrue(self.client.verify(vault, 'mykey', 'abc', algorithm, digest, signature).value)
+            tampered = signature[:-1] + bytes(bytearray([signature[-1] ^ 1]))
+            self.assertFalse(self.client.verify(vault, 'mykey', 'abc', algorithm, digest, tampered).value)
+            other = hashlib.sha256(b'other').digest()
+            self.assertFalse(self.client.verify(vault, 'mykey', 'abc', algorithm, other, signature).value)
+
+        self.client._client.send.assert_not_called()
+
+    def test_verify_pss_with_any_salt_length(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        digest = hashlib.sha384(b'message').digest()
+
+        for salt_length in (0, 20, 48, 64):
+            signature = self.private_key.sign(
+                b'message', padding.PSS(padding.MGF1(hashes.SHA384()), salt_length), hashes.SHA384())
+            result = self.client.verify('https://myvault.vault.azure.net', 'mykey', 'abc', 'PS384', digest, signature)
+            self.assertTrue(result.value)
+
+        self.client._client.send.assert_not_called()
+
+    def test_verify_pss_without_salt_length_recovery(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+        digest = hashlib.sha384(b'message').digest()
+
+        class OldPadding(object):
+            # the padding module of cryptography<37, without PSS.AUTO
+            MGF1 = padding.MGF1
+            PKCS1v15 = padding.PKCS1v15
+
+            @staticmethod
+            def PSS(mgf, salt_length):  # pylint: disable=invalid-name
+                return padding.PSS(mgf, salt_length)
+
+        results = {}
+        with patch('azure.keyvault.custom.key_vault_crypto.padding', OldPadding):
+            for salt_length in (20, 48):
+                signature = self.private_key.sign(
+                    b'message', padding.PSS(padding.MGF1(hashes.SHA384()), salt_length), hashes.SHA384())
+                results[salt_length] = self.client.verify(
+                    'https://myvault.vault.azure.net', 'mykey', 'abc', 'PS384', digest, signature).value
+
+        # the salt is as long as the hash under JWA
+        self.assertEqual(results, {20: False, 48: True})
+
+    def test_latest_version_is_left_to_the_service(self):
+        vault = 'https://myvault.vault.azure.net'
+
+        # the latest version of a key changes when the key is rotated
+        self.client.encrypt(vault, 'mykey', '', 'RSA-OAEP', b'plaintext')
+        self.client.verify(vault, 'mykey', '', 'RS256', b'0' * 32, b'0' * 256)
+
+        self.client.get_key.assert_not_called()
+        self.assertEqual(self.client._client.send.call_count, 2)
+
+    def test_without_cryptography(self):
+        with patch('azure.keyvault.custom.key_vault_client._LOCAL_CRYPTO_AVAILABLE', False):
+            client = KeyVaultClient(MagicMock(), local_crypto=True)
+        client.get_key = MagicMock(return_value=self.bundle)
+        client._client.send = MagicMock(return_value=MagicMock(status_code=200))
+        client._deserialize = MagicMock(side_effect=lambda model, response: MagicMock())
+
+        client.encrypt('https://myvault.vault.azure.net', 'mykey', 'abc', 'RSA-OAEP', b'plaintext')
+
+        client.get_key.assert_not_called()
+        self.assertEqual(client._client.send.call_count, 1)
+
+    def test_service_fallback(self):
+        vault = 'https://myvault.vault.azure.net'
+
+        # operation not allowed by the key
+        self.bundle.key.key_ops = ['encrypt']
+        self.client.verify(vault, 'mykey', 'abc', 'RS256', b'0' * 32, b'0' * 256)
+        self.assertEqual(self.client._client.send.call_count, 1)
+
+        # private key operation
+        self.client.decrypt(vault, 'mykey', 'abc', 'RSA-OAEP', b'0' * 256)
+        self.assertEqual(self.client._client.send.call_count, 2)
+
+        # key which can't be read
+        self.client.get_key = MagicMock(side_effect=KeyVaultErrorException(MagicMock(), MagicMock(status_code=403)))
+        self.client.encrypt(vault, 'otherkey', 'abc', 'RSA-OAEP', b'plaintext')
+        self.assertEqual(self.client._client.send.call_count, 3)
+
+    def test_update_key_invalidates_public_key(self):
+        vault = 'https://myvault.vault.azure.net'
+        self.client.encrypt(vault, 'mykey', 'abc', 'RSA-OAEP', b'plaintext')
+
+        self.client.update_key(vault, 'mykey', 'abc', key_ops=['verify'])
+        self.client.encrypt(vault, 'mykey', 'abc', 'RSA-OAEP', b'plaintext')
+
+        self.assertEqual(self.client.get_key.call_count, 2)
+
+
+def _access_token(expires_in, number=0):
+    claims = json.dumps({'exp': int(time.time() + expires_in), 'n': number}).encode('utf-8')
+    return 'header.{}.signature'.format(base64.urlsafe_b64encode(claims).decode('ascii').rstrip('='))
+
+
+class KeyVaultTokenCacheTest(unittest.TestCase):
+
+    def _callback(self, expires_in=3600, delay=0):
+        calls = []
+
+        def callback(server, resource, scope):
+            time.sleep(delay)
+            calls.append((server, resource, scope))
+            return 'Bearer', _access_token(expires_in, len(calls))
+
+        return callback, calls
+
+    def _authorize(self, auth, resource='https://vault.azure.net'):
+        challenge = MagicMock()
+        challenge.get_authorization_server.return_value = 'https://login.windows.net/tenant'
+        challenge.get_resource.return_value = resource
+        challenge.get_scope.return_value = ''
+        request = MagicMock(headers={})
+        auth.set_authorization_header(request, challenge)
+        return request.headers['Authorization']
+
+    def test_token_is_cached_per_resource(self):
+        callback, calls = self._callback()
+        auth = KeyVaultAuthBase(callback)
+
+        first = [self._authorize(auth) for _ in range(3)]
+        other = [self._authorize(auth, 'https://other.azure.net') for _ in range(3)]
+
+        self.assertEqual(len(set(first)), 1)
+        self.assertEqual(len(set(other)), 1)
+        self.assertNotEqual(first[0], other[0])
+        self.assertEqual([resource for _, resource, _ in calls], ['https://vault.azure.net', 'https://other.azure.net'])
+
+    def test_acquisition_is_single_flight(self):
+        callback, calls = self._callback(delay=0.2)
+        auth = KeyVaultAuthBase(callback)
+        headers = []
+
+        threads = [threading.Thread(target=lambda: headers.append(self._authorize(auth))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(headers)), 1)
+
+    def test_token_is_refreshed_before_expiry(self):
+        callback, calls = self._callback(expires_in=120)
+        auth = KeyVaultAuthBase(callback, refresh_margin=300)
+
+        first = self._authorize(auth)
+        # the token is still valid, it is returned while a new one is acquired in the background
+        self.assertEqual(self._authorize(auth), first)
+        deadline = time.time() + 5
+        while auth._tokens.background_refreshes < 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(calls), 2)
+        self.assertNotEqual(self._authorize(auth), first)
+
+    def test_expired_and_opaque_tokens_are_not_reused(self):
+        callback, calls = self._callback(expires_in=10)
+        auth = KeyVaultAuthBase(callback)
+        self._authorize(auth)
+        self._authorize(auth)
+        self.assertEqual(len(calls), 2)
+
+        auth = KeyVaultAuthBase(lambda server, resource, scope: ('Bearer', 'opaque'))
+        self.assertEqual(self._authorize(auth), 'Bearer opaque')
+        self.assertEqual(auth._tokens.acquisitions, 1)
+        self._authorize(auth)
+        self.assertEqual(auth._tokens.acquisitions, 2)
+
+    def test_credentials_switch_resources_once(self):
+        credentials = MagicMock(resource='https://management.azure.com')
+        credentials.token = {'token_type': 'Bearer', 'access_token': _access_token(3600)}
+
+        def set_token():
+            credentials.token = {'token_type': 'Bearer', 'access_token': _access_token(
+                3600, '{}#{}'.format(credentials.resource, credentials.set_token.call_count))}
+
+        credentials.set_token.side_effect = set_token
+        auth = KeyVaultAuthentication(credentials=credentials).auth
+
+        vault_token = self._authorize(auth)
+        self._authorize(auth, 'https://other.azure.net')
+        self.assertEqual(self._authorize(auth), vault_token)
+        self.assertEqual(credentials.set_token.call_count, 2)
+
+        # a rejected token is set again even though it didn't expire
+        auth._tokens.invalidate('https://login.windows.net/tenant', 'https://vault.azure.net', '',
+                                vault_token.split(' ')[1])
+        self.assertNotEqual(self._authorize(auth), vault_token)
+        self.assertEqual(credentials.set_token.call_count, 3)
+
+
+class KeyVaultChallengeTest(unittest.TestCase):
+
+    _challenge = 'Bearer authorization="https://login.windows.net/tenant", resource="https://vault.azure.net"'
+
+    def setUp(self):
+        HttpBearerChallengeCache.clear()
+        self.calls = []
+
+    def tearDown(self):
+        HttpBearerChallengeCache.clear()
+
+    def _callback(self, server, resource, scope):
+        self.calls.append((server, resource, scope))
+        return 'Bearer', 'token'
+
+    def _request(self, method='GET', data=None):
+        import requests
+        url = 'https://myvault.vault.azure.net/secrets/s?api-version=2016-10-01'
+        return requests.Request(method, url, data=data).prepare()
+
+    def _probe_session(self, status_code=401):
+        session = MagicMock()
+        session.get.return_value = MagicMock(status_code=status_code, headers={'www-authenticate': self._challenge})
+        return session
+
+    def test_pre_seeded_challenge(self):
+        auth = KeyVaultAuthBase(self._callback, authority='https://login.windows.net/tenant')
+        request = auth(self._request())
+
+        self.assertEqual(request.headers['Authorization'], 'Bearer token')
+        self.assertEqual(self.calls, [('https://login.windows.net/tenant', 'https://vault.azure.net', '')])
+        self.assertIsNotNone(HttpBearerChallengeCache.get_challenge_for_url(request.url))
+
+    def test_large_body_discovers_challenge_first(self):
+        auth = KeyVaultAuthBase(self._callback)
+        auth._probe_session = self._probe_session()
+
+        request = auth(self._request('PUT', b'x' * (64 * 1024)))
+
+        self.assertEqual(request.headers['Authorization'], 'Bearer token')
+        probe_url = auth._probe_session.get.call_args[0][0]
+        self.assertEqual(probe_url, 'https://myvault.vault.azure.net/keys?api-version=2016-10-01')
+
+    def test_probe_uses_client_configuration(self):
+        import requests
+        credentials = KeyVaultAuthentication(self._callback)
+        client = KeyVaultClient(credentials)
+        client.config.connection.verify = '/path/to/ca.pem'
+        client.config.proxies.add('https', 'http://proxy:8080')
+        client.config.add_user_agent('myapp/1.0')
+        probe = MagicMock(status_code=401, headers={'www-authenticate': self._challenge})
+
+        with patch.object(requests.Session, 'request', return_value=probe) as request:
+            challenge = credentials.auth.discover_challenge('https://myvault.vault.azure.net/secrets/s')
+
+        self.assertEqual(challenge.get_resource(), 'https://vault.azure.net')
+        args, kwargs = request.call_args
+        self.assertEqual(args[:2], ('GET', 'https://myvault.vault.azure.net/keys'))
+        self.assertEqual(kwargs['verify'], '/path/to/ca.pem')
+        self.assertEqual(kwargs['proxies'], {'https': 'http://proxy:8080'})
+        self.assertIn('myapp/1.0', kwargs['headers']['User-Agent'])
+        self.assertFalse(kwargs['allow_redirects'])
+
+    def test_small_body_gets_challenge_from_response(self):
+        auth = KeyVaultAuthBase(self._callback)
+        auth._probe_session = self._probe_session()
+
+        request = auth(self._request('PUT', b'x' * 100))
+
+        self.assertNotIn('Authorization', request.headers)
+        auth._probe_session.get.assert_not_called()
+
+    def test_retry_reuses_serialized_body(self):
+        auth = KeyVaultAuthBase(self._callback)
+        body = b'x' * 100
+        request = auth(self._request('PUT', body))
+        response = MagicMock(status_code=401, headers={'www-authenticate': self._challenge}, request=request)
+        response.connection.send.return_value = MagicMock(history=[])
+
+        auth.handle_401(response)
+
+        retried = response.connection.send.call_args[0][0]
+        self.assertIs(retried.body, request.body)
+        self.assertEqual(retried.headers['Authorization'], 'Bearer token')
+
+    def test_only_401_round_trips_are_counted(self):
+        metrics = HttpBearerChallengeCache.get_metrics()
+        auth = KeyVaultAuthBase(self._callback, authority='https://login.windows.net/tenant')
+        request = auth(self._request())
+        self.assertEqual(HttpBearerChallengeCache.get_metrics()['challenges'], metrics['challenges'])
+
+        response = MagicMock(status_code=401, headers={'www-authenticate': self._challenge}, request=request)
+        response.connection.send.return_value = MagicMock(history=[])
+        auth.handle_401(response)
+
+        new_metrics = HttpBearerChallengeCache.get_metrics()
+        self.assertEqual(new_metrics['challenges'] - metrics['challenges'], 1)
+        self.assertEqual(new_metrics['updates'] - metrics['updates'], 2)
+
+    def test_rejected_token_is_not_reused(self):
+        tokens = iter([_access_token(3600, 1), _access_token(3600, 2)])
+        auth = KeyVaultAuthBase(lambda server, resource, scope: ('Bearer', next(tokens)))
+        HttpBearerChallengeCache.set_challenge_for_url(
+            self._request().url, HttpBearerChallenge(self._request().url, self._challenge))
+        request = auth(self._request())
+        first = request.headers['Authorization']
+
+        # the vault rejects the first token although it didn't expire, e.g. it was revoked
+        response = MagicMock(status_code=401, headers={'www-authenticate': self._challenge}, request=request)
+        response.connection.send.return_value = MagicMock(history=[])
+        auth.handle_401(response)
+
+        retried = response.connection.send.call_args[0][0]
+        self.assertNotEqual(retried.headers['Authorization'], first)
+        self.assertEqual(auth(self._request()).headers['Authorization'], retried.headers['Authorization'])
+        self.assertEqual(auth._tokens.acquisitions, 2)
+
+
 class KeyVaultKeyTest(AzureKeyVaultTestCase):
 
     def setUp(self):
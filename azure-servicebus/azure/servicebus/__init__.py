@@ -22,11 +22,18 @@ from .constants import (
     AZURE_SERVICEBUS_ISSUER,
     SERVICE_BUS_HOST_BASE,
     DEFAULT_HTTP_TIMEOUT,
+    DEFAULT_HTTP_POOL_MAXSIZE,
+    DEFAULT_HTTP_IDLE_TIMEOUT,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_SAS_TOKEN_LIFETIME,
+    DEFAULT_SAS_TOKEN_REFRESH_MARGIN,
 )
 
 from .models import (
     AzureServiceBusPeekLockError,
     AzureServiceBusResourceNotFound,
+    AzureServiceBusBatchSendError,
     Queue,
     Topic,
     Subscription,
@@ -37,3 +44,5 @@ from .models import (
 )
 
 from .servicebusservice import ServiceBusService
+from .receiver import MessageReceiver
+from .sender import MessageBatchSender, EventHubSender
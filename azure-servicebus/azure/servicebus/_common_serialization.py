@@ -18,12 +18,12 @@ import sys
 import types
 import warnings
 
+from io import BytesIO
+
 if sys.version_info < (3,):
-    from cStringIO import StringIO
     from urllib2 import quote as url_quote
     from urllib2 import unquote as url_unquote
 else:
-    from io import StringIO
     from urllib.parse import quote as url_quote
     from urllib.parse import unquote as url_unquote
 
@@ -62,6 +62,10 @@ _etree_entity_feed_namespaces = {
 }
 
 
+_ATOM_ENTRY_TAG = '{' + _etree_entity_feed_namespaces['atom'] + '}entry'
+_ATOM_FEED_TAG = '{' + _etree_entity_feed_namespaces['atom'] + '}feed'
+
+
 def _make_etree_ns_attr_name(ns, name):
     return '{' + ns + '}' + name
 
@@ -123,27 +127,31 @@ def _convert_class_to_xml(source, xml_prefix=True):
     if source is None:
         return ''
 
-    xmlstr = ''
+    parts = []
     if xml_prefix:
-        xmlstr = '<?xml version="1.0" encoding="utf-8"?>'
+        parts.append('<?xml version="1.0" encoding="utf-8"?>')
+    _write_class_to_xml(source, parts)
+    return ''.join(parts)
+
 
+def _write_class_to_xml(source, parts):
     if isinstance(source, list):
         for value in source:
-            xmlstr += _convert_class_to_xml(value, False)
+            _write_class_to_xml(value, parts)
     elif isinstance(source, WindowsAzureData):
         class_name = source.__class__.__name__
-        xmlstr += '<' + class_name + '>'
+        parts.append('<' + class_name + '>')
         for name, value in vars(source).items():
             if value is not None:
                 if isinstance(value, list) or \
                     isinstance(value, WindowsAzureData):
-                    xmlstr += _convert_class_to_xml(value, False)
+                    _write_class_to_xml(value, parts)
                 else:
-                    xmlstr += ('<' + _get_serialization_name(name) + '>' +
-                               xml_escape(str(value)) + '</' +
-                               _get_serialization_name(name) + '>')
-        xmlstr += '</' + class_name + '>'
-    return xmlstr
+                    serialization_name = _get_serialization_name(name)
+                    parts.append('<' + serialization_name + '>' +
+                                 xml_escape(str(value)) + '</' +
+                                 serialization_name + '>')
+        parts.append('</' + class_name + '>')
 
 
 def _set_continuation_from_response_headers(feeds, response):
@@ -262,21 +270,47 @@ class _ETreeXmlToObject(object):
 
         _set_continuation_from_response_headers(feeds, response)
 
-        root = ETree.fromstring(response.body)
+        feeds.extend(_ETreeXmlToObject.iter_feed_entries(response.body, convert_func))
 
-        # some feeds won't have the 'feed' element, just a single 'entry' element
-        root_name = _get_etree_tag_name_without_ns(root.tag)
-        if root_name == 'feed':
-            entries = root.findall("./atom:entry", _etree_entity_feed_namespaces)
-        elif root_name == 'entry':
-            entries = [root]
-        else:
-            raise NotImplementedError()
+        return feeds
 
-        for entry in entries:
-            feeds.append(convert_func(entry))
 
-        return feeds
+    @staticmethod
+    def iter_feed_entries(body, convert_func):
+        '''
+        Parses an Atom feed incrementally and yields convert_func(entry) for
+        each entry as soon as it is parsed. Converted entries are dropped from
+        the tree, so the memory used doesn't grow with the number of entries.
+
+        body:
+            The feed, as bytes or as a file-like object.
+        convert_func:
+            Function converting an entry element to an object.
+        '''
+        if isinstance(body, bytes):
+            body = BytesIO(body)
+
+        root = None
+        depth = 0
+        for event, element in ETree.iterparse(body, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                    # some feeds won't have the 'feed' element, just a
+                    # single 'entry' element
+                    if element.tag not in (_ATOM_FEED_TAG, _ATOM_ENTRY_TAG):
+                        raise NotImplementedError()
+                depth += 1
+                continue
+
+            depth -= 1
+            if element.tag != _ATOM_ENTRY_TAG:
+                continue
+            if depth == 0:
+                yield convert_func(element)
+            elif depth == 1 and root.tag == _ATOM_FEED_TAG:
+                yield convert_func(element)
+                root.remove(element)
 
 
     @staticmethod
@@ -474,45 +508,42 @@ class _ETreeXmlToObject(object):
 
 class _XmlWriter(object):
 
+    '''
+    Writes an xml document. The parts of the document are accumulated in a
+    list, and joined once by xml().
+    '''
+
     def __init__(self, indent_string=None):
-        self.file = StringIO()
+        self._parts = []
+        self._write = self._parts.append
         self.indent_level = 0
         self.indent_string = indent_string
 
     def _before_element(self, indent_change):
         if self.indent_string:
             self.indent_level += indent_change
-            self.file.write(self.indent_string * self.indent_level)
+            self._write(self.indent_string * self.indent_level)
 
     def _after_element(self, indent_change):
         if self.indent_string:
-            self.file.write('\n')
+            self._write('\n')
             self.indent_level += indent_change
 
     def _write_attrs(self, attrs):
+        write = self._write
         for attr_name, attr_val, attr_conv in attrs:
             if attr_val is not None:
-                self.file.write(' ')
-                self.file.write(attr_name)
-                self.file.write('="')
                 val = attr_conv(_str(attr_val)) if attr_conv else _str(attr_val)
-                val = xml_escape(val)
-                self.file.write(val)
-                self.file.write('"')
+                write(' ' + attr_name + '="' + xml_escape(val) + '"')
 
     def element(self, name, val, val_conv=None, attrs=None):
         self._before_element(0)
-        self.file.write('<')
-        self.file.write(name)
+        write = self._write
+        write('<' + name)
         if attrs:
             self._write_attrs(attrs)
-        self.file.write('>')
         val = val_conv(_str(val)) if val_conv else _str(val)
-        val = xml_escape(val)
-        self.file.write(val)
-        self.file.write('</')
-        self.file.write(name)
-        self.file.write('>')
+        write('>' + xml_escape(val) + '</' + name + '>')
         self._after_element(0)
 
     def elements(self, name_val_convs):
@@ -522,27 +553,24 @@ class _XmlWriter(object):
 
     def preprocessor(self, text):
         self._before_element(0)
-        self.file.write(text)
+        self._write(text)
         self._after_element(0)
 
     def start(self, name, attrs=None):
         self._before_element(0)
-        self.file.write('<')
-        self.file.write(name)
+        self._write('<' + name)
         if attrs:
             self._write_attrs(attrs)
-        self.file.write('>')
+        self._write('>')
         self._after_element(1)
 
     def end(self, name):
         self._before_element(-1)
-        self.file.write('</')
-        self.file.write(name)
-        self.file.write('>')
+        self._write('</' + name + '>')
         self._after_element(0)
 
     def xml(self):
-        return self.file.getvalue()
+        return ''.join(self._parts)
 
     def close(self):
-        self.file.close()
+        del self._parts[:]
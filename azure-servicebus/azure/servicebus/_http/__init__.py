@@ -67,6 +67,9 @@ class HTTPRequest(object):
     protocol_override:
         specify to use this protocol instead of the global one stored in
         _HTTPClient.
+    stream:
+        return the body of a successful response as a file-like object,
+        instead of reading it.
     '''
 
     def __init__(self):
@@ -77,3 +80,4 @@ class HTTPRequest(object):
         self.headers = []    # list of (header name, header value)
         self.body = ''
         self.protocol_override = None
+        self.stream = False
@@ -15,6 +15,8 @@
 import base64
 import os
 import sys
+import threading
+import time
 
 if sys.version_info < (3,):
     from httplib import (
@@ -32,7 +34,12 @@ else:
     from urllib.parse import quote as url_quote
 
 from . import HTTPError, HTTPResponse
-from .requestsclient import _RequestsConnection
+from .requestsclient import (
+    _RequestsConnection,
+    _close_idle_connections,
+    _configure_session,
+    _configure_session_proxy,
+)
 
 
 DEBUG_REQUESTS = False
@@ -45,7 +52,8 @@ class _HTTPClient(object):
     '''
 
     def __init__(self, service_instance, cert_file=None, protocol='https',
-                 request_session=None, timeout=65, user_agent=''):
+                 request_session=None, timeout=65, user_agent='',
+                 pool_maxsize=None, idle_timeout=None):
         '''
         service_instance:
             service client instance.
@@ -60,6 +68,12 @@ class _HTTPClient(object):
             timeout for the http request, in seconds.
         user_agent:
             user agent string to set in http header.
+        pool_maxsize:
+            maximum number of keep-alive connections kept open per host. If
+            None, the adapters already mounted on the session are used.
+        idle_timeout:
+            number of seconds without any request after which the pooled
+            connections are closed rather than reused. None never evicts.
         '''
         self.service_instance = service_instance
         self.cert_file = cert_file
@@ -71,6 +85,12 @@ class _HTTPClient(object):
         self.request_session = request_session
         self.timeout = timeout
         self.user_agent = user_agent
+        self.idle_timeout = idle_timeout
+        self._last_request_time = None
+        self._idle_lock = threading.Lock()
+
+        if self.request_session is not None:
+            _configure_session(self.request_session, pool_maxsize=pool_maxsize)
 
     def set_proxy(self, host, port, user, password):
         '''
@@ -90,6 +110,17 @@ class _HTTPClient(object):
         self.proxy_user = user
         self.proxy_password = password
 
+        if self.request_session is not None:
+            _configure_session_proxy(
+                self.request_session, host, int(port), self._get_proxy_headers())
+
+    def _get_proxy_headers(self):
+        if self.proxy_user and self.proxy_password:
+            auth = base64.b64encode(
+                "{0}:{1}".format(self.proxy_user, self.proxy_password).encode())
+            return {'Proxy-Authorization': 'Basic {0}'.format(auth.decode())}
+        return None
+
     def get_uri(self, request):
         ''' Return the target uri for the request.'''
         protocol = request.protocol_override \
@@ -104,22 +135,12 @@ class _HTTPClient(object):
             if request.protocol_override else self.protocol
         protocol = protocol.lower()
         target_host = request.host
-        target_port = HTTP_PORT if protocol == 'http' else HTTPS_PORT
 
-        connection = _RequestsConnection(
+        # The connection only holds the state of a single request, the
+        # sockets are pooled and kept alive by the shared session.
+        # Proxy settings are applied to the session once, in set_proxy.
+        return _RequestsConnection(
             target_host, protocol, self.request_session, self.timeout)
-        proxy_host = self.proxy_host
-        proxy_port = self.proxy_port
-
-        if self.proxy_host:
-            headers = None
-            if self.proxy_user and self.proxy_password:
-                auth = base64.encodestring(
-                    "{0}:{1}".format(self.proxy_user, self.proxy_password).encode()).rstrip()
-                headers = {'Proxy-Authorization': 'Basic {0}'.format(auth.decode())}
-            connection.set_tunnel(proxy_host, int(proxy_port), headers)
-
-        return connection
 
     def send_request_headers(self, connection, request_headers):
         if self.proxy_host and self.request_session is None:
@@ -171,9 +192,24 @@ class _HTTPClient(object):
 
         return request.path, request.query
 
+    def _evict_idle_connections(self):
+        '''Drops the pooled connections if the client has been idle for longer
+        than idle_timeout. Load balancers silently drop idle connections, and
+        reusing one of them would fail the request.'''
+        with self._idle_lock:
+            now = time.time()
+            idle = self.idle_timeout is not None and \
+                self._last_request_time is not None and \
+                now - self._last_request_time > self.idle_timeout
+            self._last_request_time = now
+        if idle:
+            _close_idle_connections(self.request_session)
+
     def perform_request(self, request):
         ''' Sends request to cloud service server and return the response. '''
+        self._evict_idle_connections()
         connection = self.get_connection(request)
+        connection.stream = request.stream
         try:
             connection.putrequest(request.method, request.path)
 
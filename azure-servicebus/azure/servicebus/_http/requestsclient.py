@@ -12,30 +12,183 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #--------------------------------------------------------------------------
+import threading
+
+from requests.exceptions import (
+    ConnectionError,
+    ContentDecodingError,
+    ReadTimeout,
+    SSLError,
+)
+from requests.packages.urllib3.exceptions import (
+    DecodeError,
+    ProtocolError,
+    ReadTimeoutError,
+    SSLError as _Urllib3SSLError,
+)
+
+# Serializes the evictions of the clients sharing a session.
+_evict_lock = threading.Lock()
+
+
+def _read_raw(raw, amt=None):
+    '''
+    Reads the body of a urllib3 response, raising the requests exceptions
+    that response.content would raise when the connection fails mid-body.
+    '''
+    try:
+        return raw.read(amt)
+    except ReadTimeoutError as ex:
+        raise ReadTimeout(ex)
+    except _Urllib3SSLError as ex:
+        raise SSLError(ex)
+    except ProtocolError as ex:
+        raise ConnectionError(ex)
+    except DecodeError as ex:
+        raise ContentDecodingError(ex)
+
+
+class _StreamBody(object):
+
+    ''' File-like body of a streamed response, read from the connection on
+    demand. '''
+
+    def __init__(self, raw):
+        self._raw = raw
+
+    def read(self, amt=None):
+        return _read_raw(self._raw, amt)
+
+    def close(self):
+        self._raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
 
 class _Response(object):
 
     ''' Response class corresponding to the response returned from httplib
     HTTPConnection. '''
 
-    def __init__(self, response):
+    def __init__(self, response, stream=False):
         self.status = response.status_code
         self.reason = response.reason
-        self.respbody = response.content
-        self.length = len(response.content)
         self.headers = []
         for key, name in response.headers.items():
             self.headers.append((key.lower(), name))
 
+        # The body is read from the raw response in a single buffer, instead
+        # of joining the chunks of response.content, which would double the
+        # memory used by large bodies.
+        response.raw.decode_content = True
+        if stream and self.status < 300 and self.status != 204 and \
+                response.headers.get('content-length') != '0':
+            # the connection goes back to the pool once the body is read
+            self.respbody = _StreamBody(response.raw)
+            self.length = None
+        else:
+            self.respbody = _read_raw(response.raw)
+            self.length = len(self.respbody)
+
     def getheaders(self):
         '''Returns response headers.'''
         return self.headers
 
-    def read(self, _length):
-        '''Returns response body. '''
+    def read(self, _length=None):
+        '''Returns response body, or the file-like body in stream mode. '''
+        if self.length is None:
+            return self.respbody if _length is None else self.respbody.read(_length)
+        if _length is None or _length >= self.length:
+            return self.respbody
         return self.respbody[:_length]
 
 
+def _configure_session(session, pool_connections=None, pool_maxsize=None):
+    '''
+    Prepares a requests session to be shared by every request of a client.
+
+    session:
+        session object created with requests library (or compatible).
+    pool_connections:
+        Optional. Number of per-host connection pools to cache.
+    pool_maxsize:
+        Optional. Maximum number of keep-alive connections to keep in each
+        per-host pool.
+
+    The pools of the HTTPAdapters mounted on the session are resized rather
+    than replaced, so that their retries and other settings are kept.
+    Other transport adapters are left as they are.
+    '''
+    # By default, requests adds an Accept:*/* to the session, which causes
+    # issues with some Azure REST APIs. Removing it here gives us the flexibility
+    # to add it back on a case by case basis via putheader.
+    if 'Accept' in session.headers:
+        del session.headers['Accept']
+
+    if pool_connections or pool_maxsize:
+        from requests.adapters import HTTPAdapter
+        resized = set()
+        for adapter in list(session.adapters.values()):
+            if not isinstance(adapter, HTTPAdapter) or id(adapter) in resized:
+                continue
+            resized.add(id(adapter))
+            adapter.poolmanager.clear()
+            adapter.init_poolmanager(
+                pool_connections or adapter._pool_connections,
+                pool_maxsize or adapter._pool_maxsize,
+                block=adapter._pool_block)
+
+
+def _configure_session_proxy(session, host, port=None, headers=None):
+    '''
+    Routes every request of the session through the proxy.
+
+    host:
+        Address of the proxy.
+    port:
+        Port of the proxy.
+    headers:
+        Optional. Headers to send to the proxy, such as Proxy-Authorization.
+    '''
+    session.proxies['http'] = 'http://{}:{}'.format(host, port)
+    session.proxies['https'] = 'https://{}:{}'.format(host, port)
+    if headers:
+        session.headers.update(headers)
+
+
+def _close_idle_connections(session):
+    '''Closes the keep-alive connections pooled by the session adapters.
+    New connections are opened on demand by the next request.
+
+    The session may be shared with other clients and threads, so only the
+    connections waiting in the urllib3 pools are closed. Connections checked
+    out by in-flight requests are not in the pools and are left untouched.'''
+    with _evict_lock:
+        for adapter in list(session.adapters.values()):
+            pool_manager = getattr(adapter, 'poolmanager', None)
+            if pool_manager is None:
+                continue
+            for key in pool_manager.pools.keys():
+                pool = pool_manager.pools.get(key)
+                if pool is not None:
+                    _close_pooled_connections(pool)
+
+
+def _close_pooled_connections(pool):
+    '''Closes the idle connections of a urllib3 connection pool. They stay in
+    the pool, and reconnect when they are next checked out.'''
+    queue = pool.pool
+    if queue is None:
+        return
+    # holding the queue mutex prevents a request from checking out a
+    # connection while it is being closed
+    with queue.mutex:
+        for connection in queue.queue:
+            if connection is not None:
+                connection.close()
+
+
 class _RequestsConnection(object):
 
     def __init__(self, host, protocol, session, timeout):
@@ -48,21 +201,15 @@ class _RequestsConnection(object):
         self.response = None
         self.uri = None
         self.timeout = timeout
-
-        # By default, requests adds an Accept:*/* to the session, which causes
-        # issues with some Azure REST APIs. Removing it here gives us the flexibility
-        # to add it back on a case by case basis via putheader.
-        if 'Accept' in self.session.headers:
-            del self.session.headers['Accept']
+        self.stream = False
 
     def close(self):
+        # The underlying socket belongs to the session's connection pool and
+        # is kept alive for the next request, so there is nothing to release.
         pass
 
     def set_tunnel(self, host, port=None, headers=None):
-        self.session.proxies['http'] = 'http://{}:{}'.format(host, port)
-        self.session.proxies['https'] = 'https://{}:{}'.format(host, port)
-        if headers:
-            self.session.headers.update(headers)
+        _configure_session_proxy(self.session, host, port, headers)
 
     def set_proxy_credentials(self, user, password):
         pass
@@ -78,7 +225,7 @@ class _RequestsConnection(object):
         pass
 
     def send(self, request_body):
-        self.response = self.session.request(self.method, self.uri, data=request_body, headers=self.headers, timeout=self.timeout)
+        self.response = self.session.request(self.method, self.uri, data=request_body, headers=self.headers, timeout=self.timeout, stream=True)
 
     def getresponse(self):
-        return _Response(self.response)
+        return _Response(self.response, self.stream)
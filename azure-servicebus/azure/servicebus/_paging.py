@@ -0,0 +1,89 @@
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import sys
+import threading
+
+if sys.version_info < (3,):
+    from Queue import Queue, Full
+else:
+    from queue import Queue, Full
+
+
+_ERROR_PAGE_SIZE = 'page_size must be greater than 0.'
+
+
+def _iter_pages(get_page, page_size):
+    '''
+    Returns an iterator over the pages returned by get_page(skip, top), which
+    stops after the first page with less than page_size items.
+    '''
+    if page_size < 1:
+        raise ValueError(_ERROR_PAGE_SIZE)
+
+    def pages():
+        skip = 0
+        while True:
+            page = get_page(skip, page_size)
+            yield page
+            if len(page) < page_size:
+                return
+            skip += page_size
+
+    return pages()
+
+
+def _prefetch(iterable, count):
+    '''
+    Iterates over iterable in a background thread, running up to count items
+    ahead of the caller. The thread stops after its current item once the
+    caller stops iterating (the generator is closed or garbage collected).
+    An exception raised by iterable is raised to the caller in order.
+    '''
+    items = Queue(count)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(item, True):
+                    return
+        except Exception as ex:
+            _put(ex, False)
+            return
+        _put(None, False)
+
+    def _put(item, is_item):
+        while not stopped.is_set():
+            try:
+                items.put((is_item, item), timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            is_item, item = items.get()
+            if not is_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -32,3 +32,22 @@ SERVICE_BUS_HOST_BASE = '.servicebus.windows.net'
 
 # Default timeout for http requests (in secs)
 DEFAULT_HTTP_TIMEOUT = 65
+
+# Default number of keep-alive connections pooled per host
+DEFAULT_HTTP_POOL_MAXSIZE = 10
+
+# Default idle time after which pooled connections are dropped (in secs).
+# Kept below the 4 minutes idle timeout of the Azure load balancers.
+DEFAULT_HTTP_IDLE_TIMEOUT = 230
+
+# Default number of entities requested per page when enumerating them
+DEFAULT_PAGE_SIZE = 100
+
+# Maximum size of a batch of messages, for the Standard tier (in bytes)
+DEFAULT_MAX_BATCH_SIZE = 256 * 1024
+
+# Default validity of the SAS tokens (in secs)
+DEFAULT_SAS_TOKEN_LIFETIME = 300
+
+# Default time before expiry at which a cached SAS token is renewed (in secs)
+DEFAULT_SAS_TOKEN_REFRESH_MARGIN = 60
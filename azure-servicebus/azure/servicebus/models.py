@@ -38,6 +38,17 @@ class AzureServiceBusResourceNotFound(AzureException):
     '''Indicates that the resource doesn't exist.'''
 
 
+class AzureServiceBusBatchSendError(AzureException):
+    '''Indicates that batches of messages failed to be sent. `failed` is the
+    list of (list of messages, exception) tuples of the failed batches.'''
+
+    def __init__(self, failed):
+        super(AzureServiceBusBatchSendError, self).__init__(
+            '{0} batches of {1} messages failed to be sent.'.format(
+                len(failed), sum(len(messages) for messages, _ in failed)))
+        self.failed = failed
+
+
 class Queue(WindowsAzureData):
 
     ''' Queue class corresponding to Queue Description:
@@ -199,12 +210,12 @@ class Message(WindowsAzureData):
         ''' Deletes itself if find queue name or topic name and subscription
         name. '''
         if self._queue_name:
-            self.service_bus_service.delete_queue_message(
+            return self.service_bus_service.delete_queue_message(
                 self._queue_name,
                 self.broker_properties['SequenceNumber'],
                 self.broker_properties['LockToken'])
         elif self._topic_name and self._subscription_name:
-            self.service_bus_service.delete_subscription_message(
+            return self.service_bus_service.delete_subscription_message(
                 self._topic_name,
                 self._subscription_name,
                 self.broker_properties['SequenceNumber'],
@@ -216,12 +227,12 @@ class Message(WindowsAzureData):
         ''' Unlocks itself if find queue name or topic name and subscription
         name. '''
         if self._queue_name:
-            self.service_bus_service.unlock_queue_message(
+            return self.service_bus_service.unlock_queue_message(
                 self._queue_name,
                 self.broker_properties['SequenceNumber'],
                 self.broker_properties['LockToken'])
         elif self._topic_name and self._subscription_name:
-            self.service_bus_service.unlock_subscription_message(
+            return self.service_bus_service.unlock_subscription_message(
                 self._topic_name,
                 self._subscription_name,
                 self.broker_properties['SequenceNumber'],
@@ -233,12 +244,12 @@ class Message(WindowsAzureData):
         ''' Renew lock on itself if find queue name or topic name and subscription
         name. '''
         if self._queue_name:
-            self.service_bus_service.renew_lock_queue_message(
+            return self.service_bus_service.renew_lock_queue_message(
                 self._queue_name,
                 self.broker_properties['SequenceNumber'],
                 self.broker_properties['LockToken'])
         elif self._topic_name and self._subscription_name:
-            self.service_bus_service.renew_lock_subscription_message(
+            return self.service_bus_service.renew_lock_subscription_message(
                 self._topic_name,
                 self._subscription_name,
                 self.broker_properties['SequenceNumber'],
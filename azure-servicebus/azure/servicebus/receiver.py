@@ -0,0 +1,318 @@
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import logging
+import sys
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+
+if sys.version_info < (3,):
+    from Queue import Queue, Empty, Full
+else:
+    from queue import Queue, Empty, Full
+
+from ._common_error import (
+    _validate_not_none,
+)
+
+
+_LOGGER = logging.getLogger(__name__)
+
+_ERROR_RECEIVER_ENTITY = \
+    'Specify either queue_name, or topic_name and subscription_name.'
+
+
+class MessageReceiver(object):
+
+    '''
+    Receives peek-locked messages from a queue or a subscription and
+    dispatches them to a pool of handler threads.
+
+    Several peek-lock requests are kept outstanding so that throughput is not
+    bounded by the latency of a single round trip. Received messages are
+    buffered in a bounded queue: when the handlers fall behind, the buffer
+    fills up and the receive requests stop until room is available. The locks
+    of buffered and in-process messages are renewed before they expire.
+
+    When a handler returns, the message is deleted (completed). When it
+    raises, the message is unlocked so that it can be received again.
+
+    The ServiceBusService is shared by all the threads of the receiver, its
+    pool_maxsize should be at least prefetch_count + max_workers.
+    '''
+
+    def __init__(self, service, handler, queue_name=None, topic_name=None,
+                 subscription_name=None, prefetch_count=4, buffer_size=16,
+                 max_workers=4, timeout=60, lock_duration=60,
+                 lock_renewal_margin=10, retry_interval=5):
+        '''
+        service:
+            ServiceBusService used to receive the messages.
+        handler:
+            Callable invoked with each Message, from one of the worker
+            threads.
+        queue_name:
+            Name of the queue to receive from.
+        topic_name:
+            Name of the topic to receive from, with subscription_name.
+        subscription_name:
+            Name of the subscription to receive from, with topic_name.
+        prefetch_count:
+            Number of peek-lock requests kept outstanding.
+        buffer_size:
+            Maximum number of received messages waiting for a handler.
+        max_workers:
+            Number of threads running the handler.
+        timeout:
+            Timeout of each peek-lock request, in seconds.
+        lock_duration:
+            Lock duration of the queue or subscription, in seconds. Used
+            when the service doesn't return the lock expiry of a message.
+        lock_renewal_margin:
+            Number of seconds before the lock expiry at which it is renewed.
+        retry_interval:
+            Number of seconds to wait before receiving again after an error.
+        '''
+        _validate_not_none('service', service)
+        _validate_not_none('handler', handler)
+        if not queue_name and not (topic_name and subscription_name):
+            raise ValueError(_ERROR_RECEIVER_ENTITY)
+
+        self.service = service
+        self.handler = handler
+        self.queue_name = queue_name
+        self.topic_name = topic_name
+        self.subscription_name = subscription_name
+        self.prefetch_count = prefetch_count
+        self.buffer_size = buffer_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.lock_duration = lock_duration
+        self.lock_renewal_margin = lock_renewal_margin
+        self.retry_interval = retry_interval
+
+        self.received = 0
+        self.completed = 0
+        self.abandoned = 0
+        self.lock_renewals = 0
+        self.lock_renewal_failures = 0
+        self._in_flight = 0
+        self._processing = 0
+
+        # Each start has its own stop event and buffer, so that the threads
+        # of a previous start never see a later start as running.
+        self._buffer = Queue(buffer_size)
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._stopped.set()
+        self._threads = []
+
+    @property
+    def in_flight(self):
+        '''Number of peek-lock requests currently outstanding.'''
+        return self._in_flight
+
+    @property
+    def buffered(self):
+        '''Number of received messages waiting for a handler.'''
+        return self._buffer.qsize()
+
+    @property
+    def processing(self):
+        '''Number of messages being handled.'''
+        return self._processing
+
+    @property
+    def metrics(self):
+        '''Returns a snapshot of the receiver counters.'''
+        with self._lock:
+            return {
+                'in_flight': self._in_flight,
+                'buffered': self._buffer.qsize(),
+                'processing': self._processing,
+                'received': self.received,
+                'completed': self.completed,
+                'abandoned': self.abandoned,
+                'lock_renewals': self.lock_renewals,
+                'lock_renewal_failures': self.lock_renewal_failures,
+            }
+
+    def start(self):
+        '''Starts receiving and dispatching messages.'''
+        if not self._stopped.is_set():
+            return self
+        stopped = threading.Event()
+        buffer = Queue(self.buffer_size)
+        self._stopped = stopped
+        self._buffer = buffer
+        self._threads = [self._start_thread(self._receive_loop, stopped, buffer)
+                         for _ in range(self.prefetch_count)]
+        self._threads.extend(self._start_thread(self._worker_loop, stopped, buffer)
+                             for _ in range(self.max_workers))
+        self._threads.append(self._start_thread(self._renew_loop, stopped))
+        return self
+
+    def stop(self, wait=True):
+        '''
+        Stops receiving messages. Buffered messages which were not handled are
+        unlocked, as well as the messages received after stop.
+
+        wait:
+            Wait for the messages being handled to complete, and for the
+            outstanding peek-lock requests to return, which takes up to
+            timeout seconds.
+        '''
+        stopped = self._stopped
+        buffer = self._buffer
+        stopped.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+        self._abandon_buffered(buffer)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @staticmethod
+    def _start_thread(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _peek_lock(self):
+        if self.queue_name:
+            return self.service.peek_lock_queue_message(
+                self.queue_name, self.timeout)
+        return self.service.peek_lock_subscription_message(
+            self.topic_name, self.subscription_name, self.timeout)
+
+    def _receive_loop(self, stopped, buffer):
+        while not stopped.is_set():
+            with self._lock:
+                self._in_flight += 1
+            try:
+                message = self._peek_lock()
+            except Exception:
+                _LOGGER.warning('Failed to receive a message', exc_info=True)
+                stopped.wait(self.retry_interval)
+                continue
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+            # an empty response means that no message arrived before timeout
+            if message.broker_properties is None:
+                continue
+
+            with self._lock:
+                self.received += 1
+                self._locks[id(message)] = [message, self._get_renewal_time(message)]
+
+            while not stopped.is_set():
+                try:
+                    buffer.put(message, timeout=1)
+                    break
+                except Full:
+                    pass
+            else:
+                self._abandon(message)
+                continue
+
+            # stop may have drained the buffer before the message was put
+            if stopped.is_set():
+                self._abandon_buffered(buffer)
+
+    def _worker_loop(self, stopped, buffer):
+        while not stopped.is_set():
+            try:
+                message = buffer.get(timeout=1)
+            except Empty:
+                continue
+
+            with self._lock:
+                self._processing += 1
+            try:
+                self.handler(message)
+            except Exception:
+                _LOGGER.warning('Message handler failed', exc_info=True)
+                self._abandon(message)
+            else:
+                self._release(message)
+                try:
+                    message.delete()
+                    with self._lock:
+                        self.completed += 1
+                except Exception:
+                    _LOGGER.warning('Failed to complete a message', exc_info=True)
+            finally:
+                with self._lock:
+                    self._processing -= 1
+
+    def _renew_loop(self, stopped):
+        while not stopped.wait(1):
+            now = time.time()
+            with self._lock:
+                due = [message for message, renewal_time in self._locks.values()
+                       if renewal_time <= now]
+            for message in due:
+                try:
+                    message.renew_lock()
+                except Exception:
+                    _LOGGER.warning('Failed to renew a message lock', exc_info=True)
+                    with self._lock:
+                        self.lock_renewal_failures += 1
+                        self._locks.pop(id(message), None)
+                    continue
+                with self._lock:
+                    self.lock_renewals += 1
+                    if id(message) in self._locks:
+                        self._locks[id(message)][1] = \
+                            time.time() + self.lock_duration - self.lock_renewal_margin
+
+    def _get_renewal_time(self, message):
+        locked_until = message.broker_properties.get('LockedUntilUtc')
+        if locked_until:
+            parsed = parsedate_tz(locked_until)
+            if parsed:
+                return mktime_tz(parsed) - self.lock_renewal_margin
+        return time.time() + self.lock_duration - self.lock_renewal_margin
+
+    def _release(self, message):
+        with self._lock:
+            self._locks.pop(id(message), None)
+
+    def _abandon(self, message):
+        self._release(message)
+        try:
+            message.unlock()
+            with self._lock:
+                self.abandoned += 1
+        except Exception:
+            _LOGGER.warning('Failed to unlock a message', exc_info=True)
+
+    def _abandon_buffered(self, buffer):
+        while True:
+            try:
+                message = buffer.get_nowait()
+            except Empty:
+                return
+            self._abandon(message)
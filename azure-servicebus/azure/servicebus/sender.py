@@ -0,0 +1,389 @@
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import json
+import logging
+import sys
+import threading
+import time
+
+if sys.version_info < (3,):
+    from Queue import Queue
+else:
+    from queue import Queue
+
+from .constants import (
+    DEFAULT_MAX_BATCH_SIZE,
+)
+from .models import (
+    AzureServiceBusBatchSendError,
+    Message,
+)
+from ._common_error import (
+    _validate_not_none,
+)
+
+
+_LOGGER = logging.getLogger(__name__)
+
+_ERROR_SENDER_ENTITY = 'Specify either queue_name or topic_name.'
+_ERROR_MESSAGE_TOO_LARGE = \
+    'Message of {0} bytes exceeds the maximum batch size of {1} bytes.'
+_ERROR_SENDER_CLOSED = 'The sender is closed.'
+_ERROR_SENDER_LINGER = 'linger must be greater than 0.'
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.messages = []
+        self.encoded = []
+        # size of the JSON array: brackets, commas and encoded messages
+        self.size = 1
+        self.started = time.time()
+
+
+class _BatchSender(object):
+
+    '''
+    Packs serialized messages into batches of at most max_batch_size bytes,
+    one pending batch per key, and sends the batches from a pool of threads
+    with post, called with the key and the serialized batch.
+    '''
+
+    def __init__(self, service, post, max_batch_size, linger, max_workers,
+                 max_pending_batches):
+        _validate_not_none('service', service)
+        if linger is not None and linger <= 0:
+            raise ValueError(_ERROR_SENDER_LINGER)
+        self.service = service
+        self.max_batch_size = max_batch_size
+        self.linger = linger
+        self._post = post
+
+        self.messages_sent = 0
+        self.batches_sent = 0
+        self.bytes_sent = 0
+        self.failed = []
+        self._unreported_failures = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._first_send_time = None
+        self._last_send_time = None
+
+        self._batches = {}
+        self._closed = False
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._pending = Queue(max_pending_batches or max_workers)
+        self._threads = [self._start_thread(self._send_loop)
+                         for _ in range(max_workers)]
+        if linger is not None:
+            self._start_thread(self._linger_loop)
+
+    @property
+    def metrics(self):
+        '''
+        Returns a snapshot of the sender counters: messages, batches and bytes
+        sent, failed batches, mean and max latency of a batch request in
+        seconds, and messages sent per second since the first batch was sent.
+        '''
+        with self._stats_lock:
+            elapsed = (self._last_send_time or 0) - (self._first_send_time or 0)
+            return {
+                'messages_sent': self.messages_sent,
+                'batches_sent': self.batches_sent,
+                'bytes_sent': self.bytes_sent,
+                'failed_batches': len(self.failed),
+                'mean_batch_latency':
+                    self._total_latency / self.batches_sent if self.batches_sent else None,
+                'max_batch_latency': self._max_latency,
+                'messages_per_second':
+                    self.messages_sent / elapsed if elapsed > 0 else None,
+            }
+
+    def flush(self):
+        '''
+        Sends the current batches and waits for all the batches to be sent.
+        Raises AzureServiceBusBatchSendError with the batches which failed to
+        be sent since the previous flush.
+        '''
+        with self._lock:
+            for key in list(self._batches):
+                self._dispatch(key)
+        self._pending.join()
+        with self._stats_lock:
+            failed = self.failed[len(self.failed) - self._unreported_failures:]
+            self._unreported_failures = 0
+        if failed:
+            raise AzureServiceBusBatchSendError(failed)
+
+    def close(self):
+        '''
+        Flushes the messages and stops the sending threads. Raises
+        AzureServiceBusBatchSendError like flush, once the threads are
+        stopped. Closing a closed sender does nothing.
+        '''
+        with self._lock:
+            if self._closed:
+                return
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._closed = True
+            for _ in self._threads:
+                self._pending.put(None)
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _start_thread(target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _add(self, key, message):
+        encoded = json.dumps(message.as_batch_body()).encode('utf-8')
+        if len(encoded) + 2 > self.max_batch_size:
+            raise ValueError(_ERROR_MESSAGE_TOO_LARGE.format(
+                len(encoded), self.max_batch_size))
+
+        with self._lock:
+            if self._closed:
+                raise ValueError(_ERROR_SENDER_CLOSED)
+            batch = self._batches.get(key)
+            if batch is not None and \
+                    batch.size + len(encoded) + 1 > self.max_batch_size:
+                self._dispatch(key)
+                batch = None
+            if batch is None:
+                batch = self._batches[key] = _Batch()
+            batch.messages.append(message)
+            batch.encoded.append(encoded)
+            batch.size += len(encoded) + 1
+
+    def _dispatch(self, key):
+        batch = self._batches.pop(key)
+        body = b'[' + b','.join(batch.encoded) + b']'
+        self._pending.put((key, batch.messages, body))
+
+    def _send_loop(self):
+        while True:
+            batch = self._pending.get()
+            try:
+                if batch is None:
+                    return
+                key, messages, body = batch
+                start = time.time()
+                try:
+                    self._post(key, body)
+                except Exception as ex:
+                    _LOGGER.warning('Failed to send a batch of %d messages',
+                                    len(messages), exc_info=True)
+                    with self._stats_lock:
+                        self.failed.append((messages, ex))
+                        self._unreported_failures += 1
+                else:
+                    end = time.time()
+                    latency = end - start
+                    with self._stats_lock:
+                        self.messages_sent += len(messages)
+                        self.batches_sent += 1
+                        self.bytes_sent += len(body)
+                        self._total_latency += latency
+                        self._max_latency = max(self._max_latency, latency)
+                        if self._first_send_time is None:
+                            self._first_send_time = start
+                        self._last_send_time = end
+            finally:
+                self._pending.task_done()
+
+    def _linger_loop(self):
+        while True:
+            time.sleep(self.linger / 2.0)
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.time()
+                for key, batch in list(self._batches.items()):
+                    if now - batch.started >= self.linger:
+                        self._dispatch(key)
+
+
+class MessageBatchSender(_BatchSender):
+
+    '''
+    Sends messages to a queue or a topic in batches of maximal size.
+
+    Messages are serialized as they are added, and the current batch is
+    dispatched as soon as the next message would make it exceed
+    max_batch_size. Dispatched batches are sent concurrently by a pool of
+    threads. If linger is set, a partial batch is dispatched once it has
+    waited for linger seconds; otherwise it is dispatched by flush.
+
+    Batches which fail to send are recorded in `failed`, as tuples of
+    (list of messages, exception), and raised by the next flush, send_all or
+    close as an AzureServiceBusBatchSendError.
+    '''
+
+    def __init__(self, service, queue_name=None, topic_name=None,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, linger=None,
+                 max_workers=4, max_pending_batches=None):
+        '''
+        service:
+            ServiceBusService used to send the messages. Its pool_maxsize
+            should be at least max_workers.
+        queue_name:
+            Name of the queue to send to.
+        topic_name:
+            Name of the topic to send to.
+        max_batch_size:
+            Maximum size of the serialized batch, in bytes.
+        linger:
+            Optional. Number of seconds a partial batch waits for more
+            messages before being sent. Must be greater than 0.
+        max_workers:
+            Number of batches sent concurrently.
+        max_pending_batches:
+            Optional. Number of dispatched batches waiting for a thread after
+            which send blocks. Defaults to max_workers.
+        '''
+        if bool(queue_name) == bool(topic_name):
+            raise ValueError(_ERROR_SENDER_ENTITY)
+        self.entity_name = queue_name or topic_name
+        super(MessageBatchSender, self).__init__(
+            service, self._post_batch, max_batch_size, linger, max_workers,
+            max_pending_batches)
+
+    def send(self, message):
+        '''
+        Adds a message to the current batch. Blocks when too many batches are
+        waiting to be sent.
+
+        message:
+            Message object containing message body and properties.
+        '''
+        _validate_not_none('message', message)
+        self._add(None, message)
+
+    def send_all(self, messages):
+        '''
+        Sends all the messages of an iterable, then waits for all the batches
+        to be sent. Raises AzureServiceBusBatchSendError if batches failed to
+        be sent.
+
+        messages:
+            Iterable of message objects, which may be unbounded.
+        '''
+        for message in messages:
+            self.send(message)
+        self.flush()
+
+    def _post_batch(self, key, body):
+        self.service._send_message_batch(self.entity_name, body)
+
+
+class EventHubSender(_BatchSender):
+
+    '''
+    Publishes events to an Event Hub in batches of maximal size.
+
+    Events are grouped by publisher (device_id) and partition key: each
+    group has its own pending batch, so that every batch is posted to a
+    single publisher endpoint with a single partition key. Batches are sent
+    concurrently by a pool of threads, over the pooled connections of the
+    service. The latency of the batch requests and the event throughput are
+    reported by `metrics`.
+
+    Batches which fail to send are recorded in `failed`, as tuples of
+    (list of messages, exception), and raised by the next flush, send_all or
+    close as an AzureServiceBusBatchSendError.
+    '''
+
+    def __init__(self, service, hub_name, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 linger=None, max_workers=8, max_pending_batches=None):
+        '''
+        service:
+            ServiceBusService used to send the events. Its pool_maxsize
+            should be at least max_workers.
+        hub_name:
+            Name of the event hub.
+        max_batch_size:
+            Maximum size of the serialized batch, in bytes.
+        linger:
+            Optional. Number of seconds a partial batch waits for more
+            events before being sent. Must be greater than 0.
+        max_workers:
+            Number of batches sent concurrently.
+        max_pending_batches:
+            Optional. Number of dispatched batches waiting for a thread after
+            which send blocks. Defaults to max_workers.
+        '''
+        _validate_not_none('hub_name', hub_name)
+        self.hub_name = hub_name
+        super(EventHubSender, self).__init__(
+            service, self._post_batch, max_batch_size, linger, max_workers,
+            max_pending_batches)
+
+    def send(self, event, device_id=None, partition_key=None):
+        '''
+        Adds an event to the current batch of its publisher and partition
+        key. Blocks when too many batches are waiting to be sent.
+
+        event:
+            Body of the event, or Message object containing the event body
+            and properties.
+        device_id:
+            Optional. Name of the publisher sending the event.
+        partition_key:
+            Optional. Events with the same partition key are stored in the
+            same partition.
+        '''
+        _validate_not_none('event', event)
+        if not isinstance(event, Message):
+            event = Message(event)
+        if partition_key is not None:
+            broker_properties = dict(event.broker_properties or {})
+            broker_properties['PartitionKey'] = partition_key
+            event = Message(event.body, custom_properties=event.custom_properties,
+                            broker_properties=broker_properties)
+        self._add((device_id, partition_key), event)
+
+    def send_all(self, events, device_id=None, partition_key=None):
+        '''
+        Sends all the events of an iterable, then waits for all the batches
+        to be sent. Raises AzureServiceBusBatchSendError if batches failed to
+        be sent.
+
+        events:
+            Iterable of event bodies or message objects.
+        device_id:
+            Optional. Name of the publisher sending the events.
+        partition_key:
+            Optional. Partition key of the events.
+        '''
+        for event in events:
+            self.send(event, device_id, partition_key)
+        self.flush()
+
+    def _post_batch(self, key, body):
+        self.service._send_event_batch(self.hub_name, body, key[0])
@@ -13,10 +13,14 @@
 # limitations under the License.
 #--------------------------------------------------------------------------
 import datetime
+import logging
 import os
+import threading
 import time
 import json
 
+from collections import OrderedDict
+
 import requests
 
 from azure.common import (
@@ -27,6 +31,11 @@ from .constants import (
     AZURE_SERVICEBUS_ACCESS_KEY,
     AZURE_SERVICEBUS_ISSUER,
     DEFAULT_HTTP_TIMEOUT,
+    DEFAULT_HTTP_POOL_MAXSIZE,
+    DEFAULT_HTTP_IDLE_TIMEOUT,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_SAS_TOKEN_LIFETIME,
+    DEFAULT_SAS_TOKEN_REFRESH_MARGIN,
     SERVICE_BUS_HOST_BASE,
     _USER_AGENT_STRING,
 )
@@ -55,6 +64,10 @@ from ._http import (
     HTTPRequest,
 )
 from ._http.httpclient import _HTTPClient
+from ._paging import (
+    _iter_pages,
+    _prefetch,
+)
 from ._serialization import (
     _convert_event_hub_to_xml,
     _convert_topic_to_xml,
@@ -81,7 +94,8 @@ class ServiceBusService(object):
                  x_ms_version='2011-06-01', host_base=SERVICE_BUS_HOST_BASE,
                  shared_access_key_name=None, shared_access_key_value=None,
                  authentication=None, timeout=DEFAULT_HTTP_TIMEOUT,
-                 request_session=None):
+                 request_session=None, pool_maxsize=None,
+                 idle_timeout=DEFAULT_HTTP_IDLE_TIMEOUT):
         '''
         Initializes the service bus service for a namespace with the specified
         authentication settings (SAS or ACS).
@@ -114,7 +128,18 @@ class ServiceBusService(object):
         timeout:
             Optional. Timeout for the http request, in seconds.
         request_session:
-            Optional. Session object to use for http requests.
+            Optional. Session object to use for http requests. Connections
+            are kept alive and reused across requests through this session.
+        pool_maxsize:
+            Optional. Maximum number of keep-alive connections pooled per
+            host. Size it to the number of threads sharing this service.
+            If None, the session created by the service pools
+            DEFAULT_HTTP_POOL_MAXSIZE connections, and the adapters mounted
+            on request_session are left as they are.
+        idle_timeout:
+            Optional. Number of seconds without any request after which the
+            pooled connections are closed instead of being reused. If None,
+            pooled connections are never evicted.
         '''
         self.requestid = None
         self.service_namespace = service_namespace
@@ -146,11 +171,18 @@ class ServiceBusService(object):
                 raise ValueError(
                     'You need to provide servicebus access key and Issuer OR shared access key and value')
 
+        if request_session is None:
+            request_session = requests.Session()
+            if pool_maxsize is None:
+                pool_maxsize = DEFAULT_HTTP_POOL_MAXSIZE
+
         self._httpclient = _HTTPClient(
             service_instance=self,
             timeout=timeout,
-            request_session=request_session or requests.Session(),
+            request_session=request_session,
             user_agent=_USER_AGENT_STRING,
+            pool_maxsize=pool_maxsize,
+            idle_timeout=idle_timeout,
         )
         self._filter = self._httpclient.perform_request
 
@@ -194,7 +226,10 @@ class ServiceBusService(object):
         '''
         res = ServiceBusService(
             service_namespace=self.service_namespace,
-            authentication=self.authentication)
+            authentication=self.authentication,
+            request_session=self._httpclient.request_session,
+            pool_maxsize=None,
+            idle_timeout=self._httpclient.idle_timeout)
 
         old_filter = self._filter
 
@@ -319,6 +354,22 @@ class ServiceBusService(object):
         return _ETreeXmlToObject.convert_response_to_feeds(
             response, _convert_etree_element_to_queue)
 
+    def iter_queues(self, page_size=DEFAULT_PAGE_SIZE, prefetch_pages=0):
+        '''
+        Lazily enumerates the queues in the service namespace. Queues are
+        requested page by page, only as the iteration progresses.
+
+        page_size:
+            Number of queues requested at a time.
+        prefetch_pages:
+            Number of pages requested ahead, in a background thread, while
+            the caller iterates. If 0, each page is requested when the
+            previous one has been iterated over.
+        '''
+        return self._iter_feed('/$Resources/Queues',
+                               _convert_etree_element_to_queue,
+                               page_size, prefetch_pages)
+
     def create_topic(self, topic_name, topic=None, fail_on_exist=False):
         '''
         Creates a new topic. Once created, this topic resource manifest is
@@ -411,6 +462,22 @@ class ServiceBusService(object):
         return _ETreeXmlToObject.convert_response_to_feeds(
             response, _convert_etree_element_to_topic)
 
+    def iter_topics(self, page_size=DEFAULT_PAGE_SIZE, prefetch_pages=0):
+        '''
+        Lazily enumerates the topics in the service namespace. Topics are
+        requested page by page, only as the iteration progresses.
+
+        page_size:
+            Number of topics requested at a time.
+        prefetch_pages:
+            Number of pages requested ahead, in a background thread, while
+            the caller iterates. If 0, each page is requested when the
+            previous one has been iterated over.
+        '''
+        return self._iter_feed('/$Resources/Topics',
+                               _convert_etree_element_to_topic,
+                               page_size, prefetch_pages)
+
     def create_rule(self, topic_name, subscription_name, rule_name, rule=None,
                     fail_on_exist=False):
         '''
@@ -536,6 +603,30 @@ class ServiceBusService(object):
         return _ETreeXmlToObject.convert_response_to_feeds(
             response, _convert_etree_element_to_rule)
 
+    def iter_rules(self, topic_name, subscription_name,
+                   page_size=DEFAULT_PAGE_SIZE, prefetch_pages=0):
+        '''
+        Lazily enumerates the rules of the specified subscription. Rules are
+        requested page by page, only as the iteration progresses.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        page_size:
+            Number of rules requested at a time.
+        prefetch_pages:
+            Number of pages requested ahead, in a background thread, while
+            the caller iterates. If 0, each page is requested when the
+            previous one has been iterated over.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        return self._iter_feed('/' + _str(topic_name) + '/subscriptions/' +
+                               _str(subscription_name) + '/rules/',
+                               _convert_etree_element_to_rule,
+                               page_size, prefetch_pages)
+
     def create_subscription(self, topic_name, subscription_name,
                             subscription=None, fail_on_exist=False):
         '''
@@ -645,6 +736,27 @@ class ServiceBusService(object):
         return _ETreeXmlToObject.convert_response_to_feeds(
             response, _convert_etree_element_to_subscription)
 
+    def iter_subscriptions(self, topic_name, page_size=DEFAULT_PAGE_SIZE,
+                           prefetch_pages=0):
+        '''
+        Lazily enumerates the subscriptions of the specified topic.
+        Subscriptions are requested page by page, only as the iteration
+        progresses.
+
+        topic_name:
+            Name of the topic.
+        page_size:
+            Number of subscriptions requested at a time.
+        prefetch_pages:
+            Number of pages requested ahead, in a background thread, while
+            the caller iterates. If 0, each page is requested when the
+            previous one has been iterated over.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        return self._iter_feed('/' + _str(topic_name) + '/subscriptions/',
+                               _convert_etree_element_to_subscription,
+                               page_size, prefetch_pages)
+
     def send_topic_message(self, topic_name, message=None):
         '''
         Enqueues a message into the specified topic. The limit to the number
@@ -685,18 +797,12 @@ class ServiceBusService(object):
         '''
         _validate_not_none('topic_name', topic_name)
         _validate_not_none('messages', messages)
-        request = HTTPRequest()
-        request.method = 'POST'
-        request.host = self._get_host()
-        request.path = '/' + _str(topic_name) + '/messages'
-        request.headers.append(('Content-Type', 'application/vnd.microsoft.servicebus.json'))
-        request.body = _get_request_body(json.dumps([m.as_batch_body() for m in messages]))
-        request.path, request.query = self._httpclient._update_request_uri_query(request)
-        request.headers = self._update_service_bus_header(request)
-        self._perform_request(request)
+        self._send_message_batch(
+            topic_name,
+            _get_request_body(json.dumps([m.as_batch_body() for m in messages])))
 
     def peek_lock_subscription_message(self, topic_name, subscription_name,
-                                       timeout='60'):
+                                       timeout='60', stream=False):
         '''
         This operation is used to atomically retrieve and lock a message for
         processing. The message is guaranteed not to be delivered to other
@@ -717,6 +823,10 @@ class ServiceBusService(object):
             Name of the subscription.
         timeout:
             Optional. The timeout parameter is expressed in seconds.
+        stream:
+            Optional. If True, the body of the message is a file-like object
+            read from the connection on demand. Read it entirely, or close
+            it, to release the connection. Use it for large messages.
         '''
         _validate_not_none('topic_name', topic_name)
         _validate_not_none('subscription_name', subscription_name)
@@ -727,6 +837,7 @@ class ServiceBusService(object):
             _str(topic_name) + '/subscriptions/' + \
             _str(subscription_name) + '/messages/head'
         request.query = [('timeout', _int_or_none(timeout))]
+        request.stream = stream
         request.path, request.query = self._httpclient._update_request_uri_query(request)
         request.headers = self._update_service_bus_header(request)
         response = self._perform_request(request)
@@ -801,7 +912,7 @@ class ServiceBusService(object):
         self._perform_request(request)
 
     def read_delete_subscription_message(self, topic_name, subscription_name,
-                                         timeout='60'):
+                                         timeout='60', stream=False):
         '''
         Read and delete a message from a subscription as an atomic operation.
         This operation should be used when a best-effort guarantee is
@@ -814,6 +925,10 @@ class ServiceBusService(object):
             Name of the subscription.
         timeout:
             Optional. The timeout parameter is expressed in seconds.
+        stream:
+            Optional. If True, the body of the message is a file-like object
+            read from the connection on demand. Read it entirely, or close
+            it, to release the connection. Use it for large messages.
         '''
         _validate_not_none('topic_name', topic_name)
         _validate_not_none('subscription_name', subscription_name)
@@ -824,6 +939,7 @@ class ServiceBusService(object):
                        '/subscriptions/' + _str(subscription_name) + \
                        '/messages/head'
         request.query = [('timeout', _int_or_none(timeout))]
+        request.stream = stream
         request.path, request.query = self._httpclient._update_request_uri_query(request)
         request.headers = self._update_service_bus_header(request)
         response = self._perform_request(request)
@@ -904,17 +1020,11 @@ class ServiceBusService(object):
         '''
         _validate_not_none('queue_name', queue_name)
         _validate_not_none('messages', messages)
-        request = HTTPRequest()
-        request.method = 'POST'
-        request.host = self._get_host()
-        request.path = '/' + _str(queue_name) + '/messages'
-        request.headers.append(('Content-Type', 'application/vnd.microsoft.servicebus.json'))
-        request.body = _get_request_body(json.dumps([m.as_batch_body() for m in messages]))
-        request.path, request.query = self._httpclient._update_request_uri_query(request)
-        request.headers = self._update_service_bus_header(request)
-        self._perform_request(request)
+        self._send_message_batch(
+            queue_name,
+            _get_request_body(json.dumps([m.as_batch_body() for m in messages])))
 
-    def peek_lock_queue_message(self, queue_name, timeout='60'):
+    def peek_lock_queue_message(self, queue_name, timeout='60', stream=False):
         '''
         Automically retrieves and locks a message from a queue for processing.
         The message is guaranteed not to be delivered to other receivers (on
@@ -930,6 +1040,10 @@ class ServiceBusService(object):
             Name of the queue.
         timeout:
             Optional. The timeout parameter is expressed in seconds.
+        stream:
+            Optional. If True, the body of the message is a file-like object
+            read from the connection on demand. Read it entirely, or close
+            it, to release the connection. Use it for large messages.
         '''
         _validate_not_none('queue_name', queue_name)
         request = HTTPRequest()
@@ -937,6 +1051,7 @@ class ServiceBusService(object):
         request.host = self._get_host()
         request.path = '/' + _str(queue_name) + '/messages/head'
         request.query = [('timeout', _int_or_none(timeout))]
+        request.stream = stream
         request.path, request.query = self._httpclient._update_request_uri_query(request)
         request.headers = self._update_service_bus_header(request)
         response = self._perform_request(request)
@@ -1000,7 +1115,7 @@ class ServiceBusService(object):
         request.headers = self._update_service_bus_header(request)
         self._perform_request(request)
 
-    def read_delete_queue_message(self, queue_name, timeout='60'):
+    def read_delete_queue_message(self, queue_name, timeout='60', stream=False):
         '''
         Reads and deletes a message from a queue as an atomic operation. This
         operation should be used when a best-effort guarantee is sufficient
@@ -1011,6 +1126,10 @@ class ServiceBusService(object):
             Name of the queue.
         timeout:
             Optional. The timeout parameter is expressed in seconds.
+        stream:
+            Optional. If True, the body of the message is a file-like object
+            read from the connection on demand. Read it entirely, or close
+            it, to release the connection. Use it for large messages.
         '''
         _validate_not_none('queue_name', queue_name)
         request = HTTPRequest()
@@ -1018,6 +1137,7 @@ class ServiceBusService(object):
         request.host = self._get_host()
         request.path = '/' + _str(queue_name) + '/messages/head'
         request.query = [('timeout', _int_or_none(timeout))]
+        request.stream = stream
         request.path, request.query = self._httpclient._update_request_uri_query(request)
         request.headers = self._update_service_bus_header(request)
         response = self._perform_request(request)
@@ -1053,7 +1173,8 @@ class ServiceBusService(object):
         request.headers = self._update_service_bus_header(request)
         self._perform_request(request)
 
-    def receive_queue_message(self, queue_name, peek_lock=True, timeout=60):
+    def receive_queue_message(self, queue_name, peek_lock=True, timeout=60,
+                              stream=False):
         '''
         Receive a message from a queue for processing.
 
@@ -1064,14 +1185,19 @@ class ServiceBusService(object):
             delete the message. Default is True (lock).
         timeout:
             Optional. The timeout parameter is expressed in seconds.
+        stream:
+            Optional. If True, the body of the message is a file-like object
+            read from the connection on demand. Read it entirely, or close
+            it, to release the connection. Use it for large messages.
         '''
         if peek_lock:
-            return self.peek_lock_queue_message(queue_name, timeout)
+            return self.peek_lock_queue_message(queue_name, timeout, stream)
         else:
-            return self.read_delete_queue_message(queue_name, timeout)
+            return self.read_delete_queue_message(queue_name, timeout, stream)
 
     def receive_subscription_message(self, topic_name, subscription_name,
-                                     peek_lock=True, timeout=60):
+                                     peek_lock=True, timeout=60,
+                                     stream=False):
         '''
         Receive a message from a subscription for processing.
 
@@ -1084,15 +1210,19 @@ class ServiceBusService(object):
             delete the message. Default is True (lock).
         timeout:
             Optional. The timeout parameter is expressed in seconds.
+        stream:
+            Optional. If True, the body of the message is a file-like object
+            read from the connection on demand. Read it entirely, or close
+            it, to release the connection. Use it for large messages.
         '''
         if peek_lock:
             return self.peek_lock_subscription_message(topic_name,
                                                        subscription_name,
-                                                       timeout)
+                                                       timeout, stream)
         else:
             return self.read_delete_subscription_message(topic_name,
                                                          subscription_name,
-                                                         timeout)
+                                                         timeout, stream)
 
     def create_event_hub(self, hub_name, hub=None, fail_on_exist=False):
         '''
@@ -1220,6 +1350,88 @@ class ServiceBusService(object):
         request.headers = self._update_service_bus_header(request)
         self._perform_request(request)
 
+    def send_event_batch(self, hub_name, messages, device_id=None):
+        '''
+        Sends a batch of events to an Event Hub in a single request.
+
+        hub_name:
+            Name of the event hub.
+        messages:
+            List of message objects containing event body and properties.
+            Set the PartitionKey broker property to choose the partition.
+        device_id:
+            Optional. Name of the publisher sending the events.
+        '''
+        _validate_not_none('hub_name', hub_name)
+        _validate_not_none('messages', messages)
+        self._send_event_batch(
+            hub_name,
+            _get_request_body(json.dumps([m.as_batch_body() for m in messages])),
+            device_id)
+
+    def _send_event_batch(self, hub_name, body, device_id=None):
+        '''
+        Sends an already serialized batch of events to an Event Hub.
+
+        hub_name:
+            Name of the event hub.
+        body:
+            JSON array of events, as returned by Message.as_batch_body,
+            encoded in bytes.
+        device_id:
+            Optional. Name of the publisher sending the events.
+        '''
+        entity_name = _str(hub_name)
+        if device_id:
+            entity_name += '/publishers/' + _str(device_id)
+        self._send_message_batch(entity_name, body, '2014-01')
+
+    def _send_message_batch(self, entity_name, body, api_version=None):
+        '''
+        Sends an already serialized batch of messages into a queue, topic or
+        event hub.
+
+        entity_name:
+            Name of the queue or topic, or path of the event hub publisher.
+        body:
+            JSON array of messages, as returned by Message.as_batch_body,
+            encoded in bytes.
+        api_version:
+            Optional. Value of the api-version query parameter.
+        '''
+        request = HTTPRequest()
+        request.method = 'POST'
+        request.host = self._get_host()
+        request.path = '/' + _str(entity_name) + '/messages'
+        if api_version:
+            request.query = [('api-version', api_version)]
+        request.headers.append(('Content-Type', 'application/vnd.microsoft.servicebus.json'))
+        request.body = body
+        request.path, request.query = self._httpclient._update_request_uri_query(request)
+        request.headers = self._update_service_bus_header(request)
+        self._perform_request(request)
+
+    def _get_feed_page(self, path, convert_func, skip, top):
+        request = HTTPRequest()
+        request.method = 'GET'
+        request.host = self._get_host()
+        request.path = path
+        request.query = [('$skip', _str(skip)), ('$top', _str(top))]
+        request.path, request.query = self._httpclient._update_request_uri_query(request)
+        request.headers = self._update_service_bus_header(request)
+        response = self._perform_request(request)
+
+        return _ETreeXmlToObject.convert_response_to_feeds(
+            response, convert_func)
+
+    def _iter_feed(self, path, convert_func, page_size, prefetch_pages):
+        pages = _iter_pages(
+            lambda skip, top: self._get_feed_page(path, convert_func, skip, top),
+            page_size)
+        if prefetch_pages:
+            pages = _prefetch(pages, prefetch_pages)
+        return (item for page in pages for item in page)
+
     def _get_host(self):
         return self.service_namespace + self.host_base
 
@@ -1234,18 +1446,7 @@ class ServiceBusService(object):
     def _update_service_bus_header(self, request):
         ''' Add additional headers for service bus. '''
 
-        if request.method in ['PUT', 'POST', 'MERGE', 'DELETE']:
-            request.headers.append(('Content-Length', str(len(request.body))))
-
-        # if it is not GET or HEAD request, must set content-type.
-        if not request.method in ['GET', 'HEAD']:
-            for name, _ in request.headers:
-                if 'content-type' == name.lower():
-                    break
-            else:
-                request.headers.append(
-                    ('Content-Type',
-                     'application/atom+xml;type=entry;charset=utf-8'))
+        _add_content_headers(request)
 
         # Adds authorization header for authentication.
         self.authentication.sign_request(request, self._httpclient)
@@ -1253,9 +1454,177 @@ class ServiceBusService(object):
         return request.headers
 
 
+_LOGGER = logging.getLogger(__name__)
+
+
+def _add_content_headers(request):
+    '''
+    Adds the Content-Length and Content-Type headers required by service bus
+    to a request, before it is signed. Shared by the synchronous and the
+    asyncio services.
+    '''
+    if request.method in ['PUT', 'POST', 'MERGE', 'DELETE']:
+        request.headers.append(('Content-Length', str(len(request.body))))
+
+    # if it is not GET or HEAD request, must set content-type.
+    if not request.method in ['GET', 'HEAD']:
+        for name, _ in request.headers:
+            if 'content-type' == name.lower():
+                break
+        else:
+            request.headers.append(
+                ('Content-Type',
+                 'application/atom+xml;type=entry;charset=utf-8'))
+
+
+def _get_token_expiry(token):
+    ''' Returns the ExpiresOn time of a WRAP token, in seconds since Epoch. '''
+    time_pos_begin = token.find('ExpiresOn=') + len('ExpiresOn=')
+    time_pos_end = token.find('&', time_pos_begin)
+    return int(token[time_pos_begin:time_pos_end])
+
+
+class _WrapTokenCache(object):
+
+    '''
+    Thread-safe cache of WRAP tokens, keyed by scope.
+
+    The least recently used tokens are dropped beyond max_size. When a token
+    is missing or expired, only one thread requests a new one for its scope,
+    the other threads of that scope wait for it. Tokens which were used since
+    they were obtained are renewed in the background renewal_margin seconds
+    before they expire, so that requests don't wait for the access control
+    service.
+    '''
+
+    # Seconds before expiry after which a token is not used anymore
+    expiry_margin = 30
+
+    def __init__(self, max_size=256, renewal_margin=120, renewal_interval=10,
+                 background_renewal=True):
+        self.max_size = max_size
+        self.renewal_margin = renewal_margin
+        self.renewal_interval = renewal_interval
+        self.background_renewal = background_renewal
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.renewals = 0
+        self.renewal_failures = 0
+        self.evictions = 0
+
+        # scope -> [token, expiry, fetch, used since refreshed]
+        self._entries = OrderedDict()
+        self._refresh_locks = {}
+        self._lock = threading.Lock()
+        self._renewal_thread = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, scope):
+        return scope in self._entries
+
+    @property
+    def metrics(self):
+        '''Returns a snapshot of the cache counters.'''
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'renewals': self.renewals,
+                'renewal_failures': self.renewal_failures,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._refresh_locks.clear()
+
+    def get(self, scope, fetch):
+        '''
+        Returns the cached token of scope, or the token returned by fetch.
+
+        scope:
+            Key of the token.
+        fetch:
+            Callable requesting a new token for the scope.
+        '''
+        with self._lock:
+            token = self._get_valid(scope)
+            if token is not None:
+                self.hits += 1
+                return token
+            self.misses += 1
+            refresh_lock = self._refresh_locks.setdefault(scope, threading.Lock())
+
+        with refresh_lock:
+            # another thread may have refreshed the token while we waited
+            with self._lock:
+                token = self._get_valid(scope)
+            if token is None:
+                token = self._refresh(scope, fetch)
+        return token
+
+    def _get_valid(self, scope):
+        entry = self._entries.get(scope)
+        if entry is None or entry[1] - time.time() < self.expiry_margin:
+            return None
+        entry[3] = True
+        # moves the entry to the most recently used end
+        self._entries[scope] = self._entries.pop(scope)
+        return entry[0]
+
+    def _refresh(self, scope, fetch):
+        token = fetch()
+        with self._lock:
+            self.refreshes += 1
+            self._entries.pop(scope, None)
+            self._entries[scope] = [token, _get_token_expiry(token), fetch, False]
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._refresh_locks.pop(evicted, None)
+                self.evictions += 1
+            if self.background_renewal and self._renewal_thread is None:
+                self._renewal_thread = threading.Thread(target=self._renew_loop)
+                self._renewal_thread.daemon = True
+                self._renewal_thread.start()
+        return token
+
+    def _renew_loop(self):
+        while True:
+            time.sleep(self.renewal_interval)
+            self._renew_due()
+
+    def _renew_due(self):
+        renewal_time = time.time() + self.renewal_margin
+        with self._lock:
+            due = [(scope, entry[2], self._refresh_locks.setdefault(scope, threading.Lock()))
+                   for scope, entry in self._entries.items()
+                   if entry[3] and entry[1] <= renewal_time]
+        for scope, fetch, refresh_lock in due:
+            # skips the scopes which a request is already refreshing
+            if not refresh_lock.acquire(False):
+                continue
+            try:
+                self._refresh(scope, fetch)
+                with self._lock:
+                    self.renewals += 1
+            except Exception:
+                _LOGGER.warning('Failed to renew a WRAP token', exc_info=True)
+                with self._lock:
+                    self.renewal_failures += 1
+            finally:
+                refresh_lock.release()
+
+
 # Token cache for Authentication
 # Shared by the different instances of ServiceBusWrapTokenAuthentication
-_tokens = {}
+_tokens = _WrapTokenCache()
 
 
 class ServiceBusWrapTokenAuthentication:
@@ -1274,14 +1643,12 @@ class ServiceBusWrapTokenAuthentication:
 
     def _token_is_expired(self, token):
         ''' Check if token expires or not. '''
-        time_pos_begin = token.find('ExpiresOn=') + len('ExpiresOn=')
-        time_pos_end = token.find('&', time_pos_begin)
-        token_expire_time = int(token[time_pos_begin:time_pos_end])
+        token_expire_time = _get_token_expiry(token)
         time_now = time.mktime(time.localtime())
 
         # Adding 30 seconds so the token wouldn't be expired when we send the
         # token to server.
-        return (token_expire_time - time_now) < 30
+        return (token_expire_time - time_now) < _WrapTokenCache.expiry_margin
 
     def _get_token(self, host, path, httpclient):
         '''
@@ -1293,15 +1660,11 @@ class ServiceBusWrapTokenAuthentication:
             the service bus service request.
         '''
         wrap_scope = 'http://' + host + path + self.issuer + self.account_key
+        return _tokens.get(
+            wrap_scope, lambda: self._request_token(host, path, httpclient))
 
-        # Check whether has unexpired cache, return cached token if it is still
-        # usable.
-        if wrap_scope in _tokens:
-            token = _tokens[wrap_scope]
-            if not self._token_is_expired(token):
-                return token
-
-        # get token from accessconstrol server
+    def _request_token(self, host, path, httpclient):
+        ''' Gets a token from the access control server. '''
         request = HTTPRequest()
         request.protocol_override = 'https'
         request.host = host.replace('.servicebus.', '-sb.accesscontrol.')
@@ -1315,35 +1678,97 @@ class ServiceBusWrapTokenAuthentication:
         resp = httpclient.perform_request(request)
 
         token = resp.body.decode('utf-8-sig')
-        token = url_unquote(token[token.find('=') + 1:token.rfind('&')])
-        _tokens[wrap_scope] = token
-
-        return token
+        return url_unquote(token[token.find('=') + 1:token.rfind('&')])
 
 
 class ServiceBusSASAuthentication:
-    def __init__(self, key_name, key_value):
+
+    # Number of cached tokens above which expired tokens are dropped
+    _MAX_CACHED_TOKENS = 1024
+
+    def __init__(self, key_name, key_value,
+                 token_lifetime=DEFAULT_SAS_TOKEN_LIFETIME,
+                 refresh_margin=DEFAULT_SAS_TOKEN_REFRESH_MARGIN,
+                 namespace_scoped=False):
+        '''
+        Signs requests with Shared Access Signature tokens. Tokens are cached
+        per resource and reused until refresh_margin seconds before they
+        expire.
+
+        key_name:
+            SAS authentication key name.
+        key_value:
+            SAS authentication key value.
+        token_lifetime:
+            Optional. Number of seconds for which a token is valid.
+        refresh_margin:
+            Optional. Number of seconds before expiry at which a cached token
+            is replaced. Must be lower than token_lifetime.
+        namespace_scoped:
+            Optional. Sign a single token for the whole namespace instead of
+            one token per entity. The key must have access to all entities.
+        '''
+        if refresh_margin >= token_lifetime:
+            raise ValueError('refresh_margin must be lower than token_lifetime')
         self.key_name = key_name
         self.key_value = key_value
+        self.token_lifetime = token_lifetime
+        self.refresh_margin = refresh_margin
+        self.namespace_scoped = namespace_scoped
+        # resource uri -> (authorization header, renewal time)
+        self._tokens = {}
 
     def sign_request(self, request, httpclient):
         request.headers.append(
             ('Authorization', self._get_authorization(request, httpclient)))
 
     def _get_authorization(self, request, httpclient):
-        uri = httpclient.get_uri(request)
-        uri = url_quote(uri, '').lower()
-        expiry = str(self._get_expiry())
+        uri = self._get_resource_uri(request, httpclient)
+        cached = self._tokens.get(uri)
+        now = time.time()
+        if cached and now < cached[1]:
+            return cached[0]
+
+        expiry = self._get_expiry()
+        auth = self._sign(uri, expiry)
+        if len(self._tokens) >= self._MAX_CACHED_TOKENS:
+            self._purge_tokens(now)
+        self._tokens[uri] = (auth, expiry - self.refresh_margin)
+        return auth
+
+    def _get_resource_uri(self, request, httpclient):
+        '''
+        Returns the uri the token is signed for. The service accepts a
+        token for any prefix of the request uri, so message operations share
+        the token of their queue, subscription or event hub publisher.
+        '''
+        uri = httpclient.get_uri(request).partition('?')[0]
+        if self.namespace_scoped:
+            uri = uri[:uri.index('/', uri.index('://') + 3)]
+        else:
+            path_pos = uri.index('/', uri.index('://') + 3)
+            messages_pos = uri.find('/messages', path_pos + 1)
+            if messages_pos >= 0:
+                uri = uri[:messages_pos]
+        return uri
 
+    def _sign(self, uri, expiry):
+        uri = url_quote(uri, '').lower()
+        expiry = str(expiry)
         to_sign = uri + '\n' + expiry
         signature = url_quote(_sign_string(self.key_value, to_sign, False), '')
 
         auth_format = 'SharedAccessSignature sig={0}&se={1}&skn={2}&sr={3}'
-        auth = auth_format.format(signature, expiry, self.key_name, uri)
+        return auth_format.format(signature, expiry, self.key_name, uri)
 
-        return auth
+    def _purge_tokens(self, now):
+        for uri, (_, renewal_time) in list(self._tokens.items()):
+            if renewal_time <= now:
+                self._tokens.pop(uri, None)
+        if len(self._tokens) >= self._MAX_CACHED_TOKENS:
+            self._tokens.clear()
 
     def _get_expiry(self):
         '''Returns the UTC datetime, in seconds since Epoch, when this signed 
-        request expires (5 minutes from now).'''
-        return int(round(time.time() + 300))
+        request expires (token_lifetime seconds from now).'''
+        return int(round(time.time() + self.token_lifetime))
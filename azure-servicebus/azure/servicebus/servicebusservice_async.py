@@ -0,0 +1,718 @@
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import asyncio
+import json
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError("You need to install 'aiohttp' to use this feature")
+
+from azure.common import (
+    AzureHttpError,
+)
+from .constants import (
+    DEFAULT_HTTP_TIMEOUT,
+    DEFAULT_HTTP_POOL_MAXSIZE,
+    SERVICE_BUS_HOST_BASE,
+    _USER_AGENT_STRING,
+)
+from ._common_error import (
+    _dont_fail_not_exist,
+    _dont_fail_on_exist,
+    _validate_not_none,
+)
+from ._common_conversion import (
+    _int_or_none,
+    _str,
+)
+from ._common_serialization import (
+    _ETreeXmlToObject,
+    _get_request_body,
+)
+from ._http import (
+    HTTPError,
+    HTTPRequest,
+    HTTPResponse,
+)
+from ._serialization import (
+    _convert_topic_to_xml,
+    _convert_response_to_topic,
+    _convert_queue_to_xml,
+    _convert_response_to_queue,
+    _convert_subscription_to_xml,
+    _convert_response_to_subscription,
+    _convert_etree_element_to_queue,
+    _convert_etree_element_to_topic,
+    _convert_etree_element_to_subscription,
+    _create_message,
+    _service_bus_error_handler,
+)
+from .servicebusservice import (
+    ServiceBusService,
+    ServiceBusSASAuthentication,
+    _add_content_headers,
+)
+
+# Returns the loop running the current coroutine. get_running_loop was added
+# in Python 3.7, get_event_loop returns the running loop in a coroutine.
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class ServiceBusServiceAsync(object):
+
+    '''
+    asyncio version of ServiceBusService for queues, topics, subscriptions
+    and event hub events. Every operation is a coroutine, and all the
+    operations of a client share a single pool of connections so that one
+    event loop can drive many concurrent long-polling receives and sends.
+
+    Messages returned by the receive operations are bound to this client:
+    their delete, unlock and renew_lock methods return coroutines.
+
+    Requires Python 3.5+ and the aiohttp package.
+    '''
+
+    def __init__(self, service_namespace=None, account_key=None, issuer=None,
+                 host_base=SERVICE_BUS_HOST_BASE,
+                 shared_access_key_name=None, shared_access_key_value=None,
+                 authentication=None, timeout=DEFAULT_HTTP_TIMEOUT,
+                 pool_maxsize=DEFAULT_HTTP_POOL_MAXSIZE):
+        '''
+        Initializes the service bus service for a namespace with the specified
+        authentication settings (SAS or ACS).
+
+        service_namespace, account_key, issuer, host_base,
+        shared_access_key_name, shared_access_key_value, authentication,
+        timeout:
+            See ServiceBusService.
+        pool_maxsize:
+            Optional. Maximum number of connections opened concurrently to
+            the namespace. Every outstanding long-polling receive holds one
+            connection, size it accordingly. 0 means no limit.
+        '''
+        # The synchronous service validates the settings and selects the
+        # authentication. Its http client is only used to sign requests.
+        service = ServiceBusService(
+            service_namespace=service_namespace,
+            account_key=account_key,
+            issuer=issuer,
+            host_base=host_base,
+            shared_access_key_name=shared_access_key_name,
+            shared_access_key_value=shared_access_key_value,
+            authentication=authentication,
+            timeout=timeout,
+        )
+        self.service_namespace = service.service_namespace
+        self.host_base = service.host_base
+        self.authentication = service.authentication
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.proxy = None
+        self.proxy_auth = None
+        self._httpclient = service._httpclient
+        self._session = None
+
+    @staticmethod
+    def format_dead_letter_queue_name(queue_name):
+        """Get the dead letter name of this queue"""
+        return ServiceBusService.format_dead_letter_queue_name(queue_name)
+
+    @staticmethod
+    def format_dead_letter_subscription_name(subscription_name):
+        """Get the dead letter name of this subscription"""
+        return ServiceBusService.format_dead_letter_subscription_name(subscription_name)
+
+    def set_proxy(self, host, port, user=None, password=None):
+        '''
+        Sets the proxy server host and port.
+
+        host:
+            Address of the proxy. Ex: '192.168.0.100'
+        port:
+            Port of the proxy. Ex: 6000
+        user:
+            User for proxy authorization.
+        password:
+            Password for proxy authorization.
+        '''
+        self.proxy = 'http://{0}:{1}'.format(host, port)
+        if user and password:
+            self.proxy_auth = aiohttp.BasicAuth(user, password)
+        # WRAP tokens are requested through the synchronous http client
+        self._httpclient.set_proxy(host, port, user, password)
+
+    async def close(self):
+        ''' Closes the connections opened by this client. '''
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def create_queue(self, queue_name, queue=None, fail_on_exist=False):
+        '''
+        Creates a new queue. See ServiceBusService.create_queue.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        request = self._create_request(
+            'PUT', '/' + _str(queue_name) + '',
+            _get_request_body(_convert_queue_to_xml(queue)))
+        return await self._perform_create(request, fail_on_exist)
+
+    async def delete_queue(self, queue_name, fail_not_exist=False):
+        '''
+        Deletes an existing queue. See ServiceBusService.delete_queue.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        request = self._create_request('DELETE', '/' + _str(queue_name) + '')
+        return await self._perform_delete(request, fail_not_exist)
+
+    async def get_queue(self, queue_name):
+        '''
+        Retrieves an existing queue.
+
+        queue_name:
+            Name of the queue.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        request = self._create_request('GET', '/' + _str(queue_name) + '')
+        response = await self._perform_request(request)
+
+        return _convert_response_to_queue(response)
+
+    async def list_queues(self):
+        '''
+        Enumerates the queues in the service namespace.
+        '''
+        request = self._create_request('GET', '/$Resources/Queues')
+        response = await self._perform_request(request)
+
+        return _ETreeXmlToObject.convert_response_to_feeds(
+            response, _convert_etree_element_to_queue)
+
+    async def create_topic(self, topic_name, topic=None, fail_on_exist=False):
+        '''
+        Creates a new topic. See ServiceBusService.create_topic.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        request = self._create_request(
+            'PUT', '/' + _str(topic_name) + '',
+            _get_request_body(_convert_topic_to_xml(topic)))
+        return await self._perform_create(request, fail_on_exist)
+
+    async def delete_topic(self, topic_name, fail_not_exist=False):
+        '''
+        Deletes an existing topic. See ServiceBusService.delete_topic.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        request = self._create_request('DELETE', '/' + _str(topic_name) + '')
+        return await self._perform_delete(request, fail_not_exist)
+
+    async def get_topic(self, topic_name):
+        '''
+        Retrieves the description for the specified topic.
+
+        topic_name:
+            Name of the topic.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        request = self._create_request('GET', '/' + _str(topic_name) + '')
+        response = await self._perform_request(request)
+
+        return _convert_response_to_topic(response)
+
+    async def list_topics(self):
+        '''
+        Retrieves the topics in the service namespace.
+        '''
+        request = self._create_request('GET', '/$Resources/Topics')
+        response = await self._perform_request(request)
+
+        return _ETreeXmlToObject.convert_response_to_feeds(
+            response, _convert_etree_element_to_topic)
+
+    async def create_subscription(self, topic_name, subscription_name,
+                                  subscription=None, fail_on_exist=False):
+        '''
+        Creates a new subscription. See ServiceBusService.create_subscription.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        request = self._create_request(
+            'PUT',
+            '/' + _str(topic_name) + '/subscriptions/' + _str(subscription_name) + '',
+            _get_request_body(_convert_subscription_to_xml(subscription)))
+        return await self._perform_create(request, fail_on_exist)
+
+    async def delete_subscription(self, topic_name, subscription_name,
+                                  fail_not_exist=False):
+        '''
+        Deletes an existing subscription. See
+        ServiceBusService.delete_subscription.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        request = self._create_request(
+            'DELETE',
+            '/' + _str(topic_name) + '/subscriptions/' + _str(subscription_name) + '')
+        return await self._perform_delete(request, fail_not_exist)
+
+    async def get_subscription(self, topic_name, subscription_name):
+        '''
+        Gets an existing subscription.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        request = self._create_request(
+            'GET',
+            '/' + _str(topic_name) + '/subscriptions/' + _str(subscription_name) + '')
+        response = await self._perform_request(request)
+
+        return _convert_response_to_subscription(response)
+
+    async def list_subscriptions(self, topic_name):
+        '''
+        Retrieves the subscriptions in the specified topic.
+
+        topic_name:
+            Name of the topic.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        request = self._create_request(
+            'GET', '/' + _str(topic_name) + '/subscriptions/')
+        response = await self._perform_request(request)
+
+        return _ETreeXmlToObject.convert_response_to_feeds(
+            response, _convert_etree_element_to_subscription)
+
+    async def send_queue_message(self, queue_name, message=None):
+        '''
+        Sends a message into the specified queue.
+
+        queue_name:
+            Name of the queue.
+        message:
+            Message object containing message body and properties.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        _validate_not_none('message', message)
+        await self._send_message('/' + _str(queue_name) + '/messages', message)
+
+    async def send_queue_message_batch(self, queue_name, messages=None):
+        '''
+        Sends a batch of messages into the specified queue.
+
+        queue_name:
+            Name of the queue.
+        messages:
+            List of message objects containing message body and properties.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        _validate_not_none('messages', messages)
+        await self._send_message_batch(
+            '/' + _str(queue_name) + '/messages', messages)
+
+    async def peek_lock_queue_message(self, queue_name, timeout='60'):
+        '''
+        Automically retrieves and locks a message from a queue for processing.
+        See ServiceBusService.peek_lock_queue_message.
+
+        queue_name:
+            Name of the queue.
+        timeout:
+            Optional. The timeout parameter is expressed in seconds.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        return await self._receive_message(
+            'POST', '/' + _str(queue_name) + '/messages/head', timeout)
+
+    async def unlock_queue_message(self, queue_name, sequence_number, lock_token):
+        '''
+        Unlocks a message for processing by other receivers on a given queue.
+
+        queue_name:
+            Name of the queue.
+        sequence_number:
+            The sequence number of the message to be unlocked as returned in
+            BrokerProperties['SequenceNumber'] by the Peek Message operation.
+        lock_token:
+            The ID of the lock as returned by the Peek Message operation in
+            BrokerProperties['LockToken']
+        '''
+        _validate_not_none('queue_name', queue_name)
+        await self._lock_operation(
+            'PUT', '/' + _str(queue_name), sequence_number, lock_token)
+
+    async def renew_lock_queue_message(self, queue_name, sequence_number, lock_token):
+        '''
+        Renew lock on an already locked message on a given queue.
+
+        queue_name:
+            Name of the queue.
+        sequence_number:
+            The sequence number of the message as returned in
+            BrokerProperties['SequenceNumber'] by the Peek Message operation.
+        lock_token:
+            The ID of the lock as returned by the Peek Message operation in
+            BrokerProperties['LockToken']
+        '''
+        _validate_not_none('queue_name', queue_name)
+        await self._lock_operation(
+            'POST', '/' + _str(queue_name), sequence_number, lock_token)
+
+    async def read_delete_queue_message(self, queue_name, timeout='60'):
+        '''
+        Reads and deletes a message from a queue as an atomic operation.
+
+        queue_name:
+            Name of the queue.
+        timeout:
+            Optional. The timeout parameter is expressed in seconds.
+        '''
+        _validate_not_none('queue_name', queue_name)
+        return await self._receive_message(
+            'DELETE', '/' + _str(queue_name) + '/messages/head', timeout)
+
+    async def delete_queue_message(self, queue_name, sequence_number, lock_token):
+        '''
+        Completes processing on a locked message and delete it from the queue.
+
+        queue_name:
+            Name of the queue.
+        sequence_number:
+            The sequence number of the message to be deleted as returned in
+            BrokerProperties['SequenceNumber'] by the Peek Message operation.
+        lock_token:
+            The ID of the lock as returned by the Peek Message operation in
+            BrokerProperties['LockToken']
+        '''
+        _validate_not_none('queue_name', queue_name)
+        await self._lock_operation(
+            'DELETE', '/' + _str(queue_name), sequence_number, lock_token)
+
+    async def receive_queue_message(self, queue_name, peek_lock=True, timeout=60):
+        '''
+        Receive a message from a queue for processing.
+
+        queue_name:
+            Name of the queue.
+        peek_lock:
+            Optional. True to retrieve and lock the message. False to read and
+            delete the message. Default is True (lock).
+        timeout:
+            Optional. The timeout parameter is expressed in seconds.
+        '''
+        if peek_lock:
+            return await self.peek_lock_queue_message(queue_name, timeout)
+        else:
+            return await self.read_delete_queue_message(queue_name, timeout)
+
+    async def send_topic_message(self, topic_name, message=None):
+        '''
+        Enqueues a message into the specified topic.
+
+        topic_name:
+            Name of the topic.
+        message:
+            Message object containing message body and properties.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('message', message)
+        await self._send_message('/' + _str(topic_name) + '/messages', message)
+
+    async def send_topic_message_batch(self, topic_name, messages=None):
+        '''
+        Sends a batch of messages into the specified topic.
+
+        topic_name:
+            Name of the topic.
+        messages:
+            List of message objects containing message body and properties.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('messages', messages)
+        await self._send_message_batch(
+            '/' + _str(topic_name) + '/messages', messages)
+
+    async def peek_lock_subscription_message(self, topic_name, subscription_name,
+                                             timeout='60'):
+        '''
+        Atomically retrieves and locks a message from a subscription for
+        processing. See ServiceBusService.peek_lock_subscription_message.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        timeout:
+            Optional. The timeout parameter is expressed in seconds.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        return await self._receive_message(
+            'POST', self._subscription_path(topic_name, subscription_name) +
+            '/messages/head', timeout)
+
+    async def unlock_subscription_message(self, topic_name, subscription_name,
+                                          sequence_number, lock_token):
+        '''
+        Unlock a message for processing by other receivers on a given
+        subscription.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        sequence_number:
+            The sequence number of the message to be unlocked as returned in
+            BrokerProperties['SequenceNumber'] by the Peek Message operation.
+        lock_token:
+            The ID of the lock as returned by the Peek Message operation in
+            BrokerProperties['LockToken']
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        await self._lock_operation(
+            'PUT', self._subscription_path(topic_name, subscription_name),
+            sequence_number, lock_token)
+
+    async def renew_lock_subscription_message(self, topic_name, subscription_name,
+                                              sequence_number, lock_token):
+        '''
+        Renew the lock on an already locked message on a given subscription.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        sequence_number:
+            The sequence number of the message as returned in
+            BrokerProperties['SequenceNumber'] by the Peek Message operation.
+        lock_token:
+            The ID of the lock as returned by the Peek Message operation in
+            BrokerProperties['LockToken']
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        await self._lock_operation(
+            'POST', self._subscription_path(topic_name, subscription_name),
+            sequence_number, lock_token)
+
+    async def read_delete_subscription_message(self, topic_name, subscription_name,
+                                               timeout='60'):
+        '''
+        Read and delete a message from a subscription as an atomic operation.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        timeout:
+            Optional. The timeout parameter is expressed in seconds.
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        return await self._receive_message(
+            'DELETE', self._subscription_path(topic_name, subscription_name) +
+            '/messages/head', timeout)
+
+    async def delete_subscription_message(self, topic_name, subscription_name,
+                                          sequence_number, lock_token):
+        '''
+        Completes processing on a locked message and delete it from the
+        subscription.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        sequence_number:
+            The sequence number of the message to be deleted as returned in
+            BrokerProperties['SequenceNumber'] by the Peek Message operation.
+        lock_token:
+            The ID of the lock as returned by the Peek Message operation in
+            BrokerProperties['LockToken']
+        '''
+        _validate_not_none('topic_name', topic_name)
+        _validate_not_none('subscription_name', subscription_name)
+        await self._lock_operation(
+            'DELETE', self._subscription_path(topic_name, subscription_name),
+            sequence_number, lock_token)
+
+    async def receive_subscription_message(self, topic_name, subscription_name,
+                                           peek_lock=True, timeout=60):
+        '''
+        Receive a message from a subscription for processing.
+
+        topic_name:
+            Name of the topic.
+        subscription_name:
+            Name of the subscription.
+        peek_lock:
+            Optional. True to retrieve and lock the message. False to read and
+            delete the message. Default is True (lock).
+        timeout:
+            Optional. The timeout parameter is expressed in seconds.
+        '''
+        if peek_lock:
+            return await self.peek_lock_subscription_message(
+                topic_name, subscription_name, timeout)
+        else:
+            return await self.read_delete_subscription_message(
+                topic_name, subscription_name, timeout)
+
+    async def send_event(self, hub_name, message, device_id=None,
+                         broker_properties=None):
+        '''
+        Sends a new message event to an Event Hub.
+        '''
+        _validate_not_none('hub_name', hub_name)
+        if device_id:
+            path = '/{0}/publishers/{1}/messages?api-version=2014-01'.format(hub_name, device_id)
+        else:
+            path = '/{0}/messages?api-version=2014-01'.format(hub_name)
+        headers = []
+        if broker_properties:
+            headers.append(('BrokerProperties', str(broker_properties)))
+        request = self._create_request(
+            'POST', path, _get_request_body(message), headers=headers)
+        await self._perform_request(request)
+
+    def _get_host(self):
+        return self.service_namespace + self.host_base
+
+    def _subscription_path(self, topic_name, subscription_name):
+        return '/' + _str(topic_name) + '/subscriptions/' + _str(subscription_name)
+
+    def _create_request(self, method, path, body=b'', query=None, headers=None):
+        request = HTTPRequest()
+        request.method = method
+        request.host = self._get_host()
+        request.path = path
+        request.body = body
+        if query:
+            request.query = query
+        if headers:
+            request.headers = headers
+        request.path, request.query = self._httpclient._update_request_uri_query(request)
+        return request
+
+    async def _send_message(self, path, message):
+        request = self._create_request('POST', path)
+        request.headers = message.add_headers(request)
+        request.body = _get_request_body(message.body)
+        await self._perform_request(request)
+
+    async def _send_message_batch(self, path, messages):
+        request = self._create_request(
+            'POST', path,
+            _get_request_body(json.dumps([m.as_batch_body() for m in messages])),
+            headers=[('Content-Type', 'application/vnd.microsoft.servicebus.json')])
+        await self._perform_request(request)
+
+    async def _receive_message(self, method, path, timeout):
+        request = self._create_request(
+            method, path, query=[('timeout', _int_or_none(timeout))])
+        response = await self._perform_request(request)
+
+        return _create_message(response, self)
+
+    async def _lock_operation(self, method, entity_path, sequence_number, lock_token):
+        _validate_not_none('sequence_number', sequence_number)
+        _validate_not_none('lock_token', lock_token)
+        request = self._create_request(
+            method, entity_path + '/messages/' + _str(sequence_number) +
+            '/' + _str(lock_token) + '')
+        await self._perform_request(request)
+
+    async def _perform_create(self, request, fail_on_exist):
+        if not fail_on_exist:
+            try:
+                await self._perform_request(request)
+                return True
+            except AzureHttpError as ex:
+                _dont_fail_on_exist(ex)
+                return False
+        else:
+            await self._perform_request(request)
+            return True
+
+    async def _perform_delete(self, request, fail_not_exist):
+        if not fail_not_exist:
+            try:
+                await self._perform_request(request)
+                return True
+            except AzureHttpError as ex:
+                _dont_fail_not_exist(ex)
+                return False
+        else:
+            await self._perform_request(request)
+            return True
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize or 0)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                skip_auto_headers=('Accept',),
+                headers={'User-Agent': _USER_AGENT_STRING})
+        return self._session
+
+    async def _update_service_bus_header(self, request):
+        ''' Add additional headers for service bus. '''
+
+        _add_content_headers(request)
+
+        # Adds authorization header for authentication. Only SAS signing is
+        # known not to block, other authentications may request a token.
+        if isinstance(self.authentication, ServiceBusSASAuthentication):
+            self.authentication.sign_request(request, self._httpclient)
+        else:
+            await _get_running_loop().run_in_executor(
+                None, self.authentication.sign_request, request, self._httpclient)
+
+        return request.headers
+
+    async def _perform_request(self, request):
+        request.headers = await self._update_service_bus_header(request)
+        protocol = request.protocol_override or self._httpclient.protocol
+        uri = protocol.lower() + '://' + request.host + request.path
+
+        session = self._get_session()
+        async with session.request(request.method, uri,
+                                   data=request.body or None,
+                                   headers=request.headers,
+                                   proxy=self.proxy,
+                                   proxy_auth=self.proxy_auth,
+                                   timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+            respbody = await resp.read()
+            respheaders = [(name.lower(), value) for name, value in resp.headers.items()]
+
+        status = resp.status
+        if status >= 300:
+            return _service_bus_error_handler(
+                HTTPError(status, resp.reason, respheaders, respbody or None))
+
+        return HTTPResponse(status, resp.reason, respheaders, respbody or None)
@@ -69,5 +69,10 @@ setup(
         'azure-common>=1.1.5',
         'requests',
     ],
+    extras_require={
+        'async': [
+            'aiohttp>=3.0',
+        ]
+    },
     cmdclass=cmdclass
 )
@@ -0,0 +1,104 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import sys
+import threading
+
+if sys.version_info < (3,):
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from azure.servicebus import ServiceBusService
+import tests.servicebus_settings_fake as fake_settings
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServiceBusEndpoint(object):
+
+    '''Local HTTP/1.1 stand-in for the Service Bus REST endpoint.
+
+    Every request is recorded in `requests` as (method, path, headers, body).
+    Responses are produced by `handler`, a callable receiving the same tuple
+    and returning (status, headers, body). The number of TCP connections
+    accepted by the server is available in `connections`.
+    '''
+
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda method, path, headers, body: (201, {}, b''))
+        self.requests = []
+        self.connections = 0
+        self._lock = threading.Lock()
+
+        endpoint = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with endpoint._lock:
+                    endpoint.connections += 1
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                headers = dict((k.lower(), v) for k, v in self.headers.items())
+                with endpoint._lock:
+                    endpoint.requests.append((self.command, self.path, headers, body))
+                status, resp_headers, resp_body = endpoint.handler(
+                    self.command, self.path, headers, body)
+                self.send_response(status)
+                for name, value in resp_headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(resp_body)))
+                self.end_headers()
+                self.wfile.write(resp_body)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_service(self, **kwargs):
+        '''Returns a ServiceBusService sending plain http requests to this
+        endpoint.'''
+        service = ServiceBusService(
+            '127.0.0.1',
+            host_base=':{0}'.format(self.port),
+            shared_access_key_name=fake_settings.SERVICEBUS_SAS_KEY_NAME,
+            shared_access_key_value=fake_settings.SERVICEBUS_SAS_KEY_VALUE,
+            **kwargs)
+        service._httpclient.protocol = 'http'
+        return service
@@ -0,0 +1,132 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import json
+import time
+import unittest
+
+from azure.common import AzureMissingResourceHttpError
+from azure.servicebus import Message
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+import tests.servicebus_settings_fake as fake_settings
+
+try:
+    import asyncio
+    from azure.servicebus.servicebusservice_async import ServiceBusServiceAsync
+except (ImportError, SyntaxError):
+    ServiceBusServiceAsync = None
+
+
+#------------------------------------------------------------------------------
+
+
+def _peek_lock_handler(delay):
+    def handler(method, path, headers, body):
+        if path.startswith('/myqueue/messages/head'):
+            time.sleep(delay)
+            return 201, {
+                'BrokerProperties': json.dumps({'SequenceNumber': 1, 'LockToken': 'abc'}),
+                'Location': 'http://' + headers['host'] + '/myqueue/messages/1/abc',
+            }, b'body'
+        if method == 'GET':
+            return 404, {}, b''
+        return 201, {}, b''
+    return handler
+
+
+@unittest.skipIf(ServiceBusServiceAsync is None, 'requires Python 3.5+ and aiohttp')
+class ServiceBusAsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _create_service(self, endpoint, **kwargs):
+        sbs = ServiceBusServiceAsync(
+            '127.0.0.1',
+            host_base=':{0}'.format(endpoint.port),
+            shared_access_key_name=fake_settings.SERVICEBUS_SAS_KEY_NAME,
+            shared_access_key_value=fake_settings.SERVICEBUS_SAS_KEY_VALUE,
+            **kwargs)
+        sbs._httpclient.protocol = 'http'
+        return sbs
+
+    def _run(self, sbs, *coroutines):
+        results = self.loop.run_until_complete(asyncio.gather(*coroutines))
+        self.loop.run_until_complete(sbs.close())
+        return results
+
+    def test_concurrent_peek_lock_load(self):
+        with FakeServiceBusEndpoint(_peek_lock_handler(0.2)) as endpoint:
+            sbs = self._create_service(endpoint, pool_maxsize=0)
+
+            start = time.time()
+            messages = self._run(
+                sbs, *[sbs.peek_lock_queue_message('myqueue') for i in range(200)])
+            elapsed = time.time() - start
+
+        # 200 sequential long-polls would take 40 seconds
+        self.assertLess(elapsed, 10)
+        self.assertEqual(len(messages), 200)
+        self.assertEqual(messages[0].body, b'body')
+        self.assertEqual(messages[0].broker_properties['LockToken'], 'abc')
+
+    def test_message_delete_is_awaitable(self):
+        with FakeServiceBusEndpoint(_peek_lock_handler(0)) as endpoint:
+            sbs = self._create_service(endpoint)
+
+            message, = self._run(sbs, sbs.peek_lock_queue_message('myqueue'))
+            self._run(sbs, message.delete())
+
+        method, path, headers, body = endpoint.requests[-1]
+        self.assertEqual((method, path), ('DELETE', '/myqueue/messages/1/abc'))
+
+    def test_send_queue_message_and_event(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = self._create_service(endpoint)
+
+            self._run(
+                sbs,
+                sbs.send_queue_message('myqueue', Message(b'message', custom_properties={'prop': 1})),
+                sbs.send_event('myhub', '{"DeviceId": "dev-01"}', device_id='dev-01'))
+
+        requests = sorted(endpoint.requests, key=lambda request: request[1])
+        method, path, headers, body = requests[0]
+        self.assertEqual(path, '/myhub/publishers/dev-01/messages?api-version=2014-01')
+        self.assertEqual(body, b'{"DeviceId": "dev-01"}')
+        method, path, headers, body = requests[1]
+        self.assertEqual((method, path, body), ('POST', '/myqueue/messages', b'message'))
+        self.assertEqual(headers['prop'], '1')
+        self.assertTrue(headers['authorization'].startswith('SharedAccessSignature '))
+        self.assertNotIn('accept', headers)
+
+    def test_errors_are_mapped(self):
+        with FakeServiceBusEndpoint(
+                lambda method, path, headers, body: (404, {}, b'')) as endpoint:
+            sbs = self._create_service(endpoint)
+
+            deleted, = self._run(sbs, sbs.delete_queue('myqueue'))
+            self.assertFalse(deleted)
+            with self.assertRaises(AzureMissingResourceHttpError):
+                self._run(sbs, sbs.get_queue('myqueue'))
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import base64
+import hashlib
+import hmac
+import threading
+import time
+import unittest
+
+from azure.servicebus import Message
+from azure.servicebus.servicebusservice import (
+    ServiceBusSASAuthentication,
+    _WrapTokenCache,
+)
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+import tests.servicebus_settings_fake as fake_settings
+
+try:
+    from urllib.parse import quote as url_quote
+except ImportError:
+    from urllib import quote as url_quote
+
+
+#------------------------------------------------------------------------------
+
+
+class ServiceBusSASAuthenticationTest(unittest.TestCase):
+
+    def _authorizations(self, endpoint):
+        return [headers['authorization'] for method, path, headers, body in endpoint.requests]
+
+    def _parse(self, authorization):
+        prefix = 'SharedAccessSignature '
+        self.assertTrue(authorization.startswith(prefix))
+        return dict((name, value) for name, value in
+                    (part.split('=', 1) for part in authorization[len(prefix):].split('&')))
+
+    def _create_service(self, endpoint, **kwargs):
+        authentication = ServiceBusSASAuthentication(
+            fake_settings.SERVICEBUS_SAS_KEY_NAME,
+            fake_settings.SERVICEBUS_SAS_KEY_VALUE,
+            **kwargs)
+        return endpoint.create_service(authentication=authentication), authentication
+
+    def test_token_is_valid_signature(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs, _ = self._create_service(endpoint)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+
+        token = self._parse(self._authorizations(endpoint)[0])
+        expected_uri = url_quote('http://127.0.0.1:{0}:80/myqueue'.format(endpoint.port), '').lower()
+        self.assertEqual(token['sr'], expected_uri)
+        self.assertEqual(token['skn'], fake_settings.SERVICEBUS_SAS_KEY_NAME)
+        digest = hmac.HMAC(fake_settings.SERVICEBUS_SAS_KEY_VALUE.encode('utf-8'),
+                           (token['sr'] + '\n' + token['se']).encode('utf-8'),
+                           hashlib.sha256).digest()
+        self.assertEqual(token['sig'], url_quote(base64.b64encode(digest).decode('utf-8'), ''))
+
+    def test_token_is_reused_for_entity(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs, _ = self._create_service(endpoint)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            sbs.peek_lock_queue_message('myqueue', 1)
+            sbs.send_topic_message('mytopic', Message(b'message'))
+
+        authorizations = self._authorizations(endpoint)
+        self.assertEqual(len(set(authorizations[:3])), 1)
+        self.assertNotEqual(authorizations[0], authorizations[3])
+
+    def test_namespace_scoped_token(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs, _ = self._create_service(endpoint, namespace_scoped=True)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            sbs.send_topic_message('mytopic', Message(b'message'))
+
+        authorizations = self._authorizations(endpoint)
+        self.assertEqual(authorizations[0], authorizations[1])
+        self.assertEqual(self._parse(authorizations[0])['sr'],
+                         url_quote('http://127.0.0.1:{0}:80'.format(endpoint.port), '').lower())
+
+    def test_token_is_refreshed_before_expiry(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs, authentication = self._create_service(endpoint, token_lifetime=600)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            # make the cached token due for renewal
+            for uri, (auth, renewal_time) in list(authentication._tokens.items()):
+                authentication._tokens[uri] = (auth, 0)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+
+        first, second = [self._parse(authorization) for authorization in self._authorizations(endpoint)]
+        self.assertEqual(first['sr'], second['sr'])
+        self.assertGreaterEqual(int(second['se']), int(first['se']))
+        self.assertEqual(len(authentication._tokens), 1)
+
+    def test_cache_is_bounded(self):
+        authentication = ServiceBusSASAuthentication('name', 'value')
+        authentication._MAX_CACHED_TOKENS = 4
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service(authentication=authentication)
+            for i in range(10):
+                sbs.send_queue_message('myqueue{0}'.format(i), Message(b'message'))
+
+        self.assertLessEqual(len(authentication._tokens), 4)
+
+    def test_invalid_refresh_margin(self):
+        with self.assertRaises(ValueError):
+            ServiceBusSASAuthentication('name', 'value', token_lifetime=60, refresh_margin=60)
+
+
+class _FakeAccessControl(object):
+
+    def __init__(self, lifetime=1200, delay=0):
+        self.lifetime = lifetime
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls += 1
+            number = self.calls
+        return 'token={0}&ExpiresOn={1}&Issuer=test'.format(
+            number, int(time.time() + self.lifetime))
+
+
+class ServiceBusWrapTokenCacheTest(unittest.TestCase):
+
+    def test_token_is_cached(self):
+        cache = _WrapTokenCache(background_renewal=False)
+        fetch = _FakeAccessControl()
+
+        tokens = [cache.get('scope', fetch) for i in range(5)]
+
+        self.assertEqual(len(set(tokens)), 1)
+        self.assertEqual(fetch.calls, 1)
+        metrics = cache.metrics
+        self.assertEqual((metrics['hits'], metrics['misses'], metrics['size']), (4, 1, 1))
+
+    def test_expired_token_is_refreshed(self):
+        cache = _WrapTokenCache(background_renewal=False)
+        fetch = _FakeAccessControl(lifetime=10)
+
+        first = cache.get('scope', fetch)
+        second = cache.get('scope', fetch)
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(fetch.calls, 2)
+
+    def test_refresh_is_single_flight(self):
+        cache = _WrapTokenCache(background_renewal=False)
+        fetch = _FakeAccessControl(delay=0.2)
+        tokens = []
+
+        threads = [threading.Thread(target=lambda: tokens.append(cache.get('scope', fetch)))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(fetch.calls, 1)
+        self.assertEqual(len(tokens), 20)
+        self.assertEqual(len(set(tokens)), 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = _WrapTokenCache(max_size=2, background_renewal=False)
+        fetch = _FakeAccessControl()
+
+        cache.get('scope1', fetch)
+        cache.get('scope2', fetch)
+        cache.get('scope1', fetch)
+        cache.get('scope3', fetch)
+
+        self.assertIn('scope1', cache)
+        self.assertNotIn('scope2', cache)
+        self.assertEqual(cache.metrics['evictions'], 1)
+
+    def test_used_tokens_are_renewed_in_background(self):
+        cache = _WrapTokenCache(renewal_margin=1200, renewal_interval=0.05)
+        fetch = _FakeAccessControl()
+
+        cache.get('scope', fetch)
+        cache.get('scope', fetch)
+        deadline = time.time() + 5
+        while not cache.renewals and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)
+
+        # the renewed token was not used since, it is not renewed again
+        self.assertEqual(cache.renewals, 1)
+        self.assertEqual(fetch.calls, 2)
+        self.assertEqual(cache.get('scope', fetch), 'token=2&ExpiresOn={0}&Issuer=test'.format(
+            cache._entries['scope'][1]))
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
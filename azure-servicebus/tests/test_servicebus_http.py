@@ -0,0 +1,215 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import io
+import json
+import time
+import unittest
+
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from requests import Session
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.exceptions import ConnectionError, ReadTimeout
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+from azure.common import AzureMissingResourceHttpError
+from azure.servicebus import Message
+from azure.servicebus._http.requestsclient import (
+    _Response,
+    _close_idle_connections,
+)
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+
+
+#------------------------------------------------------------------------------
+
+
+class ServiceBusHttpTest(unittest.TestCase):
+
+    def test_connections_are_reused(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+
+            for i in range(20):
+                sbs.send_queue_message('myqueue', Message(b'message'))
+
+            self.assertEqual(len(endpoint.requests), 20)
+            self.assertEqual(endpoint.connections, 1)
+
+    def test_idle_connections_are_evicted(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service(idle_timeout=0.5)
+
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            time.sleep(1)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+
+            self.assertEqual(endpoint.connections, 2)
+
+    def test_eviction_skips_checked_out_connections(self):
+        session = Session()
+        pool = session.get_adapter('https://').poolmanager.connection_from_url(
+            'https://mynamespace.servicebus.windows.net')
+        idle = MagicMock()
+        checked_out = MagicMock()
+        # the checked out connection is not in the pool until it is released
+        pool.pool.get()
+        pool.pool.get()
+        pool.pool.put(idle)
+
+        _close_idle_connections(session)
+
+        idle.close.assert_called_once_with()
+        self.assertFalse(checked_out.close.called)
+        self.assertIn(idle, pool.pool.queue)
+
+    def test_session_is_configured_once(self):
+        session = Session()
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service(request_session=session, pool_maxsize=4)
+            self.assertNotIn('Accept', session.headers)
+            self.assertEqual(session.get_adapter('https://')._pool_maxsize, 4)
+
+            headers = dict(session.headers)
+            sbs.send_queue_message('myqueue', Message(b'message'))
+            self.assertEqual(dict(session.headers), headers)
+
+    def test_session_adapters_are_kept(self):
+        session = Session()
+        adapter = HTTPAdapter(max_retries=3)
+        session.mount('https://', adapter)
+        with FakeServiceBusEndpoint() as endpoint:
+            endpoint.create_service(request_session=session)
+            self.assertIs(session.get_adapter('https://'), adapter)
+            self.assertEqual(adapter._pool_maxsize, DEFAULT_POOLSIZE)
+
+            endpoint.create_service(request_session=session, pool_maxsize=4)
+            self.assertIs(session.get_adapter('https://'), adapter)
+            self.assertEqual(adapter._pool_maxsize, 4)
+            self.assertEqual(adapter.max_retries.total, 3)
+
+    def test_set_proxy_configures_session(self):
+        session = Session()
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service(request_session=session)
+            sbs.set_proxy('192.168.0.100', '6000', 'user', 'password')
+
+        self.assertEqual(session.proxies['https'], 'https://192.168.0.100:6000')
+        self.assertEqual(session.headers['Proxy-Authorization'],
+                         'Basic dXNlcjpwYXNzd29yZA==')
+
+
+def _message_handler(body):
+    def handler(method, path, headers, request_body):
+        if path.startswith('/myqueue/messages/head'):
+            return 200, {
+                'BrokerProperties': json.dumps({'SequenceNumber': 1}),
+                'Content-Type': 'application/octet-stream',
+            }, body
+        return 404, {}, b'not found'
+    return handler
+
+
+class ServiceBusReceiveBodyTest(unittest.TestCase):
+
+    @unittest.skipIf(tracemalloc is None, 'requires tracemalloc')
+    def test_body_is_read_once(self):
+        body = b'x' * (4 * 1024 * 1024)
+        with FakeServiceBusEndpoint(_message_handler(body)) as endpoint:
+            sbs = endpoint.create_service()
+            sbs.read_delete_queue_message('myqueue')
+
+            tracemalloc.start()
+            try:
+                message = sbs.read_delete_queue_message('myqueue')
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        self.assertEqual(message.body, body)
+        # response.content would join the chunks into a second copy
+        self.assertLess(peak, len(body) * 1.5)
+
+    def test_stream_body(self):
+        body = b'0123456789' * 10000
+        with FakeServiceBusEndpoint(_message_handler(body)) as endpoint:
+            sbs = endpoint.create_service()
+
+            message = sbs.receive_queue_message('myqueue', peek_lock=False, stream=True)
+            self.assertEqual(message.broker_properties['SequenceNumber'], 1)
+            self.assertEqual(message.body.read(10), b'0123456789')
+            self.assertEqual(message.body.read(), body[10:])
+
+            # the connection was released to the pool once the body was read
+            message = sbs.read_delete_queue_message('myqueue', stream=True)
+            message.body.read()
+            self.assertEqual(endpoint.connections, 1)
+
+    def test_stream_empty_and_error_responses(self):
+        with FakeServiceBusEndpoint(
+                lambda method, path, headers, body: (204, {}, b'')) as endpoint:
+            sbs = endpoint.create_service()
+            message = sbs.peek_lock_queue_message('myqueue', stream=True)
+        self.assertIsNone(message.body)
+
+        with FakeServiceBusEndpoint(_message_handler(b'')) as endpoint:
+            sbs = endpoint.create_service()
+            with self.assertRaises(AzureMissingResourceHttpError):
+                sbs.peek_lock_subscription_message('mytopic', 'mysub', stream=True)
+
+    def test_stream_read_length(self):
+        response = _Response(_requests_response(io.BytesIO(b'0123456789')),
+                             stream=True)
+        self.assertIsNone(response.length)
+        self.assertEqual(response.read(4), b'0123')
+        self.assertEqual(response.read().read(), b'456789')
+
+    def test_body_errors_are_requests_errors(self):
+        raw = MagicMock()
+        raw.read.side_effect = ProtocolError('Connection broken')
+        with self.assertRaises(ConnectionError):
+            _Response(_requests_response(raw))
+
+        raw.read.side_effect = ReadTimeoutError(None, None, 'Read timed out.')
+        with self.assertRaises(ReadTimeout):
+            _Response(_requests_response(raw))
+
+        body = _Response(_requests_response(raw), stream=True).read()
+        with self.assertRaises(ReadTimeout):
+            body.read(10)
+
+
+def _requests_response(raw):
+    response = MagicMock()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.headers = {'content-type': 'application/octet-stream'}
+    response.raw = raw
+    return response
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import itertools
+import time
+import unittest
+
+from azure.common import AzureHttpError
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+from tests.test_servicebus_serialization import _QUEUE_ENTRY
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+
+#------------------------------------------------------------------------------
+
+
+class _FakeQueueFeed(object):
+
+    def __init__(self, count, fail_after=None):
+        self.count = count
+        self.fail_after = fail_after
+        self.pages = []
+
+    def __call__(self, method, path, headers, body):
+        query = parse_qs(urlparse(path).query)
+        skip = int(query['$skip'][0])
+        top = int(query['$top'][0])
+        self.pages.append((skip, top))
+        if self.fail_after is not None and skip >= self.fail_after:
+            return 500, {}, b''
+        entries = ''.join(_QUEUE_ENTRY.format(i)
+                          for i in range(skip, min(skip + top, self.count)))
+        return 200, {}, ('<feed xmlns="http://www.w3.org/2005/Atom">' +
+                         entries + '</feed>').encode('utf-8')
+
+
+class ServiceBusPagingTest(unittest.TestCase):
+
+    def test_iter_queues_requests_pages(self):
+        feed = _FakeQueueFeed(250)
+        with FakeServiceBusEndpoint(feed) as endpoint:
+            sbs = endpoint.create_service()
+            names = [queue.name for queue in sbs.iter_queues(page_size=100)]
+
+        self.assertEqual(names, ['queue{0}'.format(i) for i in range(250)])
+        self.assertEqual(feed.pages, [(0, 100), (100, 100), (200, 100)])
+        self.assertTrue(endpoint.requests[0][1].startswith('/$Resources/Queues?'))
+
+    def test_iteration_is_lazy(self):
+        feed = _FakeQueueFeed(1000)
+        with FakeServiceBusEndpoint(feed) as endpoint:
+            sbs = endpoint.create_service()
+            queues = sbs.iter_queues(page_size=10)
+            self.assertEqual(feed.pages, [])
+            first = list(itertools.islice(queues, 15))
+
+        self.assertEqual(len(first), 15)
+        self.assertEqual(feed.pages, [(0, 10), (10, 10)])
+
+    def test_prefetch_runs_ahead_and_stops(self):
+        feed = _FakeQueueFeed(1000)
+        with FakeServiceBusEndpoint(feed) as endpoint:
+            sbs = endpoint.create_service()
+            queues = sbs.iter_queues(page_size=10, prefetch_pages=2)
+            next(queues)
+            deadline = time.time() + 5
+            while len(feed.pages) < 3 and time.time() < deadline:
+                time.sleep(0.05)
+            time.sleep(0.3)
+            # one page consumed, two queued and one waiting to be queued
+            self.assertLessEqual(len(feed.pages), 4)
+            self.assertGreaterEqual(len(feed.pages), 3)
+
+            queues.close()
+            time.sleep(0.3)
+            fetched = len(feed.pages)
+            time.sleep(0.3)
+            self.assertEqual(len(feed.pages), fetched)
+
+    def test_prefetch_yields_all_pages(self):
+        feed = _FakeQueueFeed(95)
+        with FakeServiceBusEndpoint(feed) as endpoint:
+            sbs = endpoint.create_service()
+            names = [queue.name for queue in sbs.iter_queues(page_size=10, prefetch_pages=3)]
+
+        self.assertEqual(names, ['queue{0}'.format(i) for i in range(95)])
+
+    def test_error_is_raised_after_previous_pages(self):
+        feed = _FakeQueueFeed(100, fail_after=10)
+        with FakeServiceBusEndpoint(feed) as endpoint:
+            sbs = endpoint.create_service()
+            names = []
+            with self.assertRaises(AzureHttpError):
+                for queue in sbs.iter_queues(page_size=10, prefetch_pages=2):
+                    names.append(queue.name)
+
+        self.assertEqual(len(names), 10)
+
+    def test_iter_subscriptions_and_rules_paths(self):
+        with FakeServiceBusEndpoint(
+                lambda method, path, headers, body: (
+                    200, {}, b'<feed xmlns="http://www.w3.org/2005/Atom"></feed>')) as endpoint:
+            sbs = endpoint.create_service()
+            self.assertEqual(list(sbs.iter_topics()), [])
+            self.assertEqual(list(sbs.iter_subscriptions('mytopic')), [])
+            self.assertEqual(list(sbs.iter_rules('mytopic', 'mysub', page_size=5)), [])
+
+        paths = [path for method, path, headers, body in endpoint.requests]
+        self.assertEqual(paths, [
+            '/$Resources/Topics?$skip=0&$top=100',
+            '/mytopic/subscriptions/?$skip=0&$top=100',
+            '/mytopic/subscriptions/mysub/rules/?$skip=0&$top=5',
+        ])
+
+    def test_invalid_page_size(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            with self.assertRaises(ValueError):
+                sbs.iter_queues(page_size=0)
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
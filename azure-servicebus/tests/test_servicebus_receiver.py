@@ -0,0 +1,174 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import json
+import threading
+import time
+import unittest
+
+from azure.servicebus import MessageReceiver
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+
+
+#------------------------------------------------------------------------------
+
+
+class _FakeQueue(object):
+
+    def __init__(self, count):
+        self.messages = list(range(1, count + 1))
+        self.completed = []
+        self.unlocked = []
+        self.renewed = []
+        self._lock = threading.Lock()
+
+    def __call__(self, method, path, headers, body):
+        if path.startswith('/myqueue/messages/head'):
+            with self._lock:
+                number = self.messages.pop(0) if self.messages else None
+            if number is None:
+                time.sleep(0.05)
+                return 204, {}, b''
+            return 201, {
+                'BrokerProperties': json.dumps({'SequenceNumber': number, 'LockToken': 'token'}),
+                'Location': 'http://{0}/myqueue/messages/{1}/token'.format(headers['host'], number),
+            }, str(number).encode('utf-8')
+
+        number = int(path.split('/')[3])
+        with self._lock:
+            if method == 'DELETE':
+                self.completed.append(number)
+            elif method == 'PUT':
+                self.unlocked.append(number)
+                self.messages.append(number)
+            else:
+                self.renewed.append(number)
+        return 200, {}, b''
+
+
+class ServiceBusReceiverTest(unittest.TestCase):
+
+    def _wait_for(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_receive_and_complete(self):
+        queue = _FakeQueue(50)
+        handled = []
+        with FakeServiceBusEndpoint(queue) as endpoint:
+            sbs = endpoint.create_service()
+            receiver = MessageReceiver(sbs, lambda message: handled.append(message.body),
+                                       queue_name='myqueue', timeout=1)
+            with receiver:
+                self._wait_for(lambda: len(queue.completed) == 50)
+
+        self.assertEqual(sorted(queue.completed), list(range(1, 51)))
+        self.assertEqual(len(handled), 50)
+        metrics = receiver.metrics
+        self.assertEqual(metrics['received'], 50)
+        self.assertEqual(metrics['completed'], 50)
+        self.assertEqual(metrics['buffered'], 0)
+
+    def test_failed_handler_unlocks_message(self):
+        queue = _FakeQueue(1)
+        calls = []
+
+        def handler(message):
+            calls.append(message.body)
+            if len(calls) == 1:
+                raise ValueError()
+
+        with FakeServiceBusEndpoint(queue) as endpoint:
+            sbs = endpoint.create_service()
+            with MessageReceiver(sbs, handler, queue_name='myqueue', timeout=1) as receiver:
+                self._wait_for(lambda: queue.completed)
+
+        self.assertEqual(queue.unlocked, [1])
+        self.assertEqual(queue.completed, [1])
+        self.assertEqual(receiver.abandoned, 1)
+
+    def test_lock_is_renewed(self):
+        queue = _FakeQueue(1)
+        with FakeServiceBusEndpoint(queue) as endpoint:
+            sbs = endpoint.create_service()
+            receiver = MessageReceiver(sbs, lambda message: time.sleep(2.5),
+                                       queue_name='myqueue', timeout=1,
+                                       lock_duration=1.5, lock_renewal_margin=1)
+            with receiver:
+                self._wait_for(lambda: queue.completed)
+
+        self.assertEqual(queue.completed, [1])
+        self.assertTrue(queue.renewed)
+        self.assertEqual(receiver.lock_renewals, len(queue.renewed))
+
+    def test_buffer_applies_backpressure(self):
+        queue = _FakeQueue(50)
+        release = threading.Event()
+        with FakeServiceBusEndpoint(queue) as endpoint:
+            sbs = endpoint.create_service()
+            receiver = MessageReceiver(sbs, lambda message: release.wait(),
+                                       queue_name='myqueue', timeout=1,
+                                       prefetch_count=2, buffer_size=3, max_workers=1)
+            receiver.start()
+            self._wait_for(lambda: receiver.buffered == 3)
+            time.sleep(0.2)
+            # one message in the handler, three buffered, one per blocked receive
+            self.assertLessEqual(receiver.received, 6)
+            release.set()
+            receiver.stop()
+
+        self.assertEqual(receiver.processing, 0)
+
+    def test_messages_received_after_stop_are_unlocked(self):
+        queue = _FakeQueue(2)
+        handler = queue.__call__
+        polls = []
+
+        def slow_receive(method, path, headers, body):
+            if path.startswith('/myqueue/messages/head'):
+                polls.append(path)
+                time.sleep(0.5)
+            return handler(method, path, headers, body)
+
+        with FakeServiceBusEndpoint(slow_receive) as endpoint:
+            sbs = endpoint.create_service()
+            receiver = MessageReceiver(sbs, lambda message: None, queue_name='myqueue',
+                                       timeout=1, prefetch_count=2)
+            receiver.start()
+            self._wait_for(lambda: len(polls) == 2)
+            # restarted while the receive threads are in a long poll
+            receiver.stop(wait=False)
+            receiver.start()
+            self._wait_for(lambda: len(queue.unlocked) == 2)
+
+            # the messages received after stop were unlocked rather than
+            # dispatched, and the previous receive threads exited
+            self.assertEqual(sorted(queue.unlocked), [1, 2])
+            time.sleep(0.2)
+            self.assertEqual(receiver.in_flight, 2)
+            receiver.stop()
+            self.assertEqual(receiver.in_flight, 0)
+            self.assertEqual(receiver.buffered, 0)
+
+    def test_missing_entity(self):
+        with self.assertRaises(ValueError):
+            MessageReceiver(object(), lambda message: None, topic_name='mytopic')
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
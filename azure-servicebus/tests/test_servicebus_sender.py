@@ -0,0 +1,193 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import json
+import time
+import unittest
+
+from azure.servicebus import (
+    AzureServiceBusBatchSendError,
+    EventHubSender,
+    Message,
+    MessageBatchSender,
+)
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+
+
+#------------------------------------------------------------------------------
+
+
+class ServiceBusSenderTest(unittest.TestCase):
+
+    def _messages(self, count):
+        return [Message('message {0}'.format(i), custom_properties={'index': i})
+                for i in range(count)]
+
+    def _batches(self, endpoint):
+        return [body for method, path, headers, body in endpoint.requests]
+
+    def test_batches_are_bounded_and_complete(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            with MessageBatchSender(sbs, queue_name='myqueue', max_batch_size=1024) as sender:
+                sender.send_all(self._messages(200))
+
+        batches = self._batches(endpoint)
+        self.assertGreater(len(batches), 1)
+        for body in batches:
+            self.assertLessEqual(len(body), 1024)
+        received = [json.loads(body.decode('utf-8')) for body in batches]
+        indexes = sorted(int(item['UserProperties']['index']) for batch in received for item in batch)
+        self.assertEqual(indexes, list(range(200)))
+        self.assertEqual(sender.messages_sent, 200)
+        self.assertEqual(sender.batches_sent, len(batches))
+        self.assertEqual(sender.bytes_sent, sum(len(body) for body in batches))
+
+        method, path, headers, body = endpoint.requests[0]
+        self.assertEqual((method, path), ('POST', '/myqueue/messages'))
+        self.assertEqual(headers['content-type'], 'application/vnd.microsoft.servicebus.json')
+
+    def test_batches_fill_up_to_limit(self):
+        message = Message('x' * 80)
+        size = len(json.dumps(message.as_batch_body()))
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            # room for exactly three messages per batch
+            with MessageBatchSender(sbs, topic_name='mytopic', max_batch_size=3 * size + 4) as sender:
+                sender.send_all([message] * 7)
+
+        self.assertEqual(sorted(len(json.loads(body.decode('utf-8')))
+                                for body in self._batches(endpoint)), [1, 3, 3])
+
+    def test_message_too_large(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            with MessageBatchSender(sbs, queue_name='myqueue', max_batch_size=100) as sender:
+                with self.assertRaises(ValueError):
+                    sender.send(Message('x' * 100))
+
+        self.assertEqual(endpoint.requests, [])
+
+    def test_linger_sends_partial_batch(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            with MessageBatchSender(sbs, queue_name='myqueue', linger=0.2) as sender:
+                sender.send(Message('message'))
+                deadline = time.time() + 5
+                while not endpoint.requests and time.time() < deadline:
+                    time.sleep(0.05)
+                self.assertEqual(len(endpoint.requests), 1)
+
+    def test_failed_batches_are_recorded_and_raised(self):
+        with FakeServiceBusEndpoint(
+                lambda method, path, headers, body: (500, {}, b'')) as endpoint:
+            sbs = endpoint.create_service()
+            messages = self._messages(3)
+            sender = MessageBatchSender(sbs, queue_name='myqueue')
+            with self.assertRaises(AzureServiceBusBatchSendError) as context:
+                sender.send_all(messages)
+            self.assertEqual(context.exception.failed[0][0], messages)
+
+            # failures are raised once
+            sender.flush()
+            sender.close()
+
+        self.assertEqual(len(sender.failed), 1)
+        self.assertEqual(sender.failed[0][0], messages)
+        self.assertEqual(sender.messages_sent, 0)
+
+    def test_close_is_idempotent(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            sender = MessageBatchSender(sbs, queue_name='myqueue')
+            sender.send(Message('message'))
+            sender.close()
+            sender.close()
+
+        self.assertEqual(len(endpoint.requests), 1)
+        with self.assertRaises(ValueError):
+            sender.send(Message('message'))
+
+    def test_linger_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            MessageBatchSender(object(), queue_name='myqueue', linger=0)
+
+    def test_missing_entity(self):
+        with self.assertRaises(ValueError):
+            MessageBatchSender(object(), queue_name='myqueue', topic_name='mytopic')
+
+
+class EventHubSenderTest(unittest.TestCase):
+
+    def _batches(self, endpoint):
+        return [(path, json.loads(body.decode('utf-8')))
+                for method, path, headers, body in endpoint.requests]
+
+    def test_events_are_grouped_by_publisher_and_partition_key(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            with EventHubSender(sbs, 'myhub', max_batch_size=2048) as sender:
+                for i in range(30):
+                    sender.send('{{"value": {0}}}'.format(i), device_id='dev{0}'.format(i % 2))
+                for i in range(30):
+                    sender.send(Message('{{"value": {0}}}'.format(i), custom_properties={'index': i}),
+                                partition_key='key{0}'.format(i % 3))
+                sender.flush()
+
+        batches = self._batches(endpoint)
+        paths = set(path for path, events in batches)
+        self.assertEqual(paths, set([
+            '/myhub/publishers/dev0/messages?api-version=2014-01',
+            '/myhub/publishers/dev1/messages?api-version=2014-01',
+            '/myhub/messages?api-version=2014-01',
+        ]))
+        self.assertEqual(sum(len(events) for path, events in batches), 60)
+        for path, events in batches:
+            keys = set((event.get('BrokerProperties') or {}).get('PartitionKey') for event in events)
+            self.assertEqual(len(keys), 1)
+            if path.startswith('/myhub/messages'):
+                self.assertIsNotNone(keys.pop())
+                self.assertIn('index', events[0]['UserProperties'])
+        self.assertEqual(
+            endpoint.requests[0][2]['content-type'], 'application/vnd.microsoft.servicebus.json')
+
+    def test_metrics(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            with EventHubSender(sbs, 'myhub', max_batch_size=1024, max_workers=4) as sender:
+                sender.send_all('event {0}'.format(i) for i in range(500))
+
+        metrics = sender.metrics
+        self.assertEqual(metrics['messages_sent'], 500)
+        self.assertEqual(metrics['batches_sent'], len(endpoint.requests))
+        self.assertEqual(metrics['failed_batches'], 0)
+        self.assertGreater(metrics['mean_batch_latency'], 0)
+        self.assertGreaterEqual(metrics['max_batch_latency'], metrics['mean_batch_latency'])
+        self.assertGreater(metrics['messages_per_second'], 0)
+
+    def test_send_event_batch(self):
+        with FakeServiceBusEndpoint() as endpoint:
+            sbs = endpoint.create_service()
+            sbs.send_event_batch('myhub', [Message('a'), Message('b')], device_id='dev')
+
+        method, path, headers, body = endpoint.requests[0]
+        self.assertEqual(path, '/myhub/publishers/dev/messages?api-version=2014-01')
+        self.assertEqual(json.loads(body.decode('utf-8')), [{'Body': 'a'}, {'Body': 'b'}])
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# coding: utf-8
+
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import unittest
+
+from azure.servicebus import Queue, Rule
+from azure.servicebus._common_serialization import (
+    _ETreeXmlToObject,
+    _XmlWriter,
+)
+from azure.servicebus._serialization import (
+    _convert_etree_element_to_queue,
+    _convert_queue_to_xml,
+    _convert_rule_to_xml,
+)
+from tests.servicebus_fake_endpoint import FakeServiceBusEndpoint
+
+
+#------------------------------------------------------------------------------
+
+
+_QUEUE_ENTRY = '''<entry>
+<id>https://mynamespace.servicebus.windows.net/queue{0}</id>
+<title type="text">queue{0}</title>
+<updated>2017-05-01T10:00:00Z</updated>
+<author><name>mynamespace</name></author>
+<content type="application/xml">
+<QueueDescription xmlns="http://schemas.microsoft.com/netservices/2010/10/servicebus/connect" xmlns:i="http://www.w3.org/2001/XMLSchema-instance">
+<LockDuration>PT1M</LockDuration>
+<MaxSizeInMegabytes>1024</MaxSizeInMegabytes>
+<RequiresSession>false</RequiresSession>
+<MessageCount>{0}</MessageCount>
+</QueueDescription>
+</content>
+</entry>'''
+
+
+def _queue_feed(count):
+    return ('<?xml version="1.0" encoding="utf-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom">'
+            '<title type="text">Queues</title>' +
+            ''.join(_QUEUE_ENTRY.format(i) for i in range(count)) +
+            '</feed>').encode('utf-8')
+
+
+class ServiceBusSerializationTest(unittest.TestCase):
+
+    def test_list_queues_large_feed(self):
+        body = _queue_feed(2000)
+        with FakeServiceBusEndpoint(
+                lambda method, path, headers, body_: (200, {}, body)) as endpoint:
+            sbs = endpoint.create_service()
+            queues = sbs.list_queues()
+
+        self.assertEqual(len(queues), 2000)
+        self.assertEqual([queue.name for queue in queues[:2]], ['queue0', 'queue1'])
+        self.assertEqual(queues[1999].message_count, 1999)
+        self.assertEqual(queues[0].max_size_in_megabytes, 1024)
+        self.assertFalse(queues[0].requires_session)
+        self.assertEqual(queues[0].author, 'mynamespace')
+
+    def test_feed_entries_are_yielded_incrementally(self):
+        entries = _ETreeXmlToObject.iter_feed_entries(
+            _queue_feed(3), _convert_etree_element_to_queue)
+        first = next(entries)
+        self.assertEqual(first.name, 'queue0')
+        self.assertEqual([queue.name for queue in entries], ['queue1', 'queue2'])
+
+    def test_single_entry_feed(self):
+        body = ('<entry xmlns="http://www.w3.org/2005/Atom">' +
+                _QUEUE_ENTRY.format(7)[len('<entry>'):]).encode('utf-8')
+        queues = list(_ETreeXmlToObject.iter_feed_entries(
+            body, _convert_etree_element_to_queue))
+
+        self.assertEqual([(queue.name, queue.message_count) for queue in queues], [('queue7', 7)])
+
+    def test_unknown_root_element(self):
+        with self.assertRaises(NotImplementedError):
+            list(_ETreeXmlToObject.iter_feed_entries(
+                b'<other xmlns="http://www.w3.org/2005/Atom"/>', None))
+
+    def test_writer(self):
+        writer = _XmlWriter()
+        writer.preprocessor('<?xml version="1.0"?>')
+        writer.start('root', [('a', 'x<y', None), ('b', None, None)])
+        writer.elements([('Value', True, lambda value: value.lower()), ('Missing', None, None)])
+        writer.element('Text', 'a & b')
+        writer.end('root')
+
+        self.assertEqual(
+            writer.xml(),
+            '<?xml version="1.0"?><root a="x&lt;y"><Value>true</Value><Text>a &amp; b</Text></root>')
+
+    def test_writer_indent(self):
+        writer = _XmlWriter(indent_string='  ')
+        writer.start('root')
+        writer.element('Value', 1)
+        writer.end('root')
+
+        self.assertEqual(writer.xml(), '<root>\n  <Value>1</Value>\n</root>\n')
+
+    def test_queue_and_rule_to_xml(self):
+        queue = Queue(lock_duration='PT1M', requires_session=False, max_delivery_count=5)
+        xml = _convert_queue_to_xml(queue)
+        self.assertIn('<LockDuration>PT1M</LockDuration><RequiresSession>false</RequiresSession>'
+                      '<MaxDeliveryCount>5</MaxDeliveryCount>', xml)
+
+        rule = Rule(filter_type='SqlFilter', filter_expression="a > 1")
+        xml = _convert_rule_to_xml(rule)
+        self.assertIn('<Filter i:type="SqlFilter"><SqlExpression>a &gt; 1</SqlExpression>'
+                      '<CompatibilityLevel>20</CompatibilityLevel></Filter>', xml)
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()